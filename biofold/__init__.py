@@ -24,11 +24,9 @@
 # *
 # **************************************************************************
 
+import os
 from os.path import join, exists
 
-import pwem
-from scipion.install.funcs import InstallHelper
-
 from pwchem import Plugin as pwchemPlugin
 from .constants import *
 
@@ -47,9 +45,20 @@ class Plugin(pwchemPlugin):
         """
         cls._defineEmVar(BOLTZ_DIC['home'], cls.getEnvName(BOLTZ_DIC))
         cls._defineEmVar(CHAI_DIC['home'], cls.getEnvName(CHAI_DIC))
+        cls._defineEmVar(BIOFOLD_CACHE, 'biofold-cache')
+        cls._defineVar(BIOFOLD_OFFLINE, 'False')
+
+    @classmethod
+    def getPrefetchCommand(cls, packageDic):
+        """ Command downloading the model weights of the package into the shared weights cache.
+        """
+        scriptPath = join(os.path.dirname(os.path.abspath(__file__)), 'scripts', 'prefetchWeights.py')
+        weightsDir = join(cls.getVar(BIOFOLD_CACHE), WEIGHTS_DIR, packageDic['name'])
+        return f"{cls.getEnvActivationCommand(packageDic)} && python {scriptPath} {packageDic['name']} {weightsDir}"
 
     @classmethod
     def addBoltzPackage(cls, env, default=True):
+        from scipion.install.funcs import InstallHelper
         installer = InstallHelper(
             BOLTZ_DIC['name'],
             packageHome=cls.getVar(BOLTZ_DIC['home']),
@@ -65,6 +74,9 @@ class Plugin(pwchemPlugin):
             "git clone --branch v2.2.1 --depth 1 https://github.com/jwohlwend/boltz.git && "
             "pip install --editable ./boltz[cuda]",
             f"{BOLTZ_DIC['name']}_installed"
+        ).addCommand(
+            cls.getPrefetchCommand(BOLTZ_DIC),
+            f"{BOLTZ_DIC['name']}_weights"
         )
 
         installer.addPackage(
@@ -75,6 +87,7 @@ class Plugin(pwchemPlugin):
 
     @classmethod
     def addChaiPackage(cls, env, default=True):
+        from scipion.install.funcs import InstallHelper
         installer = InstallHelper(
             CHAI_DIC['name'],
             packageHome=cls.getVar(CHAI_DIC['home']),
@@ -89,6 +102,9 @@ class Plugin(pwchemPlugin):
             f"{cls.getEnvActivationCommand(CHAI_DIC)} && "
             "pip install chai_lab==0.6.1",
             f"{CHAI_DIC['name']}_installed"
+        ).addCommand(
+            cls.getPrefetchCommand(CHAI_DIC),
+            f"{CHAI_DIC['name']}_weights"
         )
 
         installer.addPackage(
@@ -28,3 +28,27 @@
 BOLTZ_DIC = {'name': 'boltz', 'version': '2.2.1', 'home': 'BOLTZ_HOME'}
 CHAI_DIC = {'name': 'chai', 'version': '0.6.1', 'home': 'CHAI_HOME'}
 
+# Number of shards per device in which batch predictions are split, so idle devices can pick the pending ones
+SHARDS_PER_DEVICE = 4
+
+# Site-level cache shared by all the biofold protocols
+BIOFOLD_CACHE = 'BIOFOLD_CACHE'
+MSA_CACHE_SIZE = 50 * 1024 ** 3
+PREDICTION_CACHE_SIZE = 200 * 1024 ** 3
+ESM_CACHE_SIZE = 20 * 1024 ** 3
+# Subdirectory of the site cache with the model weights of each tool, shared by all the runs
+WEIGHTS_DIR = 'weights'
+
+# With offline mode on, predictions fail at once if the weights are missing instead of downloading them
+BIOFOLD_OFFLINE = 'BIOFOLD_OFFLINE'
+OFFLINE_ENVIRON = {'HF_HUB_OFFLINE': '1', 'TRANSFORMERS_OFFLINE': '1'}
+
+# Number of parsed structures the wizards keep in memory
+STRUCTURE_CACHE_SIZE = 8
+
+# Entity types that can be given in the headers of chai fasta files
+CHAI_ENTITIES = ('protein', 'dna', 'rna', 'ligand')
+
+# Number of ligands shown in the summary of a ligand screening, and of targets in the summary of a batch
+SUMMARY_TOP_LIGANDS = 10
+SUMMARY_TOP_TARGETS = 10
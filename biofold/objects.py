@@ -24,6 +24,14 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
+import itertools
+import json
+import re
+import string
+
+BOLTZ_POLYMERS = ("protein", "dna", "rna")
+
+
 class BoltzEntity:
     def __init__(self, entity_type, chain_id, sequence=None,
                  smiles=None, ccd=None, msa=None, cyclic=False):
@@ -36,4 +44,108 @@ class BoltzEntity:
         self.cyclic = cyclic
         self.modifications = []
 
+    def getMergeKey(self):
+        return (
+            self.entity_type,
+            self.sequence,
+            self.smiles,
+            self.ccd,
+            self.msa,
+            self.cyclic
+        )
+
+    def toDict(self):
+        """Returns the entity as an item of the sequences list of a Boltz input"""
+        body = {
+            "id": self.ids if len(self.ids) > 1 else self.ids[0],
+            "cyclic": self.cyclic
+        }
+
+        if self.entity_type in BOLTZ_POLYMERS:
+            body["sequence"] = self.sequence
+            if self.msa:
+                body["msa"] = self.msa
+            if self.modifications:
+                body["modifications"] = self.modifications
+        elif self.smiles:
+            body = {"id": body["id"], "smiles": self.smiles}
+        elif self.ccd:
+            body = {"id": body["id"], "ccd": self.ccd}
+
+        return {self.entity_type: body}
+
+
+def iterChainIds():
+    """Yields the chain ids A..Z, AA..ZZ, AAA..., so there is no limit on the number of chains"""
+    for length in itertools.count(1):
+        for letters in itertools.product(string.ascii_uppercase, repeat=length):
+            yield ''.join(letters)
+
+
+def buildBoltzEntities(entities, cyclic=False):
+    """Returns the BoltzEntity of every (entityType, sequence) pair, with consecutive chain ids.
+    Ligand sequences are SMILES, cyclic only applies to the polymers"""
+    chainIds, boltzEntities = iterChainIds(), []
+    for entityType, sequence in entities:
+        if entityType in BOLTZ_POLYMERS:
+            boltzEntities.append(BoltzEntity(entityType, next(chainIds), sequence=sequence, cyclic=cyclic))
+        else:
+            boltzEntities.append(BoltzEntity(entityType, next(chainIds), smiles=sequence))
+    return boltzEntities
+
+
+def mergeEntities(entities):
+    """Merges the identical entities (e.g. homo-oligomer copies) into a single one with several chain ids"""
+    merged = {}
+    for e in entities:
+        key = e.getMergeKey()
+        if key not in merged:
+            merged[key] = e
+        else:
+            merged[key].ids.extend(e.ids)
+    return list(merged.values())
+
+
+def buildBoltzDocument(sequences, properties=None):
+    """Returns the Boltz input document for a list of sequence items (BoltzEntity or their dictionaries)"""
+    document = {
+        "version": 1,
+        "sequences": [e.toDict() if isinstance(e, BoltzEntity) else e for e in sequences]
+    }
+    if properties:
+        document["properties"] = properties
+    return document
+
+
+def toYamlScalar(value):
+    if isinstance(value, (dict, list)):
+        return '{}' if isinstance(value, dict) else '[]'
+    # JSON scalars (double quoted strings, true/false/null and numbers) are valid YAML scalars
+    return json.dumps(value)
+
+
+def toYamlLines(value, indent=0):
+    """Block style YAML emitter for the plain dict/list/scalar documents of the Boltz inputs"""
+    pad, lines = '  ' * indent, []
+    if isinstance(value, dict):
+        for key, item in value.items():
+            key = key if re.match(r'^[A-Za-z_][\w-]*$', str(key)) else json.dumps(str(key))
+            if isinstance(item, (dict, list)) and item:
+                lines.append(f'{pad}{key}:')
+                lines += toYamlLines(item, indent + 1)
+            else:
+                lines.append(f'{pad}{key}: {toYamlScalar(item)}')
+    else:
+        for item in value:
+            if isinstance(item, (dict, list)) and item:
+                itemLines = toYamlLines(item, indent + 1)
+                lines.append(f'{pad}- {itemLines[0].lstrip()}')
+                lines += itemLines[1:]
+            else:
+                lines.append(f'{pad}- {toYamlScalar(item)}')
+    return lines
+
 
+def writeBoltzYaml(document, yamlPath):
+    with open(yamlPath, 'w') as f:
+        f.write('\n'.join(toYamlLines(document)) + '\n')
@@ -3,8 +3,46 @@
 # Module to declare protocols
 # Find documentation here: https://scipion-em.github.io/docs/docs/developer/creating-a-protocol
 # **************************************************************************
+import importlib
+import sys
+from collections.abc import Sequence
 
-from .protocol_import_predictions import ProtImportPredictions
-from .protocol_boltz import ProtBoltz
-from .protocol_chai import ProtChai
+# Protocols and the module they are defined in. They are imported the first time they are used, so loading one
+# protocol (e.g. to run its steps) does not load the others
+_PROTOCOLS = {
+    'ProtImportPredictions': 'protocol_import_predictions',
+    'ProtBoltz': 'protocol_boltz',
+    'ProtChai': 'protocol_chai',
+}
 
+__all__ = list(_PROTOCOLS)
+
+
+def __getattr__(name):
+    if name not in _PROTOCOLS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    protocol = getattr(importlib.import_module(f'.{_PROTOCOLS[name]}', __name__), name)
+    globals()[name] = protocol
+    return protocol
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_PROTOCOLS))
+
+
+class ProtocolTargets(Sequence):
+    """
+    Protocols given by name, imported when first accessed. Used as the _targets of the viewers, so discovering
+    the viewers does not import the protocols
+    """
+    def __init__(self, *names):
+        self.names = names
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, index):
+        module = sys.modules[__name__]
+        if isinstance(index, slice):
+            return [getattr(module, name) for name in self.names[index]]
+        return getattr(module, self.names[index])
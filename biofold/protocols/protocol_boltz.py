@@ -23,28 +23,47 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
+import glob
+import itertools
 import json
-import string
+import shlex
+import shutil
 
 import os
 import pyworkflow.protocol.params as params
-from biofold.objects import BoltzEntity
+from biofold.objects import BoltzEntity, buildBoltzEntities, mergeEntities, buildBoltzDocument, writeBoltzYaml, \
+    iterChainIds
 from pwem.protocols import EMProtocol
 from pwchem import Plugin
-from biofold.constants import BOLTZ_DIC
-
-from pwem.objects import  AtomStruct
-from pwchem.protocols.Sequences.protocol_define_sequences import ProtDefineSetOfSequences
-from pwchem.utils.utilsFasta import parseFasta
-
-
-
-class ProtBoltz(EMProtocol):
+from biofold.constants import BOLTZ_DIC, SHARDS_PER_DEVICE, SUMMARY_TOP_LIGANDS
+from biofold.utils.utilsCache import hashSequence, hashFile, hashObject, linkOrCopy, runWithCache, \
+    getCacheSummary
+from biofold.utils.utilsScores import BOLTZ_SCORES, BOLTZ_RANK_SCORE, BOLTZ_AFFINITY_SCORES, \
+    BOLTZ_AFFINITY_RANK_SCORE, getBoltzModels, getBestModel, getBoltzAffinity, writeScoresTable, renameBoltzFile
+from biofold.utils.utilsPlanner import planBoltzLaunch, getPlanArgs, getGpuMemory, countTokens, countYamlTokens
+from biofold.utils.utilsWorker import getWorkerSocket, pingWorker, startWorker, submitJob
+from biofold.utils.utilsConfidence import CONFIDENCE_ATTRIBUTES, getResidueConfidence, \
+    writeConfidenceTable, getConfidenceSummaries
+from biofold.utils.utilsFasta import iterFastaRecords, iterFastaEntities, iterFastaComplexes, guessEntityType
+from biofold.utils.utilsResume import isValidBoltzPrediction
+from biofold.utils.utilsProtocol import PredictionMixin, getUniqueJobName
+from biofold.utils.utilsScheduler import DeviceScheduler, CPU_DEVICE, runCondaJob, getDeviceSummary, \
+    splitInShards
+
+from pwem.objects import  AtomStruct, SetOfAtomStructs
+from pyworkflow.object import String, Float
+
+
+# Neutral job name the predictions are stored with in the prediction cache
+CACHE_TARGET = 'target'
+
+
+class ProtBoltz(PredictionMixin, EMProtocol):
     """
     Protocol to use Boltz-2 model.
     """
     _label = 'boltz-2 modelling'
-    protSeq = ProtDefineSetOfSequences()
+    _engineDic = BOLTZ_DIC
 
     # -------------------------- DEFINE param functions ----------------------
     def _addInputForm(self, form):
@@ -58,7 +77,7 @@ class ProtBoltz(EMProtocol):
                       label="Input structure: ", condition='inputOrigin==1',
                       help='Select the AtomStruct object whose sequence to add to the set')
 
-        form.addParam('entityType', params.EnumParam, default=0, condition='inputOrigin != 2',
+        form.addParam('entityType', params.EnumParam, default=0, condition='inputOrigin in [0,1]',
                       label='Input entity type: ', choices=['Protein', 'DNA', 'RNA'],
                       help='Input entity type to add to the set')
 
@@ -66,7 +85,7 @@ class ProtBoltz(EMProtocol):
                       label='Input chain: ', condition='inputOrigin == 1',
                       help='Specify the protein chain to use as sequence.')
 
-        form.addParam('inpPositions', params.StringParam, condition='inputOrigin != 2',
+        form.addParam('inpPositions', params.StringParam, condition='inputOrigin in [0,1]',
                       label='Input positions: ',
                       help='Specify the positions of the sequence to add in the output.')
 
@@ -74,7 +93,7 @@ class ProtBoltz(EMProtocol):
                       label="Cyclic: ",
                       help='Choose whether the input is cyclic or not.')
 
-        form.addParam('addInput', params.LabelParam, condition='inputOrigin != 2',
+        form.addParam('addInput', params.LabelParam, condition='inputOrigin in [0,1]',
                       label='Add input: ',
                       help='Add sequence to the output set')
 
@@ -89,13 +108,16 @@ class ProtBoltz(EMProtocol):
 
         form.addHidden('gpuList', params.StringParam, default='0',
                        label="Choose GPU IDs",
-                       help="Comma-separated GPU devices that can be used.")
+                       help="Comma-separated GPU devices that can be used. In batch mode, the complexes are "
+                            "distributed over all the listed GPUs.")
 
 
         form.addSection(label='Input')
         form.addParam('inputOrigin', params.EnumParam, default=0,
-                       label='Input origin: ', choices=['Sequence', 'AtomStruct', 'fasta file'],
-                       help='Input origin to add to the set')
+                       label='Input origin: ', choices=['Sequence', 'AtomStruct', 'fasta file', 'Batch'],
+                       help='Input origin to add to the set.\n'
+                            'Batch: predict many complexes with a single boltz run, so the model weights and '
+                            'the CCD are only loaded once.')
         self._addInputForm(form)
 
         form.addParam('inputList', params.TextParam, width=100, condition='inputOrigin in [0,1]',
@@ -106,6 +128,40 @@ class ProtBoltz(EMProtocol):
                       label='Sequence file: ',
                       help='Select the results fasta file.')
 
+        form.addParam('batchOrigin', params.EnumParam, default=0, condition='inputOrigin == 3',
+                      label='Batch origin: ', choices=['SetOfSequences', 'Multi-complex fasta', 'YAML directory'],
+                      help='Origin of the complexes to predict in batch.\n'
+                           'SetOfSequences: each sequence is predicted as an independent target.\n'
+                           'Multi-complex fasta: consecutive records are grouped into complexes by the header prefix '
+                           'before the first "|" (e.g. ">cplx1|A" and ">cplx1|B" form the complex "cplx1").\n'
+                           'YAML directory: folder with one Boltz input YAML per complex.')
+        form.addParam('inputSequences', params.PointerParam, pointerClass='SetOfSequences', allowsNull=True,
+                      condition='inputOrigin == 3 and batchOrigin == 0',
+                      label='Input sequences: ', help='Set of sequences to predict, one target per sequence.')
+        form.addParam('batchFile', params.FileParam, condition='inputOrigin == 3 and batchOrigin == 1',
+                      label='Multi-complex fasta: ',
+                      help='Fasta file (or .fa.gz) with the chains of all the complexes.')
+        form.addParam('batchFolder', params.PathParam, condition='inputOrigin == 3 and batchOrigin == 2',
+                      label='YAML directory: ', help='Directory with the Boltz input YAML files.')
+
+        form.addParam('ligandScreening', params.BooleanParam, default=False, condition='inputOrigin in [0,1,2]',
+                      label='Ligand screening: ',
+                      help='Virtual screening mode: the input sequences are used as receptor and predicted with each '
+                           'ligand of a library, one target per ligand. All the targets share the receptor MSA and '
+                           'are predicted in batch.')
+        form.addParam('ligandOrigin', params.EnumParam, default=0, condition='inputOrigin in [0,1,2] and ligandScreening',
+                      label='Ligands origin: ', choices=['SetOfSmallMolecules', 'SMILES file'],
+                      help='Origin of the ligands library.')
+        form.addParam('inputSmallMols', params.PointerParam, pointerClass='SetOfSmallMolecules', allowsNull=True,
+                      condition='inputOrigin in [0,1,2] and ligandScreening and ligandOrigin == 0',
+                      label='Input small molecules: ', help='Set of small molecules to screen.')
+        form.addParam('ligandsFile', params.FileParam,
+                      condition='inputOrigin in [0,1,2] and ligandScreening and ligandOrigin == 1',
+                      label='SMILES file: ', help='File with one ligand per line as "SMILES name".')
+        form.addParam('predictAffinity', params.BooleanParam, default=True,
+                      condition='inputOrigin in [0,1,2] and ligandScreening',
+                      label='Predict affinity: ', help='Predict the binding affinity of each ligand to the receptor.')
+
         group = form.addGroup('Parameters')
         group.addParam('infPot', params.BooleanParam, default=False,
                         label="Inference potentials: ",
@@ -118,6 +174,37 @@ class ProtBoltz(EMProtocol):
                         label='Diffusion samples: ', help="Number of diffusion samples for prediction.")
         group.addParam('stepScale', params.FloatParam, default=1.638,
                         label='Steps size: ', help="Number of step size. Its related to the temperature at which the diffusion process samples the distribution.")
+        group.addParam('seed', params.IntParam, default=42, expertLevel=params.LEVEL_ADVANCED,
+                       label='Random seed: ', help="Seed of the diffusion sampling, so predictions are reproducible.")
+        group.addParam('writeFullPae', params.BooleanParam, default=True, expertLevel=params.LEVEL_ADVANCED,
+                       label="Write full PAE and PDE: ",
+                       help='Save the predicted aligned error and distance error matrices of every model '
+                            '(pae_*.npz and pde_*.npz), shown by the PAE viewer.')
+        group.addParam('autoPlan', params.BooleanParam, default=True, expertLevel=params.LEVEL_ADVANCED,
+                       label="Memory-aware launch: ",
+                       help='Estimate the peak memory of each prediction from its number of tokens and choose the '
+                            'number of parallel diffusion samples, the MSA subsampling, the data loading workers and '
+                            'the accelerator so the prediction fits in the device as fast as possible.')
+        group.addParam('useMsaCache', params.BooleanParam, default=True, expertLevel=params.LEVEL_ADVANCED,
+                       label="Use MSA cache: ",
+                       help='Reuse the MSAs of the protein sequences already searched by any biofold protocol. '
+                            'Only the sequences not found in the cache are searched in the MSA server.\n'
+                            'Cached MSAs are stored unpaired, so they are valid for any complex the sequence is in.')
+        group.addParam('useResultCache', params.BooleanParam, default=True, expertLevel=params.LEVEL_ADVANCED,
+                       label="Use prediction cache: ",
+                       help='Reuse the predictions of identical targets (same entities, MSAs, parameters, seed and '
+                            'boltz version) already computed by any biofold protocol, without running boltz. '
+                            'Identical targets of a batch are predicted once. If another protocol is predicting the '
+                            'same target, this one waits for its result.\n'
+                            'Set to No to force the prediction of every target.')
+        group.addParam('useWorker', params.BooleanParam, default=False, expertLevel=params.LEVEL_ADVANCED,
+                       label="Use persistent worker: ",
+                       help='Run the predictions in a long-lived boltz worker per GPU that keeps the model loaded '
+                            'between jobs (and protocols), saving the start up and checkpoint loading time. '
+                            'If no worker can be reached, boltz predict is run as usual.')
+        group.addParam('workerIdleTimeout', params.IntParam, default=1800, condition='useWorker',
+                       expertLevel=params.LEVEL_ADVANCED, label="Worker idle timeout (s): ",
+                       help='Seconds without jobs after which the worker shuts down, releasing the GPU.')
         group.addParam('affinityMWcorr', params.BooleanParam, default=False,
                        label="Molecular weight correction: ",
                        help='Choose whether to add the molecular weight correction to the affinity prediction.')
@@ -128,171 +215,296 @@ class ProtBoltz(EMProtocol):
 
     # --------------------------- STEPS functions ------------------------------
     def _insertAllSteps(self):
-        if self.inputOrigin.get() == 2:
+        if self.inputOrigin.get() == 3:
+            self._insertFunctionStep(self.createBatchInputStep)
+        elif self.inputOrigin.get() == 2:
             self._insertFunctionStep(self.createJsonFromFastaStep)
         else:
             self._insertFunctionStep(self.createInputFileStep)
+        if self.isScreening():
+            self._insertFunctionStep(self.createScreeningInputStep)
         self._insertFunctionStep(self.createYamlFileStep)
         self._insertFunctionStep(self.runBoltzStep)
         self._insertFunctionStep(self.createOutputStep)
 
     def createYamlFileStep(self):
-        jsonPath = os.path.abspath(self._getPath("input.json"))
-        yamlPath = os.path.abspath(self._getPath("input.yaml"))
-
-        scriptPath = os.path.join(os.path.dirname(__file__), "..", "scripts", "buildYaml.py")
-
-        Plugin.runCondaCommand(
-            self,
-            program="python",
-            args=f"{scriptPath} {jsonPath} {yamlPath}",
-            condaDic=BOLTZ_DIC
-        )
+        for jsonPath, yamlPath in self.getJsonYamlPairs():
+            if jsonPath is not None:
+                self.writeYaml(jsonPath, yamlPath)
 
     def createJsonFromFastaStep(self):
         fastaPath = os.path.abspath(self.file.get())
-        seqDic = parseFasta(fastaPath)
-
-        chainIdIiter = iter(string.ascii_uppercase)
-        entities = []
-
-        for seqName, sequence in seqDic.items():
-            chainId = next(chainIdIiter)
-            entity = self.guessEntityType(sequence)
-            cyclic = self.cyclic.get()
-
-            entityDict = {
-                "id": chainId,
-                "cyclic": cyclic,
-                "sequence": sequence
-            }
-
-            entities.append({entity: entityDict})
-
-        jsonPath = os.path.abspath(self._getPath("input.json"))
-        with open(jsonPath, 'w') as f:
-            json.dump({"sequences": entities}, f, indent=2)
-
+        entities = self.buildEntities((entityType, sequence) for _, entityType, sequence
+                                      in iterFastaEntities(fastaPath))
+        self.writeInputJson(entities, os.path.abspath(self._getPath("input.json")))
 
     def createInputFileStep(self):
         entities = []
-        chainIdIiter = iter(string.ascii_uppercase)
+        chainIdIiter = iterChainIds()
 
         for inputLine in self.inputList.get().split('\n'):
             if not inputLine.strip():
                 continue
 
             inpJson = json.loads(inputLine.split(')')[1].strip())
-            seqDic = parseFasta(os.path.abspath(inpJson['seqFile']))
-            _, sequence = next(iter(seqDic.items()))
+            _, sequence = next(iterFastaRecords(os.path.abspath(inpJson['seqFile'])))
             entity = inpJson.get('entity', 'protein')
-            cyclic = inpJson.get('cyclic', False)
+            cyclic = str(inpJson.get('cyclic', False)).lower() == 'true'
 
             chainId = next(chainIdIiter)
 
             entity = BoltzEntity(
                 entity_type=entity,
-                chainId=chainId,
+                chain_id=chainId,
                 sequence=sequence,
                 cyclic=cyclic
             )
             entities.append(entity)
 
-        merged = {}
-        for e in entities:
-            key = (
-                e.entity_type,
-                e.sequence,
-                e.smiles,
-                e.ccd,
-                e.msa,
-                e.cyclic
-            )
-            if key not in merged:
-                merged[key] = e
-            else:
-                merged[key].ids.extend(e.ids)
-
-        sequences = []
-        for e in merged.values():
-            body = {
-                "id": e.ids if len(e.ids) > 1 else e.ids[0],
-                "cyclic": e.cyclic
-            }
-
-            if e.entity_type in ("protein", "dna", "rna"):
-                body["sequence"] = e.sequence
-                if e.msa:
-                    body["msa"] = e.msa
-
-            sequences.append({e.entity_type: body})
-
-        jsonPath = os.path.abspath(self._getPath("input.json"))
-
-        with open(jsonPath, "w") as f:
-            json.dump({"sequences": sequences}, f, indent=2)
+        self.writeInputJson(entities, os.path.abspath(self._getPath("input.json")))
 
+    def createBatchInputStep(self):
+        """Write one input file per complex into the batch inputs directory"""
+        inputsDir, jsonDir = self.getBatchInputsDir(), self._getExtraPath('batchJson')
+        os.makedirs(inputsDir, exist_ok=True)
+        os.makedirs(jsonDir, exist_ok=True)
 
+        if self.batchOrigin.get() == 2:
+            for name in sorted(os.listdir(self.batchFolder.get())):
+                if os.path.splitext(name)[1].lower() in ('.yaml', '.yml'):
+                    shutil.copy(os.path.join(self.batchFolder.get(), name), inputsDir)
+        else:
+            usedNames = set()
+            for complexName, entities in self.getBatchComplexes():
+                jobName = getUniqueJobName(complexName, usedNames)
+                self.writeInputJson(self.buildEntities(entities), os.path.join(jsonDir, f"{jobName}.json"))
+
+        if not os.listdir(inputsDir) and not os.listdir(jsonDir):
+            raise Exception("No complexes found in the batch input.")
+
+    def createScreeningInputStep(self):
+        """Write one input file per ligand, with the receptor of input.json and the ligand as affinity binder"""
+        inputsDir, jsonDir = self.getBatchInputsDir(), self._getExtraPath('batchJson')
+        os.makedirs(inputsDir, exist_ok=True)
+        os.makedirs(jsonDir, exist_ok=True)
+
+        with open(self._getPath("input.json")) as f:
+            receptor = json.load(f)["sequences"]
+
+        ligandChain = self.getFreeChainId(receptor)
+        usedNames = set()
+        for smiles, ligandName in self.getLigandSmiles():
+            jobName = getUniqueJobName(ligandName, usedNames)
+            ligand = BoltzEntity(entity_type="ligand", chain_id=ligandChain, smiles=smiles)
+            data = {"sequences": receptor + [ligand.toDict()]}
+            if self.predictAffinity.get():
+                data["properties"] = [{"affinity": {"binder": ligandChain}}]
+
+            with open(os.path.join(jsonDir, f"{jobName}.json"), "w") as f:
+                json.dump(data, f, indent=2)
+
+        if not usedNames:
+            raise Exception("No ligands found in the screening input.")
 
     def runBoltzStep(self):
-        filePath = os.path.abspath(self._getPath("input.yaml"))
-        args = [str(filePath)]
+        devices = self.getDevices()
+        scheduler = DeviceScheduler(devices)
+
+        if self.isScreening() and self.getReceptorMissingMsas():
+            # The first ligand is predicted alone, its receptor MSA is then shared by the rest of the library
+            seedDir = self.createSeedJob()
+            if self.getPendingTargets(seedDir):
+                errors = scheduler.run([seedDir], self.runBoltzJob)
+                if errors:
+                    raise errors[0][1]
+                self.markCompletedTargets()
+            self.shareReceptorMsas()
+
+        # Only the targets with no valid output are (re)submitted, so a failed or preempted run can be resumed
+        inputsDir = self.getBatchInputsDir() if self.isBatch() else self._getPath()
+        pending = [yamlFile for yamlFile in self.getPendingTargets(inputsDir)
+                   if self.isBatch() or os.path.basename(yamlFile) == "input.yaml"]
+
+        if self.useResultCache.get():
+            errors = self.predictWithCache(scheduler, pending)
+        else:
+            errors = self.predictTargets(scheduler, pending)
+        scheduler.writeStats(self.getDeviceStatsFile())
+        if self.useMsaCache.get():
+            self.storeMsas()
+
+        if errors:
+            if self.getMarkers().getDone():
+                # Keep the completed targets registered, the protocol can be resumed to predict the rest
+                self.defineOutputs()
+            raise Exception("Boltz prediction failed for: " + ", ".join(os.path.basename(job) for job, _ in errors))
+
+    def predictTargets(self, scheduler, yamlFiles):
+        """Runs boltz on the YAML targets (in shards if batch). Returns the list of (job, exception) that failed"""
+        if self.isBatch():
+            jobs = self.createShards(len(scheduler.devices), yamlFiles)
+        else:
+            jobs = yamlFiles
+        errors = scheduler.run(jobs, self.runBoltzJob)
+        self.markCompletedTargets()
+        return errors
+
+    def predictWithCache(self, scheduler, yamlFiles):
+        """Predicts the YAML targets not found in the prediction cache, storing their results"""
+        cache = self.getResultCache()
+        errors, counts = runWithCache(
+            cache, yamlFiles, self.getTargetKey,
+            fetch=lambda key, yamlFile: self.fetchCachedPrediction(cache, key, yamlFile),
+            predict=lambda targets: self.predictTargets(scheduler, targets),
+            store=lambda key, yamlFile: self.storeCachedPrediction(cache, key, yamlFile),
+            link=self.linkDuplicatedTarget
+        )
+        print(getCacheSummary(counts), flush=True)
+        self.markCompletedTargets()
+        return errors
+
+    def runBoltzJob(self, device, inputPath):
+        weightsCache = self.getWeightsCache()
+        args = [str(inputPath)]
 
         if self.infPot.get():
             args.append("--use_potentials")
 
-        args.append("--use_msa_server --cache ./mol")
+        args.append(f"--use_msa_server --cache {weightsCache.root}")
         args.append(f" --recycling_steps {self.recyclingSteps.get()}")
         args.append(f" --sampling_steps {self.samplingSteps.get()}")
         args.append(f" --diffusion_samples {self.diffusionSamples.get()}")
         args.append(f" --step_scale {self.stepScale.get()}")
 
+        args.append(f" --seed {self.seed.get()}")
+        if self.writeFullPae.get():
+            args.append(" --write_full_pae --write_full_pde")
         if self.affinityMWcorr.get():
             args.append(" --affinity_mw_correction")
 
         args.append(f" --diffusion_samples_affinity {self.diffusionSamplesAff.get()}")
         args.append(f" --out_dir {os.path.abspath(self._getPath())}")
 
-        if self.useGpu.get():
-            gpu_ids = self.gpuList.get()
-            selected_gpu = gpu_ids.split(",")[0]
-            os.environ["CUDA_VISIBLE_DEVICES"] = selected_gpu
+        if self.autoPlan.get():
+            args += getPlanArgs(self.planJob(device, inputPath))
+        elif device != CPU_DEVICE:
             args.append("--accelerator gpu")
         else:
             args.append("--accelerator cpu")
 
-        Plugin.runCondaCommand(
-            self,
-            args=" ".join(args),
-            condaDic=BOLTZ_DIC,
-            program="boltz predict",
-            cwd=os.path.abspath(Plugin.getVar(BOLTZ_DIC['home']))
-        )
-
-    def createOutputStep(self):
-        predictionsPath = os.path.join(os.path.abspath(self._getPath()), "boltz_results_input", "predictions")
-
-        inputFolders = [f for f in os.listdir(predictionsPath) if os.path.isdir(os.path.join(predictionsPath, f))]
-        if not inputFolders:
-            raise Exception(f"No prediction folders found in {predictionsPath}")
-
-        inputFolder = os.path.join(predictionsPath, inputFolders[0])
-
-        cifFiles = sorted([f for f in os.listdir(inputFolder) if f.lower().endswith('.cif')])
-        if not cifFiles:
-            raise Exception(f"No CIF files found in {inputFolder}")
-
-        cifPath = os.path.join(inputFolder, cifFiles[0])
+        # Shared lock on the weights while predicting, they are downloaded first if missing
+        with weightsCache.use(self.prefetchWeights, offline=self.isOffline()):
+            if self.useWorker.get() and device != CPU_DEVICE and self.runInWorker(device, " ".join(args)):
+                return
+
+            runCondaJob(
+                Plugin.getEnvActivationCommand(BOLTZ_DIC),
+                program="boltz predict",
+                args=" ".join(args),
+                device=device,
+                cwd=os.path.abspath(Plugin.getVar(BOLTZ_DIC['home'])),
+                logFile=os.path.abspath(self._getPath('logs', f'boltz_{device}.log')),
+                env=self.getJobEnviron()
+            )
 
-        bestStruct = AtomStruct(filename=cifPath)
+    def runInWorker(self, device, args):
+        """Runs the job in the persistent worker of the device, starting it if needed.
+        Returns False if no worker is reachable, so the job is run as a boltz predict subprocess"""
+        socketPath = getWorkerSocket('boltz', device)
+        scriptPath = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "scripts", "boltzWorker.py"))
+        workerLog = os.path.join(os.path.dirname(socketPath), f'boltz_{device}.log')
+        if not pingWorker(socketPath) and not startWorker(
+                Plugin.getEnvActivationCommand(BOLTZ_DIC), scriptPath, socketPath, device,
+                self.workerIdleTimeout.get(), cwd=os.path.abspath(Plugin.getVar(BOLTZ_DIC['home'])),
+                logFile=workerLog, env=self.getJobEnviron()):
+            self.logJob(device, f"No boltz worker alive on device {device}, running boltz predict")
+            return False
+
+        self.logJob(device, f"boltz worker {socketPath} (log in {workerLog}): boltz predict {args}")
+        try:
+            submitJob(socketPath, shlex.split(args), os.path.abspath(self._getPath()),
+                      onOutput=lambda path: self.logJob(device, f"Prediction written to {path}"))
+        except OSError as e:
+            self.logJob(device, f"Boltz worker on device {device} is not reachable ({e}), running boltz predict")
+            return False
+        return True
+
+    def logJob(self, device, message):
+        """Writes the message in the log of the boltz jobs of the device (and the protocol log)"""
+        with open(os.path.abspath(self._getPath('logs', f'boltz_{device}.log')), 'a') as log:
+            log.write(f'{message}\n')
+        print(message, flush=True)
 
-        self._defineOutputs(
-            outputAtomStruct=bestStruct
-        )
+    def createOutputStep(self):
+        self.defineOutputs()
+
+    def defineOutputs(self):
+        """Registers the scores of the models in the score store, their per-residue confidence in the confidence
+        table, and the models with both as attributes"""
+        jobs, store = [], self.getScoreStore()
+        for jobName, predFolder in self.getCompletedFolders():
+            models = getBoltzModels(predFolder)
+            if models:
+                affinity = getBoltzAffinity(predFolder)
+                jobs.append((jobName, [(cifFile, {**scores, **affinity}) for cifFile, scores in models], affinity))
+                store.setModels(jobs[-1][1], BOLTZ_RANK_SCORE, job=jobName)
+
+        table = writeConfidenceTable(((cifFile, getResidueConfidence(cifFile)) for _, models, _ in jobs
+                                      for cifFile, _ in models), self.getConfidenceTableFile())
+        confidence = getConfidenceSummaries(table)
+
+        outputSet = SetOfAtomStructs.create(self._getPath())
+        bestStructs, affinityRows = [], []
+        for jobName, models, affinity in jobs:
+            for cifFile, scores in models:
+                outputSet.append(self.createAtomStruct(cifFile, jobName, {**scores, **confidence.get(cifFile, {})}))
+            bestFile, bestScores = getBestModel(models, BOLTZ_RANK_SCORE)
+            bestStructs.append(self.createAtomStruct(bestFile, jobName, {**bestScores, **confidence.get(bestFile, {})}))
+            if affinity:
+                affinityRows.append({'job': jobName, 'smiles': self.getJobLigandSmiles(jobName),
+                                     BOLTZ_RANK_SCORE: bestScores.get(BOLTZ_RANK_SCORE), **affinity})
+
+        if affinityRows:
+            writeScoresTable(affinityRows, ['job', 'smiles', *BOLTZ_AFFINITY_SCORES, BOLTZ_RANK_SCORE],
+                             self.getAffinityTableFile(), sortKey=BOLTZ_AFFINITY_RANK_SCORE)
+
+        if not len(outputSet):
+            raise Exception(f"No predicted structures found in {self._getPath()}")
+
+        if self.isBatch():
+            bestSet = SetOfAtomStructs.create(self._getPath(), suffix='Best')
+            for atomStruct in bestStructs:
+                bestSet.append(atomStruct)
+            self._defineOutputs(
+                outputSetOfAtomStructs=outputSet,
+                outputBestAtomStructs=bestSet
+            )
+        else:
+            self._defineOutputs(
+                outputAtomStruct=bestStructs[0],
+                outputSetOfAtomStructs=outputSet
+            )
 
     # --------------------------- INFO functions -----------------------------------
     def _summary(self):
-        summary = []
+        summary, store = [], self.getScoreStore()
+        best = store.getBestModel()
+        if best:
+            bestFile, _, bestScores = best
+            summary.append(f"Best of {store.countModels()} models (highest confidence score): "
+                           f"{os.path.basename(bestFile)}")
+            for scoreKey, attrName in BOLTZ_SCORES.items():
+                if bestScores.get(scoreKey) is not None:
+                    summary.append(f"  {attrName}: {bestScores[scoreKey]:.3f}")
+        if os.path.exists(self.getAffinityTableFile()):
+            with open(self.getAffinityTableFile()) as f:
+                header = f.readline().rstrip('\n').split('\t')
+                summary.append(f"Top ligands by {BOLTZ_AFFINITY_RANK_SCORE} (full table in {self.getAffinityTableFile()}):")
+                for line in itertools.islice(f, SUMMARY_TOP_LIGANDS):
+                    row = dict(zip(header, line.rstrip('\n').split('\t')))
+                    summary.append(f"  {row['job']}: {row[BOLTZ_AFFINITY_RANK_SCORE]}")
+        summary += self.getPlanSummary()
+        summary += getDeviceSummary(self.getDeviceStatsFile())
         return summary
 
     def _methods(self):
@@ -301,6 +513,18 @@ class ProtBoltz(EMProtocol):
 
     def _validate(self):
         validations = []
+        if self.isScreening():
+            if self.ligandOrigin.get() == 0 and not self.inputSmallMols.get():
+                validations.append('A SetOfSmallMolecules is needed for the ligand screening.')
+            elif self.ligandOrigin.get() == 1 and not self.ligandsFile.get():
+                validations.append('A SMILES file is needed for the ligand screening.')
+        elif self.isBatch():
+            if self.batchOrigin.get() == 0 and not self.inputSequences.get():
+                validations.append('A SetOfSequences is needed for the batch prediction.')
+            elif self.batchOrigin.get() == 1 and not self.batchFile.get():
+                validations.append('A multi-complex fasta file is needed for the batch prediction.')
+            elif self.batchOrigin.get() == 2 and not self.batchFolder.get():
+                validations.append('A directory of YAML files is needed for the batch prediction.')
         return validations
 
     def _warnings(self):
@@ -308,23 +532,400 @@ class ProtBoltz(EMProtocol):
         return warnings
 
     # --------------------------- UTILS functions -----------------------------------
-    def guessEntityType(self, sequence):
-        seq = sequence.upper()
-        dnaLetters = set("ACGT")
-        rnaLetters = set("ACGU")
-        proteinLetters = set("ACDEFGHIKLMNPQRSTVWY")
-
-        seqSet = set(seq)
-
-        # check for RNA (U present, T absent)
-        if "U" in seqSet and "T" not in seqSet:
-            return "rna"
-        # check for DNA (T present, U absent)
-        elif "T" in seqSet and "U" not in seqSet and seqSet <= dnaLetters:
-            return "dna"
-        # check for protein: contains amino acid letters not in DNA/RNA
-        elif seqSet <= proteinLetters:
-            return "protein"
+    def isBatch(self):
+        return self.inputOrigin.get() == 3 or self.isScreening()
+
+    def isScreening(self):
+        return self.inputOrigin.get() in [0, 1, 2] and self.ligandScreening.get()
+
+    def getAffinityTableFile(self):
+        return self._getPath('affinity.tsv')
+
+    def getBatchInputsDir(self):
+        return self._getPath('inputs')
+
+    def createShards(self, nDevices, yamlFiles):
+        """Splits the batch YAMLs in shard directories, several per device so idle devices can take the pending ones.
+        Each shard is predicted by a single boltz run"""
+        inputsDir = os.path.abspath(self.getBatchInputsDir())
+        # A shard is run with the plan of its largest target, so targets with different planned settings
+        # (part of their cache key) go in different shards
+        planGroups = {}
+        for yamlFile in yamlFiles:
+            planGroups.setdefault(json.dumps(self.getPlanSettings(yamlFile), sort_keys=True), []).append(yamlFile)
+        planGroups = list(planGroups.values())
+        if not yamlFiles:
+            return []
+        elif nDevices == 1 and len(planGroups) == 1 and len(yamlFiles) == len(os.listdir(inputsDir)):
+            return [inputsDir]
+
+        shardsDir = os.path.abspath(self._getExtraPath('shards'))
+        shutil.rmtree(shardsDir, ignore_errors=True)
+        jobs, nShards = [], SHARDS_PER_DEVICE * nDevices if nDevices > 1 else 1
+        for yamlGroup in planGroups:
+            for shard in splitInShards(yamlGroup, nShards, cost=os.path.getsize):
+                shardDir = os.path.join(shardsDir, f'shard_{len(jobs)}')
+                os.makedirs(shardDir)
+                for yamlFile in shard:
+                    os.symlink(yamlFile, os.path.join(shardDir, os.path.basename(yamlFile)))
+                jobs.append(shardDir)
+        return jobs
+
+    def getJsonYamlPairs(self):
+        """Returns the (json, yaml) input pairs to convert. Inputs already in YAML have no json"""
+        if not self.isBatch():
+            return [(os.path.abspath(self._getPath("input.json")), os.path.abspath(self._getPath("input.yaml")))]
+
+        pairs, jsonDir = [], self._getExtraPath('batchJson')
+        for name in sorted(os.listdir(jsonDir)):
+            if name.endswith('.json'):
+                jobName = os.path.splitext(name)[0]
+                pairs.append((os.path.abspath(os.path.join(jsonDir, name)),
+                              os.path.abspath(os.path.join(self.getBatchInputsDir(), f"{jobName}.yaml"))))
+        return pairs
+
+    def getBatchComplexes(self):
+        """Yields the (complexName, [(entityType, sequence)]) of the SetOfSequences or multi-complex fasta input.
+        The fasta is streamed, one complex at a time"""
+        if self.batchOrigin.get() == 0:
+            complexes = {}
+            for seq in self.inputSequences.get():
+                name = seq.getSeqName() or seq.getId()
+                complexes.setdefault(name, []).append((guessEntityType(seq.getSequence()), seq.getSequence()))
+            yield from complexes.items()
         else:
-            return "protein"
+            yield from iterFastaComplexes(self.batchFile.get())
+
+    def getPredictionFolders(self):
+        """Returns the (jobName, folder) of every boltz_results_*/predictions/<jobName> in the protocol"""
+        predFolders = []
+        protPath = os.path.abspath(self._getPath())
+        for resultsDir in sorted(os.listdir(protPath)):
+            predictionsPath = os.path.join(protPath, resultsDir, "predictions")
+            if not resultsDir.startswith("boltz_results_") or not os.path.isdir(predictionsPath):
+                continue
+            for jobName in sorted(os.listdir(predictionsPath)):
+                if os.path.isdir(os.path.join(predictionsPath, jobName)):
+                    predFolders.append((jobName, os.path.join(predictionsPath, jobName)))
+        return predFolders
+
+    def getPredictionFolder(self, jobName):
+        """Returns the boltz_results_*/predictions/<jobName> folder of the job (None if not predicted)"""
+        predFolders = glob.glob(os.path.join(os.path.abspath(self._getPath()), "boltz_results_*", "predictions",
+                                             glob.escape(jobName)))
+        return sorted(predFolders)[0] if predFolders else None
+
+    def getCompletedFolders(self):
+        """Returns the (jobName, folder) of the valid prediction of every completed target"""
+        completed, done = {}, self.getMarkers().getDone()
+        for jobName, predFolder in self.getPredictionFolders():
+            if jobName in done and jobName not in completed and isValidBoltzPrediction(predFolder):
+                completed[jobName] = predFolder
+        return list(completed.items())
+
+    def markCompletedTargets(self):
+        markers = self.getMarkers()
+        for jobName, predFolder in self.getPredictionFolders():
+            if not markers.isDone(jobName) and isValidBoltzPrediction(predFolder):
+                markers.markDone(jobName)
+
+    def getPendingTargets(self, inputsDir):
+        """Returns the YAML inputs in inputsDir with no valid prediction. Invalid partial predictions are
+        removed, so boltz does not skip them as already predicted"""
+        self.markCompletedTargets()
+        done = self.getMarkers().getDone()
+        pending = [os.path.abspath(os.path.join(inputsDir, name)) for name in sorted(os.listdir(inputsDir))
+                   if os.path.splitext(name)[1].lower() in ('.yaml', '.yml') and os.path.splitext(name)[0] not in done]
+
+        pendingNames = {os.path.splitext(os.path.basename(yamlFile))[0] for yamlFile in pending}
+        for jobName, predFolder in self.getPredictionFolders():
+            if jobName in pendingNames:
+                shutil.rmtree(predFolder, ignore_errors=True)
+        return pending
+
+    def writeYaml(self, jsonPath, yamlPath):
+        try:
+            with open(jsonPath) as f:
+                data = json.load(f)
+            writeBoltzYaml(buildBoltzDocument(data["sequences"], data.get("properties")), yamlPath)
+        except Exception as e:
+            # Fallback to the PyYAML dump in the boltz environment
+            print(f"In-process YAML writing failed for {jsonPath} ({e}), using buildYaml.py")
+            scriptPath = os.path.join(os.path.dirname(__file__), "..", "scripts", "buildYaml.py")
+            Plugin.runCondaCommand(
+                self,
+                program="python",
+                args=f"{scriptPath} {jsonPath} {yamlPath}",
+                condaDic=BOLTZ_DIC
+            )
 
+    def getFreeChainId(self, sequences):
+        usedIds = set()
+        for item in sequences:
+            ids = next(iter(item.values()))["id"]
+            usedIds.update(ids if isinstance(ids, list) else [ids])
+        return next(chainId for chainId in iterChainIds() if chainId not in usedIds)
+
+    def planJob(self, device, inputPath):
+        """Launch plan for the largest target of the input (YAML file or directory)"""
+        if os.path.isdir(inputPath):
+            yamlFiles = [os.path.join(inputPath, name) for name in os.listdir(inputPath)]
+        else:
+            yamlFiles = [inputPath]
+        tokens = max(self.getTargetTokens(yamlFile) for yamlFile in yamlFiles)
+
+        plan = self.getPlan(tokens, useGpu=device != CPU_DEVICE)
+        if not plan['fits']:
+            print(f"Warning: {inputPath} ({tokens} tokens) is estimated to need "
+                  f"{plan['estimated_gpu_memory']:.0f} GB, more than available in device {device}")
+
+        plansDir = self._getExtraPath('plans')
+        os.makedirs(plansDir, exist_ok=True)
+        with open(os.path.join(plansDir, f"{os.path.basename(inputPath)}.json"), 'w') as f:
+            json.dump({'input': inputPath, 'device': device, **plan}, f, indent=2)
+        return plan
+
+    def getPlan(self, tokens, useGpu=True):
+        """Launch plan for a target of that size. Planned for the smallest device of the protocol, so the plan
+        of a target (part of its cache key) does not depend on the device it is run on"""
+        if useGpu and not hasattr(self, 'planGpuMemory'):
+            self.planGpuMemory = getGpuMemory(self.getDevices())
+        return planBoltzLaunch(tokens, self.diffusionSamples.get(), threads=self.numberOfThreads.get(),
+                               gpuMemory=self.planGpuMemory if useGpu else None, useGpu=useGpu)
+
+    def getPlanSettings(self, yamlFile):
+        """Planned settings that change the prediction of the target (not only its speed)"""
+        if not self.autoPlan.get():
+            return None
+        plan = self.getPlan(self.getTargetTokens(yamlFile), useGpu=self.getDevices()[0] != CPU_DEVICE)
+        return {key: plan[key] for key in ('accelerator', 'num_subsampled_msa')}
+
+    def getTargetJson(self, yamlFile):
+        jobName = os.path.splitext(os.path.basename(yamlFile))[0]
+        return self._getExtraPath('batchJson', f"{jobName}.json") if self.isBatch() else self._getPath("input.json")
+
+    def getTargetTokens(self, yamlFile):
+        jsonPath = self.getTargetJson(yamlFile)
+        if os.path.exists(jsonPath):
+            with open(jsonPath) as f:
+                return countTokens(json.load(f)["sequences"])
+        return countYamlTokens(yamlFile)
+
+    def getPlanSummary(self):
+        """Summary of the launch plan of the largest job"""
+        plansDir, plans = self._getExtraPath('plans'), []
+        if os.path.exists(plansDir):
+            for name in os.listdir(plansDir):
+                with open(os.path.join(plansDir, name)) as f:
+                    plans.append(json.load(f))
+        if not plans:
+            return []
+
+        plan = max(plans, key=lambda p: p['tokens'])
+        return [f"Launch plan of the largest job ({os.path.basename(plan['input'])}, {plan['tokens']} tokens, "
+                f"device {plan['device']}):",
+                f"  {' '.join(getPlanArgs(plan))}",
+                f"  Estimated peak memory: GPU {plan['estimated_gpu_memory']:.1f} GB, "
+                f"host {plan['estimated_host_memory']:.1f} GB"]
+
+    def getTargetKey(self, yamlFile):
+        """Cache key of a target: hash of its entities (with the MSAs by content), the prediction parameters,
+        the seed and the boltz version"""
+        jsonPath = self.getTargetJson(yamlFile)
+        if os.path.exists(jsonPath):
+            with open(jsonPath) as f:
+                target = json.load(f)
+            for item in target["sequences"]:
+                body = next(iter(item.values()))
+                if body.get("msa") and os.path.exists(body["msa"]):
+                    body["msa"] = hashFile(body["msa"])
+        else:
+            target = hashFile(yamlFile)
+
+        return hashObject({
+            'engine': BOLTZ_DIC['name'], 'version': BOLTZ_DIC['version'], 'target': target,
+            'params': {name: getattr(self, name).get() for name in
+                       ['infPot', 'recyclingSteps', 'samplingSteps', 'diffusionSamples', 'stepScale', 'seed',
+                        'affinityMWcorr', 'diffusionSamplesAff', 'writeFullPae']},
+            'plan': self.getPlanSettings(yamlFile)
+        })
+
+    def getCachedFolder(self, jobName):
+        return os.path.abspath(self._getPath("boltz_results_cache", "predictions", jobName))
+
+    def fetchCachedPrediction(self, cache, key, yamlFile):
+        """Links the cached prediction of the target into the protocol. Returns False on a miss"""
+        jobName = os.path.splitext(os.path.basename(yamlFile))[0]
+        if not cache.fetchDir(key, self.getCachedFolder(jobName),
+                              rename=lambda fileName: renameBoltzFile(fileName, CACHE_TARGET, jobName)):
+            return False
+        # Marked here, its duplicates are linked before the markers are refreshed
+        if isValidBoltzPrediction(self.getCachedFolder(jobName)):
+            self.getMarkers().markDone(jobName)
+        return True
+
+    def storeCachedPrediction(self, cache, key, yamlFile):
+        jobName = os.path.splitext(os.path.basename(yamlFile))[0]
+        predFolder = self.getPredictionFolder(jobName)
+        if predFolder and self.getMarkers().isDone(jobName):
+            cache.storeDir(key, predFolder, rename=lambda fileName: renameBoltzFile(fileName, jobName, CACHE_TARGET))
+
+    def linkDuplicatedTarget(self, srcYaml, yamlFile):
+        """Links the prediction of srcYaml as the prediction of the identical target yamlFile"""
+        srcJob, jobName = [os.path.splitext(os.path.basename(path))[0] for path in (srcYaml, yamlFile)]
+        predFolder, markers = self.getPredictionFolder(srcJob), self.getMarkers()
+        if predFolder and not markers.isDone(srcJob) and isValidBoltzPrediction(predFolder):
+            markers.markDone(srcJob)
+        if not predFolder or not markers.isDone(srcJob):
+            print(f"Warning: {jobName} not linked, the identical target {srcJob} has no valid prediction", flush=True)
+            return
+
+        dstFolder = self.getCachedFolder(jobName)
+        shutil.rmtree(dstFolder, ignore_errors=True)
+        os.makedirs(dstFolder)
+        for fileName in os.listdir(predFolder):
+            linkOrCopy(os.path.join(predFolder, fileName),
+                       os.path.join(dstFolder, renameBoltzFile(fileName, srcJob, jobName)))
+
+    def getLigandSmiles(self):
+        """Returns the [(smiles, name)] of the screening library"""
+        if self.ligandOrigin.get() == 1:
+            smiFile = self.ligandsFile.get()
+        else:
+            smiFile = self.convertMolsToSmiles()
+
+        ligands = []
+        with open(smiFile) as f:
+            for i, line in enumerate(f):
+                fields = line.split()
+                if fields and not fields[0].startswith('#'):
+                    ligands.append((fields[0], fields[1] if len(fields) > 1 else f'ligand_{i + 1}'))
+        return ligands
+
+    def convertMolsToSmiles(self):
+        """Converts all the molecules of the input set to SMILES with a single RDKit run in the boltz env"""
+        molList, smiFile = self._getExtraPath('ligands.tsv'), self._getExtraPath('ligands.smi')
+        with open(molList, 'w') as f:
+            for mol in self.inputSmallMols.get():
+                molFile = os.path.abspath(mol.getFileName())
+                f.write(f"{molFile}\t{os.path.splitext(os.path.basename(molFile))[0]}\n")
+
+        scriptPath = os.path.join(os.path.dirname(__file__), "..", "scripts", "molsToSmiles.py")
+        Plugin.runCondaCommand(
+            self,
+            program="python",
+            args=f"{scriptPath} {os.path.abspath(molList)} {os.path.abspath(smiFile)}",
+            condaDic=BOLTZ_DIC
+        )
+        return smiFile
+
+    def getJobLigandSmiles(self, jobName):
+        jsonPath = self._getExtraPath('batchJson', f"{jobName}.json")
+        if os.path.exists(jsonPath):
+            with open(jsonPath) as f:
+                for item in json.load(f)["sequences"]:
+                    if "ligand" in item and item["ligand"].get("smiles"):
+                        return item["ligand"]["smiles"]
+
+    def getReceptorMissingMsas(self):
+        """Returns the [(entityIdx, sequence)] of the receptor proteins with no MSA"""
+        with open(self._getPath("input.json")) as f:
+            receptor = json.load(f)["sequences"]
+        return [(idx, item["protein"]["sequence"]) for idx, item in enumerate(receptor)
+                if "protein" in item and not item["protein"].get("msa")]
+
+    def createSeedJob(self):
+        """Moves the first screening target to its own input directory"""
+        inputsDir, seedDir = self.getBatchInputsDir(), os.path.abspath(self._getExtraPath('seed'))
+        os.makedirs(seedDir, exist_ok=True)
+        if not os.listdir(seedDir):
+            shutil.move(os.path.join(inputsDir, sorted(os.listdir(inputsDir))[0]), seedDir)
+        return seedDir
+
+    def shareReceptorMsas(self):
+        """Sets the receptor MSAs generated in the seed job in the inputs of the rest of the screening targets"""
+        seedJob = os.path.splitext(os.listdir(self._getExtraPath('seed'))[0])[0]
+        protPath, msaFiles = os.path.abspath(self._getPath()), {}
+        for entityIdx, sequence in self.getReceptorMissingMsas():
+            seedMsas = glob.glob(os.path.join(protPath, "boltz_results_seed", "msa", f"{seedJob}_{entityIdx}.csv"))
+            if seedMsas:
+                key = hashSequence(sequence)
+                msaFile = os.path.abspath(self._getExtraPath('msas', f'{key}.csv'))
+                self.writeUnpairedMsa(seedMsas[0], msaFile)
+                if self.useMsaCache.get():
+                    self.getMsaCache().store(key, '.csv', msaFile)
+                msaFiles[sequence] = msaFile
+
+        for jsonPath, yamlPath in self.getJsonYamlPairs():
+            if not os.path.exists(yamlPath):
+                continue
+            with open(jsonPath) as f:
+                data = json.load(f)
+            for item in data["sequences"]:
+                body = item.get("protein")
+                if body and not body.get("msa") and body["sequence"] in msaFiles:
+                    body["msa"] = msaFiles[body["sequence"]]
+            with open(jsonPath, "w") as f:
+                json.dump(data, f, indent=2)
+            self.writeYaml(jsonPath, yamlPath)
+
+    def createAtomStruct(self, cifFile, jobName, scores):
+        atomStruct = AtomStruct(filename=cifFile)
+        atomStruct.jobName = String()
+        atomStruct.setAttributeValue('jobName', jobName)
+        for scoreKey, attrName in {**BOLTZ_SCORES, **BOLTZ_AFFINITY_SCORES, **CONFIDENCE_ATTRIBUTES}.items():
+            if scores.get(scoreKey) is not None:
+                setattr(atomStruct, attrName, Float())
+                atomStruct.setAttributeValue(attrName, scores[scoreKey])
+        return atomStruct
+
+    def buildEntities(self, entities):
+        """Boltz entities of the (entityType, sequence) pairs, ligands given as SMILES"""
+        return buildBoltzEntities(entities, cyclic=self.cyclic.get())
+
+    def writeInputJson(self, entities, jsonPath):
+        merged = mergeEntities(entities)
+
+        if self.useMsaCache.get():
+            for e in merged:
+                if e.entity_type == "protein" and not e.msa:
+                    e.msa = self.fetchCachedMsa(e.sequence)
+
+        with open(jsonPath, "w") as f:
+            json.dump({"sequences": [e.toDict() for e in merged]}, f, indent=2)
+
+    def fetchCachedMsa(self, sequence):
+        """Copies the cached MSA of the sequence into the protocol and returns its path, or None on a miss"""
+        key = hashSequence(sequence)
+        msaFile = os.path.abspath(self._getExtraPath('msas', f'{key}.csv'))
+        if os.path.exists(msaFile) or self.getMsaCache().fetch(key, '.csv', msaFile):
+            return msaFile
+
+    def storeMsas(self):
+        """Stores in the MSA cache the MSAs boltz generated for the protein sequences that were not cached"""
+        msaCache, protPath = self.getMsaCache(), os.path.abspath(self._getPath())
+        for jsonPath, yamlPath in self.getJsonYamlPairs():
+            if jsonPath is None or not os.path.exists(jsonPath):
+                continue
+            with open(jsonPath) as f:
+                sequences = json.load(f)["sequences"]
+
+            targetId = os.path.splitext(os.path.basename(yamlPath))[0]
+            for entityIdx, item in enumerate(sequences):
+                body = item.get("protein")
+                if not body or body.get("msa"):
+                    continue
+                msaFiles = glob.glob(os.path.join(protPath, "boltz_results_*", "msa", f"{targetId}_{entityIdx}.csv"))
+                key = hashSequence(body["sequence"])
+                if msaFiles and not msaCache.contains(key, '.csv'):
+                    unpairedFile = self._getExtraPath('msas', f'{key}.csv')
+                    self.writeUnpairedMsa(msaFiles[0], unpairedFile)
+                    msaCache.store(key, '.csv', unpairedFile)
+
+    def writeUnpairedMsa(self, msaFile, outFile):
+        """Rewrites a boltz csv MSA with no pairing keys, so it can be reused in any complex"""
+        os.makedirs(os.path.dirname(outFile), exist_ok=True)
+        with open(msaFile) as fIn, open(outFile, 'w') as fOut:
+            fOut.write(fIn.readline())
+            for line in fIn:
+                fOut.write('-1,' + line.split(',', 1)[1])
@@ -23,24 +23,39 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
+import glob
 import json
 
 import os
-import re
+import shutil
 import pyworkflow.protocol.params as params
 from pwem.protocols import EMProtocol
 from pwchem import Plugin
-from biofold.constants import CHAI_DIC
+from biofold.constants import CHAI_DIC, BIOFOLD_CACHE, SHARDS_PER_DEVICE, SUMMARY_TOP_TARGETS, ESM_CACHE_SIZE
+from biofold.utils.utilsCache import hashSequence, hashObject, normaliseSequence, \
+    linkOrCopy, runWithCache, getCacheSummary
+from biofold.utils.utilsConfidence import CONFIDENCE_ATTRIBUTES, getResidueConfidence, \
+    writeConfidenceTable, readConfidenceTable, getConfidenceSummaries
+from biofold.utils.utilsFasta import iterFastaRecords, iterFastaEntities, iterFastaComplexes, guessEntityType, \
+    isFastaFile, getFastaName, writeFastaRecord
+from biofold.utils.utilsScores import CHAI_SCORES, CHAI_RANK_SCORE, PLDDT_SCORE, getChaiModels
+from biofold.utils.utilsResume import isValidChaiPrediction
+from biofold.utils.utilsProtocol import PredictionMixin, getUniqueJobName
+from biofold.utils.utilsScheduler import DeviceScheduler, CPU_DEVICE, runCondaJob, getDeviceSummary, \
+    splitInShards
 
 from pwem.objects import  AtomStruct, SetOfAtomStructs
+from pyworkflow.object import String, Float
 
 
-class ProtChai(EMProtocol):
+class ProtChai(PredictionMixin, EMProtocol):
     """
     Protocol to use Chai-1 model.
     """
     _label = 'chai-1 modelling'
+    _engineDic = CHAI_DIC
     NEWFILE = False
+    CHAI_TARGET = 'input'
 
     # -------------------------- DEFINE param functions ----------------------
     def _addInputForm(self, form):
@@ -75,10 +90,21 @@ class ProtChai(EMProtocol):
         Params:
             form: this is the form to be populated with sections and params.
         """
+        form.addHidden('useGpu', params.BooleanParam, default=True,
+                       label="Use GPU for execution",
+                       help="This protocol has both CPU and GPU implementation. Choose one.")
+
+        form.addHidden('gpuList', params.StringParam, default='0',
+                       label="Choose GPU IDs",
+                       help="Comma-separated GPU devices that can be used. In batch mode, the complexes are "
+                            "distributed over all the listed GPUs.")
+
         form.addSection(label='Input')
         form.addParam('inputOrigin', params.EnumParam, default=0,
-                      label='Input origin: ', choices=['Sequence', 'AtomStruct', 'fasta file'],
-                      help='Input origin to add to the set')
+                      label='Input origin: ', choices=['Sequence', 'AtomStruct', 'fasta file', 'Batch'],
+                      help='Input origin to add to the set.\n'
+                           'Batch: predict many complexes in a single chai process per GPU, so the model '
+                           'components are only loaded once.')
         self._addInputForm(form)
 
         form.addParam('inputList', params.TextParam, width=100, condition='inputOrigin in [0,1]',
@@ -89,11 +115,41 @@ class ProtChai(EMProtocol):
                       label='Sequence file: ',
                       help='Select the fasta file.')
 
+        form.addParam('batchOrigin', params.EnumParam, default=0, condition='inputOrigin == 3',
+                      label='Batch origin: ', choices=['SetOfSequences', 'Multi-complex fasta', 'FASTA directory'],
+                      help='Origin of the complexes to predict in batch.\n'
+                           'SetOfSequences: each sequence is predicted as an independent target.\n'
+                           'Multi-complex fasta: consecutive records are grouped into complexes by the header prefix '
+                           'before the first "|" (e.g. ">cplx1|A" and ">cplx1|B" form the complex "cplx1").\n'
+                           'FASTA directory: folder with one fasta file per complex.\n'
+                           'The entity type of each chain is read from the header (e.g. ">protein|name=A") '
+                           'or guessed from its sequence.')
+        form.addParam('inputSequences', params.PointerParam, pointerClass='SetOfSequences', allowsNull=True,
+                      condition='inputOrigin == 3 and batchOrigin == 0',
+                      label='Input sequences: ', help='Set of sequences to predict, one target per sequence.')
+        form.addParam('batchFile', params.FileParam, condition='inputOrigin == 3 and batchOrigin == 1',
+                      label='Multi-complex fasta: ',
+                      help='Fasta file (or .fa.gz) with the chains of all the complexes.')
+        form.addParam('batchFolder', params.PathParam, condition='inputOrigin == 3 and batchOrigin == 2',
+                      label='FASTA directory: ', help='Directory with one fasta file (or .fa.gz) per complex.')
 
         form = form.addGroup('Parameters')
         form.addParam('msa', params.BooleanParam, default=True,
                       label="Run with MSAs: ",
                       help='Choose whether to run with MSAs for improved performance.')
+        form.addParam('useMsaCache', params.BooleanParam, default=True, condition='msa',
+                      expertLevel=params.LEVEL_ADVANCED, label="Use MSA cache: ",
+                      help='Reuse the MSAs of the protein sequences already searched by any biofold protocol. '
+                           'The MSA server is only queried for the protein sequences that are not cached.')
+        form.addParam('useEsmCache', params.BooleanParam, default=True, expertLevel=params.LEVEL_ADVANCED,
+                      label="Use ESM embedding cache: ",
+                      help='Reuse the ESM-2 embeddings of the protein chains already embedded by any biofold '
+                           'protocol, instead of running the language model again. Embeddings are stored as '
+                           'float16 arrays that are memory-mapped when reused.')
+        form.addParam('writeFullPae', params.BooleanParam, default=True, expertLevel=params.LEVEL_ADVANCED,
+                      label="Write full PAE and PDE: ",
+                      help='Save the predicted aligned error and distance error matrices of every model '
+                           '(pae.model_idx_*.npy and pde.model_idx_*.npy), shown by the PAE viewer.')
         form.addParam('trunkRecycles', params.IntParam, default=3, expertLevel=params.LEVEL_ADVANCED,
                         label='Recycling steps: ', help="Number of recycling steps for prediction.")
         form.addParam('timeSteps', params.IntParam, default=200,
@@ -102,14 +158,26 @@ class ProtChai(EMProtocol):
                         label='Trunk samples: ', help="Number of trunk samples for prediction.")
         form.addParam('diffNsamples', params.IntParam, default=5, expertLevel=params.LEVEL_ADVANCED,
                        label='Difussion samples for affinity: ', help="Number of diffusion samples for affinity.")
+        form.addParam('seed', params.IntParam, default=42, expertLevel=params.LEVEL_ADVANCED,
+                      label='Random seed: ', help="Seed of the prediction, so it is reproducible.")
+        form.addParam('useResultCache', params.BooleanParam, default=True, expertLevel=params.LEVEL_ADVANCED,
+                      label="Use prediction cache: ",
+                      help='Reuse the prediction of an identical input (same entities, parameters, seed and chai '
+                           'version) already computed by any biofold protocol, without running chai. If another '
+                           'protocol is predicting the same input, this one waits for its result.\n'
+                           'Set to No to force the prediction.')
 
     # --------------------------- STEPS functions ------------------------------
     def _insertAllSteps(self):
-        if (self.inputOrigin.get() != 2):
-            self._insertFunctionStep(self.createInputFileStep)
+        if self.isBatch():
+            self._insertFunctionStep(self.createBatchInputStep)
+            self._insertFunctionStep(self.runChaiBatchStep)
         else:
-            self._insertFunctionStep(self.ensureFastaHasNames)
-        self._insertFunctionStep(self.runChaiStep)
+            if (self.inputOrigin.get() != 2):
+                self._insertFunctionStep(self.createInputFileStep)
+            else:
+                self._insertFunctionStep(self.ensureFastaHasNames)
+            self._insertFunctionStep(self.runChaiStep)
         self._insertFunctionStep(self.extractScoreStep)
         self._insertFunctionStep(self.createOutputStep)
 
@@ -139,137 +207,191 @@ class ProtChai(EMProtocol):
                 seqFile = inpDict.get("seqFile")
                 entity = inpDict.get("entity", "protein").lower()
 
-                sequence = ""
-                with open(seqFile) as sf:
-                    for l in sf:
-                        if l.startswith(">"):
-                            continue
-                        sequence += l.strip()
+                _, sequence = next(iterFastaRecords(seqFile))
 
                 uniqueName = f"{base_name}_{counter}"
                 counter += 1
                 f.write(f">{entity}|name={uniqueName}\n")
                 f.write(f"{sequence}\n")
 
+    def createBatchInputStep(self):
+        """Write one chai fasta file per complex into the batch inputs directory"""
+        inputsDir = self.getBatchInputsDir()
+        os.makedirs(inputsDir, exist_ok=True)
+
+        usedNames = set()
+        for complexName, entities in self.getBatchComplexes():
+            jobName = getUniqueJobName(complexName, usedNames)
+            with open(os.path.join(inputsDir, f"{jobName}.fasta"), 'w') as f:
+                for i, (entity, sequence) in enumerate(entities):
+                    f.write(f">{entity}|name={jobName}_{i + 1}\n{sequence}\n")
+
+        if not usedNames:
+            raise Exception("No complexes found in the batch input.")
+
     def runChaiStep(self):
-        if (self.inputOrigin.get() == 2 and not self.NEWFILE):
+        # input.fasta is also checked on disk, NEWFILE is lost when a protocol is resumed in a new process
+        if (self.inputOrigin.get() == 2 and not self.NEWFILE and not os.path.exists(self._getPath('input.fasta'))):
             filePath = os.path.abspath(self.file.get())
         else:
             filePath = os.path.abspath(self._getPath('input.fasta'))
-        args = [str(filePath)]
-
-        args.append(os.path.join(os.path.abspath(self._getPath()), "chai_results"))
-
-        if self.msa.get():
-            args.append("--use-msa-server")
 
-        args.append(f" --num-trunk-recycles {self.trunkRecycles.get()}")
-        args.append(f" --num-diffn-timesteps {self.timeSteps.get()}")
-        args.append(f" --num-trunk-samples {self.trunkSamples.get()}")
-        args.append(f" --num-diffn-samples {self.diffNsamples.get()}")
-
-        Plugin.runCondaCommand(
-            self,
-            args=" ".join(args),
-            condaDic=CHAI_DIC,
-            program="chai-lab fold",
-            cwd=os.path.abspath(Plugin.getVar(CHAI_DIC['home']))
+        # A resumed run does not repeat a valid prediction. chai-lab needs an empty output folder otherwise
+        self.markCompletedTargets()
+        if self.getMarkers().isDone(self.CHAI_TARGET):
+            return
+        shutil.rmtree(self.getTargetJob(filePath)[1], ignore_errors=True)
+
+        # Run as a single target batch, so it also uses the ESM embedding cache
+        scheduler = DeviceScheduler(self.getDevices()[:1])
+        errors = self.predictWithCache(scheduler, [filePath])
+        scheduler.writeStats(self.getDeviceStatsFile())
+        if self.msa.get() and self.useMsaCache.get():
+            self.storeMsas()
+
+        if errors:
+            raise errors[0][1]
+
+    def runChaiBatchStep(self):
+        devices = self.getDevices()
+        scheduler = DeviceScheduler(devices)
+
+        # Only the targets with no valid output are (re)submitted, so a failed or preempted run can be resumed
+        errors = self.predictWithCache(scheduler, self.getPendingTargets())
+        self.markCompletedTargets()
+        scheduler.writeStats(self.getDeviceStatsFile())
+        if self.msa.get() and self.useMsaCache.get():
+            self.storeMsas()
+
+        if errors:
+            if self.getMarkers().getDone():
+                # Keep the completed targets registered, the protocol can be resumed to predict the rest
+                self.extractScoreStep()
+                self.createOutputStep()
+            raise Exception("Chai prediction failed for: " + ", ".join(os.path.basename(job) for job, _ in errors))
+
+    def predictWithCache(self, scheduler, fastaFiles):
+        """Predicts the targets, reusing the predictions of the prediction cache if it is used.
+        Waits for the result if another protocol is predicting the same input.
+        Returns the list of (job, exception) that failed"""
+        if not self.useResultCache.get():
+            return self.predictTargets(scheduler, fastaFiles)
+
+        cache = self.getResultCache()
+        errors, counts = runWithCache(
+            cache, fastaFiles, self.getTargetKey,
+            fetch=lambda key, fastaFile: self.fetchCachedPrediction(cache, key, fastaFile),
+            predict=lambda targets: self.predictTargets(scheduler, targets),
+            store=lambda key, fastaFile: self.storeCachedPrediction(cache, key, fastaFile),
+            link=self.linkDuplicatedTarget
         )
+        print(getCacheSummary(counts), flush=True)
+        return errors
+
+    def predictTargets(self, scheduler, fastaFiles):
+        """Runs the targets in shards, each one predicted in a single chai process.
+        Returns the list of (job, exception) that failed"""
+        errors = scheduler.run(self.createShards(len(scheduler.devices), fastaFiles), self.runChaiBatchJob)
+        self.markCompletedTargets()
+        return errors
+
+    def runChaiBatchJob(self, device, shardFile):
+        scriptPath = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "scripts", "chaiBatch.py"))
+        # Shared lock on the weights while predicting, they are downloaded first if missing
+        with self.getWeightsCache().use(self.prefetchWeights, offline=self.isOffline()):
+            # The device is restricted through CUDA_VISIBLE_DEVICES, so it is always the first visible one
+            runCondaJob(
+                Plugin.getEnvActivationCommand(CHAI_DIC),
+                program=f"python {scriptPath}",
+                args=f"{shardFile} {'cpu' if device == CPU_DEVICE else 'cuda:0'}",
+                device=device,
+                cwd=os.path.abspath(Plugin.getVar(CHAI_DIC['home'])),
+                logFile=os.path.abspath(self._getPath('logs', f'chai_{device}.log')),
+                env=self.getJobEnviron()
+            )
 
     def extractScoreStep(self):
-        """Extract per-residue score and compute mean score per model"""
-        resultsPath = os.path.join(os.path.abspath(self._getPath()), "chai_results")
-        self.meanScore = {}
-
-        extraFiles = self.getExtraFiles()
-
-        for cifName in extraFiles:
-            cifPath = os.path.join(resultsPath, cifName)
-            modelName = os.path.splitext(cifName)[0]
-
-            headers = []
-            scoreValues = []
-            seenResidues = set()
-
-            with open(cifPath) as f:
-                for line in f:
-                    if line.startswith('_atom_site.'):
-                        headers.append(line.strip())
-                    elif line.startswith('ATOM'):
-                        break
-
-            colIndex = {h.split('.')[-1]: i for i, h in enumerate(headers)}
-
-            if 'B_iso_or_equiv' not in colIndex:
-                raise Exception(f"No score field in {cifName}")
-
-            with open(cifPath) as f:
-                for line in f:
-                    if not line.startswith('ATOM'):
-                        continue
-                    cols = re.sub(r'\s+', ' ', line.strip()).split()
-                    resnum = int(cols[colIndex['auth_seq_id']])
-                    score = float(cols[colIndex['B_iso_or_equiv']])
-                    if resnum not in seenResidues:
-                        seenResidues.add(resnum)
-                        scoreValues.append(score)
-
-            self.meanScore[modelName] = sum(scoreValues) / len(scoreValues)
-
-        self.bestModel = max(self.meanScore, key=self.meanScore.get)
+        """Read the chai scores of every model and store them ranked by aggregate score, and write the per-residue
+        confidence of all the models in the confidence table"""
+        if not self.isBatch():
+            self.getExtraFiles()
+
+        store, rankKeys, confidences = self.getScoreStore(), {}, []
+        for jobName, resultsPath in self.getResultsDirs():
+            models = getChaiModels(resultsPath)
+            jobConfidences = [(cifFile, getResidueConfidence(cifFile)) for cifFile, _ in models]
+            rankKeys[jobName] = CHAI_RANK_SCORE
+            if all(scores.get(CHAI_RANK_SCORE) is None for _, scores in models):
+                # No score files, ranked by the mean pLDDT of the models
+                models = [(cifFile, {PLDDT_SCORE: confidence['mean']}) for cifFile, confidence in jobConfidences]
+                rankKeys[jobName] = PLDDT_SCORE
+            store.setModels(models, rankKeys[jobName], job=jobName)
+            confidences += jobConfidences
+        store.setInfo('rankScores', rankKeys)
+        writeConfidenceTable(confidences, self.getConfidenceTableFile())
 
     def createOutputStep(self):
-        resultsPath = os.path.join((self._getPath()), "chai_results")
-        extraFiles = self.getExtraFiles()
+        store = self.getScoreStore()
+        confidence = getConfidenceSummaries(readConfidenceTable(self.getConfidenceTableFile()))
         outputSet = SetOfAtomStructs.create(self._getPath())
-        for cifName in extraFiles:
-            atomStruct = AtomStruct(filename=os.path.join(resultsPath, cifName))
-            outputSet.append(atomStruct)
-
-        bestSrc = os.path.join(resultsPath, self.bestModel + '.cif')
-        bestStruct = AtomStruct(filename=bestSrc)
+        for cifFile, jobName, scores in store.getModels():
+            outputSet.append(self.createAtomStruct(cifFile, jobName, {**scores, **confidence.get(cifFile, {})}))
+
+        if not len(outputSet):
+            raise Exception(f"No predicted structures found in {self._getPath('chai_results')}")
+
+        if self.isBatch():
+            bestSet = SetOfAtomStructs.create(self._getPath(), suffix='Best')
+            for cifFile, jobName, scores in store.getBestModels():
+                bestSet.append(self.createAtomStruct(cifFile, jobName, {**scores, **confidence.get(cifFile, {})}))
+            self._defineOutputs(
+                outputSetOfAtomStructs=outputSet,
+                outputBestAtomStructs=bestSet
+            )
+        else:
+            bestFile, jobName, bestScores = store.getBestModel()
+            bestStruct = self.createAtomStruct(bestFile, jobName, {**bestScores, **confidence.get(bestFile, {})})
 
-        self._defineOutputs(
-            outputBestAtomStruct=bestStruct,
-            outputSetOfAtomStructs=outputSet
-        )
+            self._defineOutputs(
+                outputBestAtomStruct=bestStruct,
+                outputSetOfAtomStructs=outputSet
+            )
 
     # --------------------------- INFO functions -----------------------------------
     def _summary(self):
-        summary = []
-
-        resultsPath = os.path.join(os.path.abspath(self._getPath()), "chai_results")
-
-        try:
-            extraFiles = self.getExtraFiles()
-        except Exception as e:
-            summary.append(f"No CIF files found in {resultsPath}: {e}")
+        summary, store = [], self.getScoreStore()
+        # Score each job was ranked by
+        rankKeys = store.getInfo('rankScores', {})
+        if self.isBatch():
+            # Jobs ranked by aggregate score first, then the ones with no score files (ranked by pLDDT)
+            topModels = store.getTopJobModels(SUMMARY_TOP_TARGETS, firstScored=CHAI_RANK_SCORE)
+            if topModels:
+                summary.append(f"{store.countJobs()} targets predicted ({store.countModels()} models). Top targets:")
+                for cifFile, jobName, scores in topModels:
+                    rankKey = rankKeys.get(jobName, CHAI_RANK_SCORE)
+                    rankValue = f"{scores[rankKey]:.3f}" if scores.get(rankKey) is not None else "-"
+                    summary.append(f"  {jobName}: {os.path.basename(cifFile)} "
+                                   f"({CHAI_SCORES.get(rankKey, rankKey)}={rankValue})")
+            summary += self.getEsmSummary()
+            summary += getDeviceSummary(self.getDeviceStatsFile())
             return summary
 
-        if not extraFiles:
-            summary.append(f"No CIF files found in {resultsPath}.")
+        models = store.getModels()
+        if not models:
+            summary.append(f"No scored models yet in {self._getPath('chai_results')}.")
             return summary
 
-        scores = {}
-        logFile = os.path.join(self._getPath('logs'), "run.stdout")
-        if os.path.exists(logFile):
-            with open(logFile) as f:
-                for line in f:
-                    m = re.search(r"Score=([\d.]+), writing output to (.+\.cif)", line)
-                    if m:
-                        score = float(m.group(1))
-                        cifPath = m.group(2)
-                        modelName = os.path.splitext(os.path.basename(cifPath))[0]
-                        scores[modelName] = score
-
         summary.append("Scores per model:")
-        for modelName in sorted(scores.keys()):
-            summary.append(f"  {modelName}: {scores[modelName]}")
-
-        if scores:
-            bestModel = max(scores, key=scores.get)
-            summary.append(f"\nBest structure (highest score): {bestModel}.cif")
-
+        for cifFile, _, scores in models:
+            summary.append(f"  {os.path.basename(cifFile)}: " +
+                           ", ".join(f"{CHAI_SCORES.get(key, key)}={value:.3f}" for key, value in scores.items()
+                                     if value is not None))
+        rankKey = rankKeys.get(models[0][1], CHAI_RANK_SCORE)
+        summary.append(f"\nBest structure (highest {CHAI_SCORES.get(rankKey, rankKey)}): "
+                       f"{os.path.basename(models[0][0])}")
+
+        summary += self.getEsmSummary()
+        summary += getDeviceSummary(self.getDeviceStatsFile())
         return summary
 
     def _methods(self):
@@ -278,6 +400,13 @@ class ProtChai(EMProtocol):
 
     def _validate(self):
         validations = []
+        if self.isBatch():
+            if self.batchOrigin.get() == 0 and not self.inputSequences.get():
+                validations.append('A SetOfSequences is needed for the batch prediction.')
+            elif self.batchOrigin.get() == 1 and not self.batchFile.get():
+                validations.append('A multi-complex fasta file is needed for the batch prediction.')
+            elif self.batchOrigin.get() == 2 and not self.batchFolder.get():
+                validations.append('A directory of fasta files is needed for the batch prediction.')
         return validations
 
     def _warnings(self):
@@ -285,6 +414,213 @@ class ProtChai(EMProtocol):
         return warnings
 
     # --------------------------- UTILS functions -----------------------------------
+    def isBatch(self):
+        return self.inputOrigin.get() == 3
+
+    def getBatchInputsDir(self):
+        return self._getPath('inputs')
+
+    def getTargetResultsDir(self, fastaFile):
+        return os.path.abspath(self._getPath("chai_results", os.path.splitext(os.path.basename(fastaFile))[0]))
+
+    def getTargetJob(self, fastaFile):
+        """Returns the (jobName, results folder) the target fastaFile is predicted as"""
+        if not self.isBatch():
+            return self.CHAI_TARGET, os.path.join(os.path.abspath(self._getPath()), "chai_results")
+        return os.path.splitext(os.path.basename(fastaFile))[0], self.getTargetResultsDir(fastaFile)
+
+    def getResultsDirs(self):
+        """Returns the (jobName, results folder) of every completed target"""
+        if not self.isBatch():
+            return [self.getTargetJob(None)]
+        return [(jobName, self.getTargetResultsDir(jobName)) for jobName in sorted(self.getMarkers().getDone())]
+
+    def getBatchComplexes(self):
+        """Yields the (complexName, [(entityType, sequence)]) of the batch input. Fasta inputs are streamed"""
+        if self.batchOrigin.get() == 0:
+            complexes = {}
+            for seq in self.inputSequences.get():
+                name = seq.getSeqName() or seq.getId()
+                complexes.setdefault(name, []).append((guessEntityType(seq.getSequence()), seq.getSequence()))
+            yield from complexes.items()
+        elif self.batchOrigin.get() == 1:
+            yield from iterFastaComplexes(self.batchFile.get())
+        else:
+            for name in sorted(os.listdir(self.batchFolder.get())):
+                if isFastaFile(name):
+                    yield getFastaName(name), [(entityType, sequence) for _, entityType, sequence
+                                               in iterFastaEntities(os.path.join(self.batchFolder.get(), name))]
+
+    def getPendingTargets(self):
+        """Returns the fasta inputs with no valid prediction. Invalid partial predictions are removed,
+        chai-lab needs an empty output folder"""
+        self.markCompletedTargets()
+        inputsDir, done, pending = self.getBatchInputsDir(), self.getMarkers().getDone(), []
+        for name in sorted(os.listdir(inputsDir)):
+            if os.path.splitext(name)[0] not in done:
+                fastaFile = os.path.abspath(os.path.join(inputsDir, name))
+                shutil.rmtree(self.getTargetResultsDir(fastaFile), ignore_errors=True)
+                pending.append(fastaFile)
+        return pending
+
+    def markCompletedTargets(self):
+        markers = self.getMarkers()
+        fastaFiles = os.listdir(self.getBatchInputsDir()) if self.isBatch() else [None]
+        for jobName, resultsDir in map(self.getTargetJob, fastaFiles):
+            if not markers.isDone(jobName) and isValidChaiPrediction(resultsDir):
+                markers.markDone(jobName)
+
+    def createShards(self, nDevices, fastaFiles):
+        """Splits the targets in shard files, several per device so idle devices can take the pending ones.
+        Each shard is predicted by a single chai process"""
+        shardsDir = os.path.abspath(self._getExtraPath('shards'))
+        shutil.rmtree(shardsDir, ignore_errors=True)
+        os.makedirs(shardsDir)
+
+        lengths = {fastaFile: self.getTargetLength(fastaFile) for fastaFile in fastaFiles}
+        jobs, nShards = [], SHARDS_PER_DEVICE * nDevices if nDevices > 1 else 1
+        for i, shard in enumerate(splitInShards(fastaFiles, nShards, cost=lengths.get)):
+            targets = []
+            for fastaFile in shard:
+                jobName, resultsDir = self.getTargetJob(fastaFile)
+                targets.append((jobName, fastaFile, resultsDir))
+            jobs.append(self.writeShard(os.path.join(shardsDir, f'shard_{i}.json'), targets))
+        return jobs
+
+    def writeShard(self, shardFile, targets):
+        """Writes the chaiBatch.py input to predict the (name, fastaFile, outputDir) targets"""
+        shard = {'options': self.getInferenceOptions(),
+                 'targets': [{'name': name, 'fasta': fastaFile, 'outputDir': outputDir,
+                              'length': self.getTargetLength(fastaFile), **self.getMsaOptions(fastaFile)}
+                             for name, fastaFile, outputDir in targets],
+                 'saveErrorMatrices': self.writeFullPae.get()}
+        if self.useEsmCache.get():
+            shard['esmCache'] = {'root': os.path.join(Plugin.getVar(BIOFOLD_CACHE), 'esm'), 'maxSize': ESM_CACHE_SIZE,
+                                 'statsDir': os.path.abspath(self.getEsmStatsDir())}
+
+        os.makedirs(os.path.dirname(shardFile), exist_ok=True)
+        with open(shardFile, 'w') as f:
+            json.dump(shard, f, indent=2)
+        return shardFile
+
+    def getTargetLength(self, fastaFile):
+        return sum(len(sequence) for _, sequence in self.getFastaEntities(fastaFile))
+
+    def getEsmStatsDir(self):
+        return self._getExtraPath('esm_stats')
+
+    def getEsmSummary(self):
+        """Hit/miss counters of the ESM embedding cache over all the chai runs of the protocol"""
+        statsDir, hits, misses = self.getEsmStatsDir(), 0, 0
+        if not os.path.exists(statsDir):
+            return []
+        for name in os.listdir(statsDir):
+            with open(os.path.join(statsDir, name)) as f:
+                stats = json.load(f)
+            hits, misses = hits + stats['hits'], misses + stats['misses']
+        return [f"ESM embedding cache: {hits} hits, {misses} misses"] if hits + misses else []
+
+    def getInferenceOptions(self):
+        """Options of chai-lab run_inference"""
+        return {'num_trunk_recycles': self.trunkRecycles.get(), 'num_diffn_timesteps': self.timeSteps.get(),
+                'num_trunk_samples': self.trunkSamples.get(), 'num_diffn_samples': self.diffNsamples.get(),
+                'seed': self.seed.get()}
+
+    def fetchCachedPrediction(self, cache, key, fastaFile):
+        """Links the cached prediction of the target into the protocol. Returns False on a miss"""
+        jobName, resultsDir = self.getTargetJob(fastaFile)
+        if not cache.fetchDir(key, resultsDir):
+            return False
+        # Marked here, its duplicates are linked before the markers are refreshed
+        if isValidChaiPrediction(resultsDir):
+            self.getMarkers().markDone(jobName)
+        return True
+
+    def storeCachedPrediction(self, cache, key, fastaFile):
+        jobName, resultsDir = self.getTargetJob(fastaFile)
+        if self.getMarkers().isDone(jobName):
+            cache.storeDir(key, resultsDir)
+
+    def linkDuplicatedTarget(self, srcFasta, fastaFile):
+        """Links the prediction of srcFasta as the prediction of the identical target fastaFile"""
+        srcJob, jobName = [os.path.splitext(os.path.basename(path))[0] for path in (srcFasta, fastaFile)]
+        srcDir, dstDir, markers = self.getTargetResultsDir(srcFasta), self.getTargetResultsDir(fastaFile), \
+            self.getMarkers()
+        if not markers.isDone(srcJob) and isValidChaiPrediction(srcDir):
+            markers.markDone(srcJob)
+        if not markers.isDone(srcJob):
+            print(f"Warning: {jobName} not linked, the identical target {srcJob} has no valid prediction", flush=True)
+            return
+        shutil.rmtree(dstDir, ignore_errors=True)
+        os.makedirs(dstDir)
+        for fileName in os.listdir(srcDir):
+            if os.path.isfile(os.path.join(srcDir, fileName)):
+                linkOrCopy(os.path.join(srcDir, fileName), os.path.join(dstDir, fileName))
+
+    def getJobEnviron(self):
+        """Environment of the chai jobs: weights read from the shared weights cache"""
+        return dict(super().getJobEnviron() or os.environ, CHAI_DOWNLOADS_DIR=self.getWeightsCache().root)
+
+    def getMsaOptions(self, fastaPath):
+        """Uses the cached MSAs of the protein sequences, the MSA server is only queried for the ones not cached
+        (chaiBatch.py adds their MSAs to the same folder)"""
+        if not self.msa.get():
+            return {}
+
+        sequences = list(dict.fromkeys(self.getProteinSequences(fastaPath)))
+        if self.useMsaCache.get() and sequences:
+            msaCache, msaDir = self.getMsaCache(), os.path.abspath(self._getExtraPath('msas'))
+            missing = [seq for seq in sequences if not self.fetchCachedMsa(msaCache, msaDir, hashSequence(seq))]
+            return {'msaDirectory': msaDir, 'msaServerSequences': missing} if missing else {'msaDirectory': msaDir}
+
+        return {'useMsaServer': True}
+
+    def fetchCachedMsa(self, msaCache, msaDir, key):
+        """Whether the MSA of the sequence key is in msaDir, copied from the MSA cache if needed"""
+        msaFile = os.path.join(msaDir, f'{key}.aligned.pqt')
+        return os.path.exists(msaFile) or msaCache.fetch(key, '.aligned.pqt', msaFile)
+
+    def storeMsas(self):
+        """Stores in the MSA cache the MSAs generated by the MSA server (named by chai after the sequence hash),
+        written by chai in the results folders or by chaiBatch.py with the cached ones"""
+        msaCache = self.getMsaCache()
+        resultsPath = os.path.join(os.path.abspath(self._getPath()), "chai_results")
+        msaDirs = glob.glob(os.path.join(resultsPath, "msas")) + glob.glob(os.path.join(resultsPath, "*", "msas")) + \
+            glob.glob(os.path.abspath(self._getExtraPath('msas')))
+        for msaDir in msaDirs:
+            for name in os.listdir(msaDir):
+                if name.endswith('.aligned.pqt'):
+                    key = name[:-len('.aligned.pqt')]
+                    if not msaCache.contains(key, '.aligned.pqt'):
+                        msaCache.store(key, '.aligned.pqt', os.path.join(msaDir, name))
+
+    def getFastaEntities(self, fastaPath):
+        """Returns the [(entityType, sequence)] of a chai fasta (headers as >entity|name=...)"""
+        return [(header.split('|')[0].lower(), sequence) for header, sequence in iterFastaRecords(fastaPath)]
+
+    def getProteinSequences(self, fastaPath):
+        return [sequence for entity, sequence in self.getFastaEntities(fastaPath) if entity == 'protein']
+
+    def getTargetKey(self, fastaPath):
+        """Cache key of the input: hash of its entities, the prediction parameters, the seed and the chai version"""
+        return hashObject({
+            'engine': CHAI_DIC['name'], 'version': CHAI_DIC['version'],
+            'target': [[entity, normaliseSequence(sequence)] for entity, sequence in self.getFastaEntities(fastaPath)],
+            'params': {name: getattr(self, name).get() for name in
+                       ['msa', 'trunkRecycles', 'timeSteps', 'trunkSamples', 'diffNsamples', 'seed', 'writeFullPae']}
+        })
+
+    def createAtomStruct(self, cifFile, jobName, scores):
+        atomStruct = AtomStruct(filename=cifFile)
+        if self.isBatch():
+            atomStruct.jobName = String()
+            atomStruct.setAttributeValue('jobName', jobName)
+        for scoreKey, attrName in {**CHAI_SCORES, **CONFIDENCE_ATTRIBUTES}.items():
+            if scores.get(scoreKey) is not None:
+                setattr(atomStruct, attrName, Float())
+                atomStruct.setAttributeValue(attrName, scores[scoreKey])
+        return atomStruct
+
     def getExtraFiles(self):
         extraFiles = []
         resultsPath = os.path.join(os.path.abspath(self._getPath()), "chai_results")
@@ -298,68 +634,11 @@ class ProtChai(EMProtocol):
 
         return extraFiles
 
-    def guessEntityType(self, sequence):
-        seq = sequence.upper()
-        dnaLetters = set("ACGT")
-        rnaLetters = set("ACGU")
-        proteinLetters = set("ACDEFGHIKLMNPQRSTVWY")
-
-        seqSet = set(seq)
-
-        # check for RNA (U present, T absent)
-        if "U" in seqSet and "T" not in seqSet:
-            return "rna"
-        # check for DNA (T present, U absent)
-        elif "T" in seqSet and "U" not in seqSet and seqSet <= dnaLetters:
-            return "dna"
-        # check for protein: contains amino acid letters not in DNA/RNA
-        elif seqSet <= proteinLetters:
-            return "protein"
-        else:
-            return "protein"
-
     def ensureFastaHasNames(self):
+        """Writes the input fasta (gzip compressed or not) as a chai fasta, record by record"""
         fastaPath = os.path.abspath(self.file.get())
-        outputPath = os.path.join(self._getPath('input.fasta'))
-
-        with open(fastaPath) as f:
-            lines = f.readlines()
-
-        fixedLines = []
-        counter = 1
-        sequenceBuffer = ""
-        currentHeader = None
-
-
-        for line in lines:
-            line = line.rstrip("\n")
-            if line.startswith(">"):
-                if currentHeader is not None:
-                    entityType = self.guessEntityType(sequenceBuffer)
-                    self.writeSequence(entityType, currentHeader, sequenceBuffer, counter, fixedLines)
-                    counter += 1
-
-                header = line[1:]
-                if "|name=" in header:
-                    header = header.split("|name=")[-1]
-                currentHeader = header
-                sequenceBuffer = ""
-            else:
-                sequenceBuffer += line.strip()
-
-        if currentHeader is not None:
-            entityType = self.guessEntityType(sequenceBuffer)
-            self.writeSequence(entityType, currentHeader, sequenceBuffer, counter, fixedLines)
-            counter += 1
-
-        with open(outputPath, 'w') as f:
-            f.writelines(fixedLines)
+        with open(self._getPath('input.fasta'), 'w') as f:
+            for name, entityType, sequence in iterFastaEntities(fastaPath):
+                writeFastaRecord(f, f"{entityType}|name={name.replace('|', '_')}", sequence)
 
         self.NEWFILE = True
-
-    def writeSequence(self, entityType, header, sequence, counter, fixedLines):
-        if not header:
-            header = f"seq{counter}"
-        fixedLines.append(f">{entityType}|{header}\n")
-        for i in range(0, len(sequence), 80):
-            fixedLines.append(sequence[i:i + 80] + "\n")
\ No newline at end of file
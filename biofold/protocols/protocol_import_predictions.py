@@ -23,21 +23,29 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
-import tarfile
-import zipfile
+import glob
+import json
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import os
-import re
-import shutil
 import pyworkflow.protocol.params as params
-from pyworkflow.object import String
+from pyworkflow.object import String, Float
 from pyworkflow.utils import Message
 from pwem.protocols import EMProtocol
 
 from pwem.objects import AtomStruct, SetOfAtomStructs
+from biofold.constants import SUMMARY_TOP_TARGETS
+from biofold.utils.utilsArchive import SERVER_ORIGINS, listArchiveMembers, extractMembers, isServerStructure, \
+    isServerConfidence, importServerArchive, scoreServerModels, isZipArchive, isTarArchive
+from biofold.utils.utilsCache import hashFile, hashObject
+from biofold.utils.utilsConfidence import CONFIDENCE_TABLE, CONFIDENCE_ATTRIBUTES, readConfidenceTable, \
+    mergeConfidenceTables, getConfidenceSummaries
+from biofold.utils.utilsScores import AF3_SCORES, AF3_RANK_SCORE, PLDDT_SCORE
+from biofold.utils.utilsProtocol import ScoredModelsMixin, getUniqueJobName
 
 
-class ProtImportPredictions(EMProtocol):
+class ProtImportPredictions(ScoredModelsMixin, EMProtocol):
     """
     Protocol to import predicted structures.
     AlphaFold3 server: https://alphafoldserver.com/
@@ -51,197 +59,156 @@ class ProtImportPredictions(EMProtocol):
     def _defineParams(self, form):
         form.addSection(label=Message.LABEL_INPUT)
 
-        form.addParam('inputOrigin', params.EnumParam, default=0,
-                      label='Input origin: ', choices=['AlphaFold3', 'Protenix', 'Chai', 'Boltz'],
+        form.addParam('bulkImport', params.BooleanParam, default=False,
+                      label='Import several archives: ',
+                      help='Import all the archives of a directory (or matching a glob pattern), each one as a job. '
+                           'The server of each archive is detected from its content. Archives with the same '
+                           'content are imported once, and continuing the protocol only imports the new ones.')
+
+        form.addParam('inputOrigin', params.EnumParam, default=0, condition='not bulkImport',
+                      label='Input origin: ', choices=SERVER_ORIGINS,
                       help='Input entity type to add to the set')
 
-        form.addParam('folder', params.FileParam,
+        form.addParam('folder', params.FileParam, condition='not bulkImport',
                       label='Results: ',
                       help='Select the results folder downloaded from the server.')
 
+        form.addParam('archives', params.PathParam, condition='bulkImport',
+                      label='Archives: ',
+                      help='Directory with the .zip/.tar.gz/.tgz archives downloaded from the servers, '
+                           'or a glob pattern (e.g. /data/af3/fold_*.zip).')
+
+        form.addParallelSection(threads=4, mpi=0)
+
     # --------------------------- STEPS functions ------------------------------
     def _insertAllSteps(self):
-        self._insertFunctionStep(self.convertStep)
-        self._insertFunctionStep(self.extractPlddtStep)
+        if self.bulkImport.get():
+            # The archive list is a step argument, so a continued protocol imports the new downloads
+            self._insertFunctionStep(self.importArchivesStep, self.getArchivesSignature())
+        else:
+            self._insertFunctionStep(self.convertStep)
+            self._insertFunctionStep(self.extractPlddtStep)
         self._insertFunctionStep(self.createOutputStep)
 
     def convertStep(self):
-        """Copy CIF files into the protocol extra folder"""
-        self.extraFiles = []
-
-        filePath = self.folder.get()
+        """Extract from the archive only the structure files that are imported and their confidence files"""
+        filePath, origin = self.folder.get(), self.inputOrigin.get()
         extraPath = self._getExtraPath()
         os.makedirs(extraPath, exist_ok=True)
 
-        lower = filePath.lower()
-
-        if lower.endswith(".zip"):
-            with zipfile.ZipFile(filePath, 'r') as zipRef:
-                zipRef.extractall(extraPath)
+        members = listArchiveMembers(filePath)
+        if not any(isServerStructure(name, origin) for name in members):
+            raise Exception("No CIF/PDB files found in the selected folder.")
+        members = [name for name in members if isServerStructure(name, origin) or isServerConfidence(name, origin)]
 
-        elif lower.endswith(".tar.gz") or lower.endswith(".tgz") or lower.endswith(".tar"):
-            with tarfile.open(filePath, 'r:*') as tarRef:
-                tarRef.extractall(extraPath)
+        extraFiles = extractMembers(filePath, members, extraPath, threads=self.numberOfThreads.get())
+        with open(self.getExtraFilesList(), 'w') as f:
+            json.dump(extraFiles, f, indent=2)
 
-        else:
-            raise Exception("Unsupported file format. Please provide .zip or .tar.gz/.tgz archive.")
-
-
-        if self.inputOrigin.get() == 1: #protenix
-            for root, dirs, files in os.walk(extraPath):
-                if os.path.basename(root).lower() == "predictions":
-                    for name in files:
-                        if name.lower().endswith(".cif"):
-                            rel = os.path.relpath(os.path.join(root, name), extraPath)
-                            self.extraFiles.append(rel)
-        elif self.inputOrigin.get() == 3: #boltz
-            for root, dirs, files in os.walk(extraPath):
-                if os.path.basename(root).lower() == "result":
-                    for name in files:
-                        if name.lower().endswith(".pdb"):
-                            rel = os.path.relpath(os.path.join(root, name), extraPath)
-                            self.extraFiles.append(rel)
-        else: #af3 and chai
-            for root, dirs, files in os.walk(extraPath):
-                if "templates" in root.lower().split(os.sep):
+    def extractPlddtStep(self):
+        """Store the mean pLDDT per model (supports CIF and PDB) and the AlphaFold3/Protenix summary confidences,
+        used for the ranking when present. PAE and contact probabilities are decoded into .npy files"""
+        models, rankKey = scoreServerModels(self._getExtraPath(), self.getExtraFiles(), self.inputOrigin.get())
+        store = self.getScoreStore()
+        store.setModels(models, rankKey)
+        store.setInfo('rankScore', rankKey)
+
+    def importArchivesStep(self, signature):
+        """Import the new archives in a process pool, one job per archive content"""
+        store = self.getScoreStore()
+        imported = store.getInfo('archives', {})
+        archives = self.getArchiveFiles()
+        if not archives:
+            raise Exception(f"No archives found in {self.archives.get()}")
+
+        failed = []
+        with ProcessPoolExecutor(max(1, self.numberOfThreads.get())) as executor:
+            newArchives = {}
+            for archive, key in zip(archives, executor.map(hashFile, archives)):
+                if key not in imported and key not in newArchives:
+                    newArchives[key] = archive
+            print(f"{len(archives)} archives found, {len(newArchives)} new", flush=True)
+
+            usedNames, futures = {entry['job'] for entry in imported.values()}, {}
+            for key, archive in newArchives.items():
+                jobName = getUniqueJobName(self.getArchiveName(archive), usedNames, 'job')
+                jobDir = os.path.abspath(self._getExtraPath('jobs', jobName))
+                shutil.rmtree(jobDir, ignore_errors=True)
+                futures[executor.submit(importServerArchive, archive, jobDir)] = (key, archive, jobName)
+
+            for future in as_completed(futures):
+                key, archive, jobName = futures[future]
+                try:
+                    origin, models, rankKey = future.result()
+                except Exception as e:
+                    print(f"{os.path.basename(archive)} could not be imported: {e}", flush=True)
+                    failed.append(os.path.basename(archive))
                     continue
-                for name in files:
-                    if name.lower().endswith(".cif"):
-                        rel = os.path.relpath(os.path.join(root, name), extraPath)
-                        self.extraFiles.append(rel)
+                store.setModels(models, rankKey, job=jobName)
+                imported[key] = {'archive': archive, 'job': jobName, 'origin': SERVER_ORIGINS[origin]}
+                store.setInfo('archives', imported)
 
-        if not self.extraFiles:
-            raise Exception("No CIF/PDB files found in the selected folder.")
-
-    def extractPlddtStep(self):
-        """Extract per-residue pLDDT and compute mean pLDDT per model (supports CIF and PDB)."""
-        extraPath = self._getExtraPath()
-        self.meanPlddt = {}
-
-        for fileName in self.extraFiles:
-            filePath = os.path.join(extraPath, fileName)
-            modelName = os.path.splitext(fileName)[0]
-            plddtValues = []
-
-            if fileName.lower().endswith(".cif"):
-                headers = []
-                seenResidues = set()
-                with open(filePath) as f:
-                    for line in f:
-                        if line.startswith('_atom_site.'):
-                            headers.append(line.strip())
-                        elif line.startswith('ATOM'):
-                            break
-                colIndex = {h.split('.')[-1]: i for i, h in enumerate(headers)}
-                if 'B_iso_or_equiv' not in colIndex:
-                    raise Exception(f"No pLDDT field in {fileName}")
-                with open(filePath) as f:
-                    for line in f:
-                        if not line.startswith('ATOM'):
-                            continue
-                        cols = re.sub(r'\s+', ' ', line.strip()).split()
-                        resnum = int(cols[colIndex['auth_seq_id']])
-                        if resnum in seenResidues:
-                            continue
-                        seenResidues.add(resnum)
-                        plddt = float(cols[colIndex['B_iso_or_equiv']])
-                        plddtValues.append(plddt)
-
-            elif fileName.lower().endswith(".pdb"):
-                seenResidues = set()
-                with open(filePath) as f:
-                    for line in f:
-                        if not line.startswith("ATOM"):
-                            continue
-                        cols = re.sub(r'\s+', ' ', line[0:66].strip()).split()
-                        try:
-                            resnum = int(line[22:26].strip())
-                            bfactor = float(line[60:66].strip())
-                        except ValueError:
-                            continue
-                        if resnum in seenResidues:
-                            continue
-                        seenResidues.add(resnum)
-                        plddtValues.append(bfactor)
-
-            else:
-                raise Exception(f"Unsupported file type for pLDDT extraction: {fileName}")
-
-            if not plddtValues:
-                raise Exception(f"No pLDDT values found in {fileName}")
-
-            self.meanPlddt[modelName] = sum(plddtValues) / len(plddtValues)
-
-        self.bestModel = max(self.meanPlddt, key=self.meanPlddt.get)
-
-        # Write results to file
-        resultsFile = self._getPath('results.txt')
-        with open(resultsFile, 'w') as f:
-            for model, plddt in self.meanPlddt.items():
-                f.write(f"{model}\t{plddt:.2f}\n")
-            f.write(f"BEST\t{self.bestModel}\n")
-
-        self._store()
+        store.setInfo('failedArchives', sorted(failed))
+        if not imported:
+            raise Exception("None of the archives could be imported.")
 
     def createOutputStep(self):
-        extraPath = self._getExtraPath()
-        outPath = os.path.join(extraPath, 'outputs')
-        os.makedirs(outPath, exist_ok=True)
+        """The extracted files are registered in place, with no copies, and their residue confidence summary"""
+        store, origins = self.getScoreStore(), self.getJobOrigins()
+        if self.bulkImport.get():
+            mergeConfidenceTables([self._getExtraPath('jobs', job, CONFIDENCE_TABLE) for job in sorted(origins)],
+                                  self.getConfidenceTableFile())
+        confidence = getConfidenceSummaries(readConfidenceTable(self.getConfidenceTableFile()))
 
         outputSet = SetOfAtomStructs.create(self._getPath())
-
-        if self.inputOrigin.get() == 0:
-            origin = 'AlphaFold3'
-        elif self.inputOrigin.get() == 1:
-            origin = 'Protenix'
-        elif self.inputOrigin.get() == 2:
-            origin = 'Chai'
+        for src, job, scores in store.getModels():
+            outputSet.append(self.createAtomStruct(src, job, origins.get(job), {**scores, **confidence.get(src, {})}))
+
+        if self.bulkImport.get():
+            bestSet = SetOfAtomStructs.create(self._getPath(), suffix='Best')
+            for src, job, scores in store.getBestModels():
+                bestSet.append(self.createAtomStruct(src, job, origins.get(job), {**scores, **confidence.get(src, {})}))
+            self._defineOutputs(outputBestAtomStructs=bestSet, outputSetOfAtomStructs=outputSet)
         else:
-            origin = 'Boltz'
-
-        for cifName in self.extraFiles:
-            src = os.path.join(extraPath, cifName)
-
-            base = os.path.basename(cifName)
-            dst = os.path.join(outPath, base)
-
-            shutil.copy(src, dst)
-
-            atomStruct = AtomStruct(filename=dst)
-            atomStruct.origin = String()
-            atomStruct.setAttributeValue('origin', origin)
-            outputSet.append(atomStruct)
-
-        if origin != 'Boltz':
-            bestSrc = os.path.join(extraPath, self.bestModel + '.cif')
-        else:
-            bestSrc = os.path.join(extraPath, self.bestModel + '.pdb')
-
-        bestStruct = AtomStruct(filename=bestSrc)
-        bestStruct.origin = String()
-        bestStruct.setAttributeValue('origin', origin)
-
-        self._defineOutputs(
-            outputBestAtomStruct=bestStruct,
-            outputSetOfAtomStructs=outputSet
-        )
+            bestSrc, job, scores = store.getBestModel()
+            self._defineOutputs(
+                outputBestAtomStruct=self.createAtomStruct(bestSrc, job, origins.get(job),
+                                                           {**scores, **confidence.get(bestSrc, {})}),
+                outputSetOfAtomStructs=outputSet
+            )
 
     # --------------------------- INFO functions -----------------------------------
     def _summary(self):
         summary = []
-        resultsFile = self._getPath('results.txt')
-
-        if os.path.exists(resultsFile):
-            summary.append("Mean pLDDT per model:")
-            with open(resultsFile) as f:
-                for line in f:
-                    if line.startswith("BEST"):
-                        bestModel = line.split()[1]
-                    else:
-                        model, plddt = line.split()
-                        summary.append(f"  {model}: {plddt}")
-
-            summary.append(f"\nBest structure (highest mean pLDDT): {bestModel}")
+        store = self.getScoreStore()
+
+        if self.bulkImport.get():
+            topModels = store.getTopJobModels(SUMMARY_TOP_TARGETS, firstScored=AF3_RANK_SCORE)
+            if topModels:
+                summary.append(f"{store.countJobs()} jobs imported ({store.countModels()} models). "
+                               f"Top jobs (ranking score, or mean pLDDT if there is none):")
+                for modelFile, jobName, scores in topModels:
+                    line = f"  {jobName}: {os.path.basename(modelFile)} (pLDDT={scores[PLDDT_SCORE]:.2f}"
+                    if scores.get(AF3_RANK_SCORE) is not None:
+                        line += f", {AF3_RANK_SCORE}={scores[AF3_RANK_SCORE]:.3f}"
+                    summary.append(line + ")")
+            failed = store.getInfo('failedArchives', [])
+            if failed:
+                summary.append(f"Archives not imported: {', '.join(failed)}")
+            return summary
+
+        models = store.getModels()
+        if models:
+            rankKey = store.getInfo('rankScore', PLDDT_SCORE)
+            rankName = 'mean pLDDT' if rankKey == PLDDT_SCORE else rankKey
+            summary.append(f"Mean pLDDT per model{'' if rankKey == PLDDT_SCORE else f' ({rankName})'}:")
+            for modelFile, _, scores in models:
+                line = f"  {os.path.splitext(os.path.basename(modelFile))[0]}: {scores[PLDDT_SCORE]:.2f}"
+                if rankKey != PLDDT_SCORE:
+                    line += f" ({scores[rankKey]:.3f})"
+                summary.append(line)
+
+            summary.append(f"\nBest structure (highest {rankName}): {os.path.basename(models[0][0])}")
 
         return summary
 
@@ -251,10 +218,56 @@ class ProtImportPredictions(EMProtocol):
 
     def _validate(self):
         validations = []
+        if self.bulkImport.get() and not self.getArchiveFiles():
+            validations.append(f"No .zip/.tar.gz/.tgz archives found in {self.archives.get()}")
         return validations
 
     def _warnings(self):
         warnings = []
         return warnings
 
-    # --------------------------- UTILS functions -----------------------------------
\ No newline at end of file
+    # --------------------------- UTILS functions -----------------------------------
+    def getExtraFilesList(self):
+        return self._getExtraPath('extraFiles.json')
+
+    def getExtraFiles(self):
+        """Paths, relative to the extra folder, of the extracted structure files"""
+        with open(self.getExtraFilesList()) as f:
+            return json.load(f)
+
+    def getArchiveFiles(self):
+        """Archives in the archives directory, or matching the archives glob pattern"""
+        pattern = self.archives.get() or ''
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*')
+        return sorted(os.path.abspath(path) for path in glob.glob(pattern)
+                      if os.path.isfile(path) and (isZipArchive(path) or isTarArchive(path)))
+
+    def getArchivesSignature(self):
+        return hashObject([[path, os.path.getsize(path), os.path.getmtime(path)] for path in self.getArchiveFiles()])
+
+    def getArchiveName(self, archivePath):
+        name = os.path.basename(archivePath)
+        for ext in ('.tar.gz', '.tgz', '.tar', '.zip'):
+            if name.lower().endswith(ext):
+                return name[:-len(ext)]
+        return name
+
+    def getJobOrigins(self):
+        """Server of the models of each job"""
+        if not self.bulkImport.get():
+            return {'': SERVER_ORIGINS[self.inputOrigin.get()]}
+        return {entry['job']: entry['origin'] for entry in self.getScoreStore().getInfo('archives', {}).values()}
+
+    def createAtomStruct(self, filePath, jobName, origin, scores):
+        atomStruct = AtomStruct(filename=filePath)
+        atomStruct.origin = String()
+        atomStruct.setAttributeValue('origin', origin)
+        if self.bulkImport.get():
+            atomStruct.jobName = String()
+            atomStruct.setAttributeValue('jobName', jobName)
+        for scoreKey, attrName in {**AF3_SCORES, **CONFIDENCE_ATTRIBUTES}.items():
+            if scores.get(scoreKey) is not None:
+                setattr(atomStruct, attrName, Float())
+                atomStruct.setAttributeValue(attrName, scores[scoreKey])
+        return atomStruct
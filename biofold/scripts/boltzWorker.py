@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Persistent boltz inference worker. Runs in the boltz environment on a single device and keeps the loaded
+checkpoints resident between jobs, so only the first job pays for the model loading.
+
+Jobs are line-delimited JSON requests on a Unix socket:
+    {"cmd": "ping"}                                   -> {"status": "ok", ...}
+    {"cmd": "predict", "args": [...], "outDir": ...}  -> {"status": "output", "path": ...}* {"status": "done"}
+    {"cmd": "shutdown"}                               -> {"status": "bye"}
+Requests are answered by a listener thread, so a busy worker still answers pings. Predict requests are queued and
+run one by one in the main thread. Output messages are sent while the job runs, one per new prediction folder of the
+job input, and {"status": "alive"} heartbeats are sent every HEARTBEAT_INTERVAL seconds while it is queued or runs.
+
+The worker holds an exclusive lock on <socket>.pid while alive: a second worker started on the same socket exits
+without touching it. The worker exits after idleTimeout seconds without jobs.
+"""
+import argparse
+import fcntl
+import json
+import os
+import queue
+import socket
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from pathlib import Path
+
+MAX_MODELS = 4
+# Seconds between the checks for new prediction folders while a job runs
+OUTPUT_POLL_INTERVAL = 5
+# Seconds between the heartbeats sent to the queued and running jobs
+HEARTBEAT_INTERVAL = 30
+# Seconds the listener waits for a connection before checking whether the worker stopped
+ACCEPT_TIMEOUT = 1
+# Arguments that are only read at prediction time, so they can change without reloading the checkpoint
+RUNTIME_KWARGS = ('predict_args', 'steering_args')
+
+loadedModels = OrderedDict()
+
+
+def patchCheckpointLoading(modelClass):
+    originalLoad = modelClass.load_from_checkpoint
+
+    def cachedLoad(checkpoint, **kwargs):
+        key = json.dumps([modelClass.__name__, str(checkpoint),
+                          {k: v for k, v in kwargs.items() if k not in RUNTIME_KWARGS}],
+                         sort_keys=True, default=str)
+        if key not in loadedModels:
+            loadedModels[key] = originalLoad(checkpoint, **kwargs)
+            while len(loadedModels) > MAX_MODELS:
+                loadedModels.popitem(last=False)
+        loadedModels.move_to_end(key)
+
+        model = loadedModels[key]
+        for kwarg in RUNTIME_KWARGS:
+            if kwarg in kwargs:
+                setattr(model, kwarg, kwargs[kwarg])
+        return model
+
+    modelClass.load_from_checkpoint = cachedLoad
+
+
+def getPredictionFolders(outDir, inputPath):
+    """Prediction folders of the input: boltz writes them in <outDir>/boltz_results_<input name>/predictions"""
+    predictionsDir = os.path.join(outDir, f'boltz_results_{Path(inputPath).stem}', 'predictions')
+    if not os.path.isdir(predictionsDir):
+        return []
+    return [os.path.join(predictionsDir, name) for name in sorted(os.listdir(predictionsDir))]
+
+
+class OutputReporter(threading.Thread):
+    """Sends the prediction folders of a request as they appear (the ones existing before it are not sent)"""
+    def __init__(self, client, outDir, inputPath):
+        super().__init__(daemon=True)
+        self.client, self.outDir, self.inputPath = client, outDir, inputPath
+        self.reported = set(getPredictionFolders(outDir, inputPath))
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(OUTPUT_POLL_INTERVAL):
+            self.sendNewFolders()
+
+    def sendNewFolders(self):
+        for folder in getPredictionFolders(self.outDir, self.inputPath):
+            if folder not in self.reported:
+                self.reported.add(folder)
+                self.client.send({'status': 'output', 'path': folder})
+
+    def stop(self):
+        """Stops polling and sends the folders written since the last poll"""
+        self.stopped.set()
+        self.join()
+        self.sendNewFolders()
+
+
+class Client:
+    """Connection of a request. Its messages can be sent from several threads, and a client that went away
+    does not stop the job"""
+    def __init__(self, conn):
+        self.conn, self.lock = conn, threading.Lock()
+
+    def send(self, message):
+        with self.lock:
+            try:
+                self.conn.sendall((json.dumps(message) + '\n').encode())
+            except OSError:
+                pass
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class Worker:
+    """Answers the requests from a listener thread and runs the queued jobs in the main thread"""
+    def __init__(self, server, boltzMain):
+        self.server, self.boltzMain = server, boltzMain
+        self.jobs, self.pending, self.pendingLock = queue.Queue(), set(), threading.Lock()
+        self.nJobs, self.startTime = 0, time.time()
+        self.stopped = threading.Event()
+
+    def listen(self):
+        while not self.stopped.is_set():
+            try:
+                conn, _ = self.server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        client = Client(conn)
+        try:
+            with conn.makefile('r') as reader:
+                request = json.loads(reader.readline() or '{}')
+        except (OSError, ValueError):
+            client.close()
+            return
+
+        cmd = request.get('cmd')
+        if cmd == 'predict':
+            # Closed by the main thread once the job is done
+            with self.pendingLock:
+                self.pending.add(client)
+            self.jobs.put((client, request))
+            return
+        if cmd == 'ping':
+            client.send({'status': 'ok', 'pid': os.getpid(), 'jobs': self.nJobs, 'queued': self.jobs.qsize(),
+                         'models': len(loadedModels), 'uptime': time.time() - self.startTime})
+        elif cmd == 'shutdown':
+            client.send({'status': 'bye'})
+            self.jobs.put(None)
+        else:
+            client.send({'status': 'error', 'message': f'Unknown command {cmd}'})
+        client.close()
+
+    def beat(self):
+        while not self.stopped.wait(HEARTBEAT_INTERVAL):
+            with self.pendingLock:
+                clients = list(self.pending)
+            for client in clients:
+                client.send({'status': 'alive'})
+
+    def run(self, idleTimeout):
+        for target in (self.listen, self.beat):
+            threading.Thread(target=target, daemon=True).start()
+        try:
+            while True:
+                try:
+                    job = self.jobs.get(timeout=idleTimeout)
+                except queue.Empty:
+                    print(f'Idle for {idleTimeout} s, shutting down', flush=True)
+                    break
+                if job is None:
+                    break
+                self.predict(*job)
+        finally:
+            self.stop()
+
+    def predict(self, client, request):
+        # boltz runs in the main thread, the new prediction folders are reported from another one
+        reporter = OutputReporter(client, request['outDir'], request['args'][0])
+        reporter.start()
+        try:
+            try:
+                self.boltzMain.predict.main(args=request['args'], standalone_mode=False)
+            finally:
+                reporter.stop()
+            self.nJobs += 1
+            client.send({'status': 'done'})
+        except BaseException as e:
+            traceback.print_exc()
+            client.send({'status': 'error', 'message': f'{type(e).__name__}: {e}'})
+        finally:
+            self.finish(client)
+
+    def finish(self, client):
+        with self.pendingLock:
+            self.pending.discard(client)
+        client.close()
+
+    def stop(self):
+        """Stops the listener and fails the jobs still queued"""
+        self.stopped.set()
+        self.server.close()
+        while True:
+            try:
+                job = self.jobs.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                job[0].send({'status': 'error', 'message': 'Worker shut down'})
+                self.finish(job[0])
+
+
+def lockWorker(socketPath):
+    """Takes the pid lock of the socket. Returns the locked file, or None if another worker holds it"""
+    lockFile = open(socketPath + '.pid', 'a+')
+    try:
+        fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lockFile.close()
+        return None
+    lockFile.truncate(0)
+    lockFile.write(f'{os.getpid()}\n')
+    lockFile.flush()
+    return lockFile
+
+
+def serve(socketPath, idleTimeout):
+    # Taken before loading boltz, so the worker is seen as alive while it starts
+    lockFile = lockWorker(socketPath)
+    if lockFile is None:
+        print(f'Another worker is serving {socketPath}, exiting', flush=True)
+        return 0
+
+    with lockFile:
+        from boltz import main as boltzMain
+        for className in ('Boltz1', 'Boltz2'):
+            if hasattr(boltzMain, className):
+                patchCheckpointLoading(getattr(boltzMain, className))
+
+        # Left by a worker that was killed: no live worker holds the lock
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(socketPath)
+        server.listen(8)
+        server.settimeout(ACCEPT_TIMEOUT)
+        try:
+            Worker(server, boltzMain).run(idleTimeout)
+        finally:
+            if os.path.exists(socketPath):
+                os.remove(socketPath)
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Persistent boltz inference worker')
+    parser.add_argument('--socket', required=True, help='Unix socket path to listen on')
+    parser.add_argument('--idle_timeout', type=float, default=1800, help='Seconds without jobs before exiting')
+    args = parser.parse_args()
+
+    sys.exit(serve(args.socket, args.idle_timeout))
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+In-process batched chai-1 inference. Runs in the chai environment and predicts all the targets of a shard
+with run_inference in a loop, keeping the exported model components loaded between targets (chai-lab loads
+them again for every target otherwise). Targets are predicted from the shortest to the longest, so the
+targets of the same crop size run one after the other.
+
+The ESM-2 embeddings of the protein chains can be kept in a content-addressed cache shared by all the runs,
+stored as float16 .npy files that are memory-mapped on a hit instead of running the language model again.
+
+The shard is a JSON file:
+    {"options": {"num_trunk_recycles": 3, ...},
+     "targets": [{"name": ..., "fasta": ..., "outputDir": ..., "length": ..., "msaDirectory": ...}, ...],
+     "esmCache": {"root": ..., "maxSize": ..., "statsDir": ...}, "saveErrorMatrices": true}
+A target with "useMsaServer" queries the MSA server, one with "msaDirectory" reads its MSAs from it. The MSA server
+is queried for the "msaServerSequences" of a target with no MSA in its msaDirectory, and their MSAs added to it.
+With "saveErrorMatrices" the PAE and PDE of the models are saved next to them.
+"""
+import importlib.util
+import inspect
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from pathlib import Path
+
+# ESM model chai-lab embeds the protein chains with, part of the embedding cache key
+ESM_MODEL = 'facebook/esm2_t36_3B_UR50D'
+
+
+def loadUtilsCache():
+    """biofold.utils.utilsCache, imported from its file (the biofold package needs Scipion)"""
+    utilsPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils', 'utilsCache.py')
+    spec = importlib.util.spec_from_file_location('utilsCache', utilsPath)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def patchEsmEmbeddings(esmConfig, chaiVersion):
+    """Serves the ESM embeddings of the sequences found in the cache and stores the new ones.
+    Returns the hit/miss counters"""
+    import numpy as np
+    import torch
+    from chai_lab.data.dataset.embeddings import esm
+    stats = {'hits': 0, 'misses': 0}
+    if not hasattr(esm, '_get_esm_contexts_for_sequences'):
+        print('ESM embedding cache not supported by this chai-lab version')
+        return stats
+
+    utilsCache = loadUtilsCache()
+    cache = utilsCache.FileCache(esmConfig['root'], esmConfig['maxSize'])
+    originalGet = esm._get_esm_contexts_for_sequences
+
+    def getKey(sequence):
+        return utilsCache.hashObject({'model': ESM_MODEL, 'chai': chaiVersion,
+                                      'sequence': utilsCache.normaliseSequence(sequence)})
+
+    def cachedGet(prot_sequences, device, **kwargs):
+        contexts, missing = {}, set()
+        for sequence in prot_sequences:
+            embedding = cache.load(getKey(sequence), '.npy', lambda path: np.load(path, mmap_mode='r'))
+            if embedding is None:
+                missing.add(sequence)
+            else:
+                contexts[sequence] = esm.EmbeddingContext(esm_embeddings=torch.from_numpy(
+                    np.asarray(embedding, dtype=np.float32)))
+        stats['hits'] += len(contexts)
+        stats['misses'] += len(missing)
+
+        computed = originalGet(missing, device, **kwargs) if missing else {}
+        for sequence, context in computed.items():
+            with tempfile.NamedTemporaryFile(suffix='.npy') as tmpFile:
+                np.save(tmpFile, context.esm_embeddings.detach().cpu().to(torch.float16).numpy())
+                tmpFile.flush()
+                cache.store(getKey(sequence), '.npy', tmpFile.name)
+        return {**contexts, **computed}
+
+    esm._get_esm_contexts_for_sequences = cachedGet
+    return stats
+
+
+def patchComponentLoading(chai1):
+    """Caches the exported components (trunk, diffusion module, embedders...) loaded by chai-lab"""
+    loadedComponents = {}
+    if not hasattr(chai1, 'load_exported'):
+        return loadedComponents
+    originalLoad = chai1.load_exported
+
+    def cachedLoad(compKey, device):
+        key = (str(compKey), str(device))
+        if key not in loadedComponents:
+            loadedComponents[key] = originalLoad(compKey, device)
+        return loadedComponents[key]
+
+    chai1.load_exported = cachedLoad
+    return loadedComponents
+
+
+def saveErrorMatrices(candidates, outputDir):
+    """Saves the PAE and PDE of every model returned by run_inference as pae.model_idx_<i>.npy and
+    pde.model_idx_<i>.npy (float16), as chai-lab only writes their summary"""
+    import numpy as np
+    for key in ('pae', 'pde'):
+        matrices = getattr(candidates, key, None)
+        if matrices is None:
+            continue
+        for i, matrix in enumerate(matrices):
+            np.save(os.path.join(outputDir, f'{key}.model_idx_{i}.npy'),
+                    matrix.detach().float().cpu().numpy().astype(np.float16))
+
+
+def searchMissingMsas(sequences, msaDirectory, utilsCache):
+    """Queries the MSA server for the protein sequences with no MSA in msaDirectory (the rest were taken from the
+    MSA cache), and adds their .aligned.pqt files to it"""
+    from chai_lab.data.dataset.msas.colabfold import generate_colabfold_msas
+    sequences = [sequence for sequence in sequences if not os.path.exists(
+        os.path.join(msaDirectory, f'{utilsCache.hashSequence(sequence)}.aligned.pqt'))]
+    if not sequences:
+        return
+
+    # chai-lab needs an empty folder, the MSAs are moved to msaDirectory once complete
+    os.makedirs(msaDirectory, exist_ok=True)
+    tmpDir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(msaDirectory)), prefix='.msas_')
+    try:
+        generate_colabfold_msas(protein_seqs=sequences, msa_dir=Path(tmpDir))
+        for name in os.listdir(tmpDir):
+            if name.endswith('.aligned.pqt'):
+                os.replace(os.path.join(tmpDir, name), os.path.join(msaDirectory, name))
+    finally:
+        shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+def getTargetKwargs(target, options, device, supported):
+    kwargs = {**options, 'output_dir': Path(target['outputDir']), 'device': device}
+    if target.get('msaDirectory'):
+        kwargs['msa_directory'] = Path(target['msaDirectory'])
+    elif target.get('useMsaServer'):
+        kwargs['use_msa_server'] = True
+    # Components stay loaded, so they do not need to be moved in and out of the device for every target
+    kwargs['low_memory'] = False
+    return {key: value for key, value in kwargs.items() if key in supported}
+
+
+def main(shardFile, device):
+    import torch
+    import chai_lab
+    from chai_lab import chai1
+
+    with open(shardFile) as f:
+        shard = json.load(f)
+
+    utilsCache = loadUtilsCache()
+    loadedComponents = patchComponentLoading(chai1)
+    esmConfig, esmStats = shard.get('esmCache'), None
+    if esmConfig:
+        esmStats = patchEsmEmbeddings(esmConfig, getattr(chai_lab, '__version__', ''))
+    supported = set(inspect.signature(chai1.run_inference).parameters)
+    device = torch.device(device)
+
+    failed = []
+    targets = sorted(shard['targets'], key=lambda target: target.get('length', 0))
+    for i, target in enumerate(targets):
+        startTime = time.time()
+        try:
+            if target.get('msaServerSequences'):
+                searchMissingMsas(target['msaServerSequences'], target['msaDirectory'], utilsCache)
+            candidates = chai1.run_inference(fasta_file=Path(target['fasta']),
+                                             **getTargetKwargs(target, shard['options'], device, supported))
+            if shard.get('saveErrorMatrices'):
+                saveErrorMatrices(candidates, target['outputDir'])
+            print(f"[{i + 1}/{len(targets)}] {target['name']} predicted in {time.time() - startTime:.1f} s "
+                  f"({len(loadedComponents)} components loaded)", flush=True)
+        except Exception:
+            traceback.print_exc()
+            print(f"[{i + 1}/{len(targets)}] {target['name']} failed", flush=True)
+            failed.append(target['name'])
+
+    if esmStats is not None:
+        print(f"ESM embedding cache: {esmStats['hits']} hits, {esmStats['misses']} misses")
+        os.makedirs(esmConfig['statsDir'], exist_ok=True)
+        shardName = os.path.splitext(os.path.basename(shardFile))[0]
+        with open(os.path.join(esmConfig['statsDir'], f'{shardName}_{os.getpid()}.json'), 'w') as f:
+            json.dump(esmStats, f)
+
+    if failed:
+        print(f"Failed targets: {', '.join(failed)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: chaiBatch.py shard.json device")
+        sys.exit(1)
+
+    sys.exit(main(sys.argv[1], sys.argv[2]))
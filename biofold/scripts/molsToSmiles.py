@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+import sys
+
+from rdkit import Chem
+
+
+def readMol(molFile):
+    lower = molFile.lower()
+    if lower.endswith('.smi'):
+        with open(molFile) as f:
+            return Chem.MolFromSmiles(f.readline().split()[0])
+    elif lower.endswith('.sdf'):
+        return next(iter(Chem.SDMolSupplier(molFile)), None)
+    elif lower.endswith('.mol2'):
+        return Chem.MolFromMol2File(molFile)
+    elif lower.endswith('.pdb'):
+        return Chem.MolFromPDBFile(molFile)
+    return Chem.MolFromMolFile(molFile)
+
+
+def main(listFile, outFile):
+    """Converts the molecule files listed in listFile (one per line) into a "SMILES name" file"""
+    with open(listFile) as f, open(outFile, 'w') as fOut:
+        for line in f:
+            molFile, name = line.rstrip('\n').split('\t')
+            mol = readMol(molFile)
+            if mol is None:
+                print(f'Could not read {molFile}, skipping it')
+                continue
+            fOut.write(f'{Chem.MolToSmiles(mol)} {name}\n')
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: molsToSmiles.py molList.tsv output.smi")
+        sys.exit(1)
+
+    main(sys.argv[1], sys.argv[2])
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Downloads the model weights (and CCD) of boltz or chai-lab into a shared weights directory of the biofold cache.
+Runs in the environment of the tool, at install time or before the first prediction that needs them.
+
+The directory is locked while downloading, so concurrent protocols wait for the weights instead of downloading
+them again, and a manifest with the sha256 of every file is written at the end. Files that do not match the
+manifest are downloaded again.
+"""
+import importlib.util
+import os
+import sys
+from pathlib import Path
+
+# ESM model chai-lab embeds the protein chains with
+ESM_MODEL = 'facebook/esm2_t36_3B_UR50D'
+# Exported model components of chai-1
+CHAI_COMPONENTS = ('feature_embedding.pt', 'bond_loss_input_proj.pt', 'token_embedder.pt', 'trunk.pt',
+                   'diffusion_module.pt', 'confidence_head.pt')
+
+
+def loadUtilsCache():
+    """biofold.utils.utilsCache, imported from its file (the biofold package needs Scipion)"""
+    utilsPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils', 'utilsCache.py')
+    spec = importlib.util.spec_from_file_location('utilsCache', utilsPath)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def downloadBoltz(weightsDir):
+    """Boltz-2 checkpoints and the CCD molecules, as boltz predict --cache weightsDir expects them"""
+    from boltz import main
+    download = getattr(main, 'download_boltz2', None) or main.download
+    download(Path(weightsDir))
+
+
+def downloadChai(weightsDir):
+    """chai-1 components, conformers and ESM model, into the CHAI_DOWNLOADS_DIR folder"""
+    # chai-lab reads its downloads folder when imported
+    os.environ['CHAI_DOWNLOADS_DIR'] = weightsDir
+    from chai_lab.utils import paths
+    for component in CHAI_COMPONENTS:
+        paths.chai1_component(component)
+    conformers = getattr(paths, 'cached_conformers', None)
+    if conformers is not None:
+        conformers.get_path()
+
+    from chai_lab.data.dataset.embeddings import esm
+    esmFolder = getattr(esm, 'esm_cache_folder', None)
+    if esmFolder is not None:
+        from huggingface_hub import snapshot_download
+        snapshot_download(ESM_MODEL, cache_dir=esmFolder)
+
+
+DOWNLOADERS = {'boltz': downloadBoltz, 'chai': downloadChai}
+
+
+def main(tool, weightsDir):
+    cache = loadUtilsCache().WeightsCache(weightsDir)
+    if cache.prefetch(DOWNLOADERS[tool]):
+        print(f"{tool} weights downloaded to {cache.root}")
+    else:
+        print(f"{tool} weights already in {cache.root}")
+    return 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] not in DOWNLOADERS:
+        print(f"Usage: prefetchWeights.py {'|'.join(DOWNLOADERS)} weightsDir")
+        sys.exit(1)
+
+    sys.exit(main(sys.argv[1], os.path.abspath(sys.argv[2])))
@@ -23,9 +23,35 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
+import gc
+import gzip
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from biofold.objects import BoltzEntity, buildBoltzEntities, mergeEntities, buildBoltzDocument, writeBoltzYaml
 from biofold.protocols import ProtChai, ProtBoltz
+from biofold.utils.utilsCache import FileCache, MemoryCache, WeightsCache, hashObject, runWithCache
+from biofold.utils.utilsConfidence import getResidueConfidence, streamJsonMatrices, writeConfidenceTable, \
+    readConfidenceTable, selectConfidentModels
+from biofold.utils.utilsFasta import iterFastaComplexes, iterFastaEntities
+from biofold.utils.utilsPae import PaePyramid, buildPyramid
+from biofold.utils.utilsProtocol import getUniqueJobName
+from biofold.utils.utilsScores import CHAI_SCORES, CHAI_CHAIN_FLAGS, CHAI_RANK_SCORE, PLDDT_SCORE, ScoreStore, \
+    readNpzScores
 from pyworkflow.tests import BaseTest, setupTestProject, DataSet
 
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
 
 defSetASChain, defSetPDBChain = 'A', 'B'
 defSetPDBFile = 'Tmp/5ni1_{}_FIRST-LAST.fa'.format(defSetPDBChain)
@@ -38,6 +64,10 @@ defSetSeqs = '''1) {"name": "%s", "chain": "%s", "index": "FIRST-LAST", "seqFile
                          (names[0], defSetPDBChain, defSetPDBFile)
 
 
+# Import time budget of the biofold modules, as a fraction of the whole import (dominated by Scipion and pwchem),
+# so it does not depend on the load of the machine
+IMPORT_TIME_FRACTION = 0.25
+
 class TestChai(BaseTest):
     @classmethod
     def setUpClass(cls):
@@ -54,12 +84,32 @@ class TestChai(BaseTest):
         self.launchProtocol(protChai)
         best = getattr(protChai, 'outputBestAtomStruct', None)
         self.assertIsNotNone(best)
+        self.assertTrue(hasattr(best, 'aggregateScore'))
         all = getattr(protChai, 'outputSetOfAtomStructs', None)
         self.assertIsNotNone(all)
 
+    def _runChaiBatch(self):
+        protChai = self.newProtocol(
+            ProtChai,
+            inputOrigin=3,
+            batchOrigin=1,
+            timeSteps=50,
+            diffNsamples=1,
+            batchFile=self.ds.getFile('Sequences/3lqd_B_mutated.fasta')
+        )
+
+        self.launchProtocol(protChai)
+        outSet = getattr(protChai, 'outputSetOfAtomStructs', None)
+        self.assertIsNotNone(outSet)
+        self.assertEqual(len(outSet), 1)
+        self.assertIsNotNone(getattr(protChai, 'outputBestAtomStructs', None))
+
     def test(self):
         self._runChai()
 
+    def testBatch(self):
+        self._runChaiBatch()
+
 class TestBoltz(BaseTest):
     @classmethod
     def setUpClass(cls):
@@ -74,15 +124,351 @@ class TestBoltz(BaseTest):
             entityType=1,
             recyclingSteps=1,
             samplingSteps=50,
+            diffusionSamples=2,
             file=self.ds.getFile('Sequences/3lqd_B_mutated.fasta')
         )
 
         self.launchProtocol(protBoltz)
         best = getattr(protBoltz, 'outputAtomStruct', None)
         self.assertIsNotNone(best)
+        self.assertTrue(hasattr(best, 'confidenceScore'))
+        all = getattr(protBoltz, 'outputSetOfAtomStructs', None)
+        self.assertEqual(len(all), 2)
+
+    def _runBoltzBatch(self):
+        protBoltz = self.newProtocol(
+            ProtBoltz,
+            inputOrigin=3,
+            batchOrigin=1,
+            recyclingSteps=1,
+            samplingSteps=50,
+            batchFile=self.ds.getFile('Sequences/3lqd_B_mutated.fasta')
+        )
+
+        self.launchProtocol(protBoltz)
+        outSet = getattr(protBoltz, 'outputSetOfAtomStructs', None)
+        self.assertIsNotNone(outSet)
+        self.assertEqual(len(outSet), 1)
+        self.assertIsNotNone(getattr(protBoltz, 'outputBestAtomStructs', None))
 
     def test(self):
         self._runBoltz()
 
+    def testBatch(self):
+        self._runBoltzBatch()
+
+
+class TestBoltzYaml(BaseTest):
+    @unittest.skipIf(yaml is None, 'PyYAML is needed to run buildYaml.py')
+    def testInProcessYaml(self):
+        entities = [BoltzEntity('protein', f'A{i}', sequence='MKTAYIAKQRQISFVKSHFSRQ' * (i + 1)) for i in range(20)]
+        entities += [BoltzEntity('dna', 'D', sequence='ACGTACGT', cyclic=True)]
+        document = buildBoltzDocument(mergeEntities(entities))
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            jsonPath, scriptYaml, inProcYaml = [os.path.join(tmpDir, name) for name in
+                                                ('input.json', 'script.yaml', 'inproc.yaml')]
+            with open(jsonPath, 'w') as f:
+                json.dump({"sequences": document["sequences"]}, f)
+
+            scriptPath = os.path.join(os.path.dirname(__file__), '..', 'scripts', 'buildYaml.py')
+            start = time.time()
+            subprocess.run([sys.executable, scriptPath, jsonPath, scriptYaml], check=True)
+            scriptTime = time.time() - start
+
+            start = time.time()
+            writeBoltzYaml(document, inProcYaml)
+            inProcTime = time.time() - start
+
+            print(f'buildYaml.py subprocess: {scriptTime * 1000:.1f} ms, in-process writer: {inProcTime * 1000:.1f} ms')
+            with open(scriptYaml) as f1, open(inProcYaml) as f2:
+                self.assertEqual(yaml.safe_load(f1), yaml.safe_load(f2))
+            self.assertLess(inProcTime, scriptTime)
+
+    def testFastaEntityTypes(self):
+        # Without the header types the peptide would be taken as DNA and the SMILES as a protein
+        with tempfile.TemporaryDirectory() as tmpDir:
+            fastaFile = os.path.join(tmpDir, 'complex.fasta')
+            with open(fastaFile, 'w') as f:
+                f.write('>protein|name=A\nGATTACA\n>protein|name=B\nGATTACA\n>ligand|name=L\nCCO\n')
+            entities = buildBoltzEntities(((entityType, sequence) for _, entityType, sequence
+                                           in iterFastaEntities(fastaFile)), cyclic=True)
+
+        self.assertEqual(buildBoltzDocument(mergeEntities(entities))['sequences'],
+                         [{'protein': {'id': ['A', 'B'], 'cyclic': True, 'sequence': 'GATTACA'}},
+                          {'ligand': {'id': 'C', 'smiles': 'CCO'}}])
+
+
+class TestConfidenceParser(BaseTest):
+    def testChainsAndLigands(self):
+        # Both chains number their residues from 1 and the ligand is only in HETATM rows
+        cifLines = ['data_test', 'loop_'] + [f'_atom_site.{column}' for column in
+                    ['group_PDB', 'id', 'label_atom_id', 'auth_seq_id', 'auth_asym_id', 'B_iso_or_equiv']]
+        cifLines += ['ATOM 1 N 1 A 90.0', 'ATOM 2 "C1\'" 1 A 80.0', 'ATOM 3 N 2 A 70.0',
+                     'ATOM 4 N 1 B 40.0', 'HETATM 5 C1 1 C 20.0', 'HETATM 6 C2 1 C 30.0', '#']
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            cifFile = os.path.join(tmpDir, 'model.cif')
+            with open(cifFile, 'w') as f:
+                f.write('\n'.join(cifLines) + '\n')
+            confidence = getResidueConfidence(cifFile)
+
+        self.assertEqual(list(confidence['values']), [85.0, 70.0, 40.0, 25.0])
+        self.assertEqual(confidence['chainMeans'], {'A': 77.5, 'B': 40.0, 'C': 25.0})
+        self.assertAlmostEqual(confidence['mean'], 55.0)
+
+    def testChaiChainFlags(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            npzFile = os.path.join(tmpDir, 'scores.model_idx_0.npz')
+            np.savez(npzFile, aggregate_score=np.array([0.8]), ptm=np.array([0.7]),
+                     has_inter_chain_clashes=np.array([False, True, False]))
+            scores = readNpzScores(npzFile, CHAI_SCORES, CHAI_CHAIN_FLAGS)
+
+        self.assertEqual(scores, {'aggregate_score': 0.8, 'ptm': 0.7, 'iptm': None, 'has_inter_chain_clashes': 1.0})
+
+    def testConfidenceTable(self):
+        def residues(chains, ids, values):
+            return {'chains': np.array(chains), 'residues': np.array(ids), 'values': np.array(values, dtype=float)}
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            tableFile = os.path.join(tmpDir, 'residueConfidence.npz')
+            writeConfidenceTable([('model_0.cif', residues(['A', 'A', 'B'], ['120', '121A', '1'], [90.0, 75.0, 30.0])),
+                                  ('model_1.cif', residues(['A', 'A'], ['120', '121'], [90.0, 50.0]))], tableFile)
+            table = readConfidenceTable(tableFile)
+
+        self.assertEqual(selectConfidentModels(table, 70, chain='A', first=120, last=180), ['model_0.cif'])
+        self.assertEqual(selectConfidentModels(table, 70, chain='A', first=120, last=120),
+                         ['model_0.cif', 'model_1.cif'])
+
+    def testStreamedPae(self):
+        # Small chunks, so the key and the rows are split between reads
+        with tempfile.TemporaryDirectory() as tmpDir:
+            jsonFile, paeFile = os.path.join(tmpDir, 'full_data_0.json'), os.path.join(tmpDir, 'pae.npy')
+            with open(jsonFile, 'w') as f:
+                json.dump({'atom_plddts': [90.0, 80.0], 'pae': [[0.5, 2.0, 8.0], [1.5, 0.5, 9.0], [7.0, 6.0, 0.5]],
+                           'token_chain_ids': ['A', 'A', 'B']}, f)
+            self.assertEqual(streamJsonMatrices(jsonFile, {'pae': paeFile}, chunkSize=5), ['pae'])
+            pae = np.load(paeFile)
+
+        self.assertEqual(pae.dtype, np.float16)
+        self.assertEqual(pae.tolist(), [[0.5, 2.0, 8.0], [1.5, 0.5, 9.0], [7.0, 6.0, 0.5]])
+
+    def testPaePyramid(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            paeFile = os.path.join(tmpDir, 'model_0_pae.npy')
+            np.save(paeFile, np.arange(100, dtype=np.float16).reshape(10, 10))
+            pyramid = PaePyramid(buildPyramid(paeFile, tileSize=4))
+            full, fullExtent = pyramid.read((0, 10), (0, 10), pixels=10)
+            coarse, coarseExtent = pyramid.read((0, 10), (0, 10), pixels=3)
+
+        self.assertEqual(len(pyramid.levels), 3)
+        self.assertEqual(full.shape, (10, 10))
+        self.assertEqual(fullExtent, (0, 10, 10, 0))
+        self.assertEqual(coarse.shape, (5, 5))
+        self.assertEqual(coarse[0, 0], 5.5)
+        self.assertEqual(coarseExtent, (0, 10, 10, 0))
+
+    def testPaeHeatmapZoom(self):
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+        from biofold.viewers.viewer_pae import TiledHeatmap
+        with tempfile.TemporaryDirectory() as tmpDir:
+            paeFile = os.path.join(tmpDir, 'model_0_pae.npy')
+            np.save(paeFile, np.arange(64 * 64, dtype=np.float16).reshape(64, 64))
+            pyramid = PaePyramid(buildPyramid(paeFile, tileSize=4))
+            # A few screen pixels, so the whole matrix is shown from a coarse level
+            figure = Figure(figsize=(1, 1), dpi=10)
+            FigureCanvasAgg(figure)
+            ax = figure.add_subplot()
+            TiledHeatmap(figure, ax, pyramid, 31.75)
+            image = ax.images[0]
+            coarseShape = image.get_array().shape
+
+            # The heatmap is not referenced by the test, zooming must still load the finer level
+            gc.collect()
+            ax.set_xlim(0, 8)
+            ax.set_ylim(8, 0)
+
+        self.assertLess(coarseShape[0], 64)
+        self.assertEqual(image.get_array().shape, (8, 8))
+        self.assertEqual(tuple(image.get_extent()), (0, 8, 8, 0))
+
+
+class TestScoreStore(BaseTest):
+    def testTopJobModels(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            store = ScoreStore(os.path.join(tmpDir, 'scores.sqlite'))
+            store.setModels([('a_0.cif', {CHAI_RANK_SCORE: 0.4}), ('a_1.cif', {CHAI_RANK_SCORE: 0.6})],
+                            CHAI_RANK_SCORE, job='a')
+            store.setModels([('b_0.cif', {CHAI_RANK_SCORE: 0.5})], CHAI_RANK_SCORE, job='b')
+            # Ranked by pLDDT: after the jobs with an aggregate score, whatever its value
+            store.setModels([('c_0.cif', {PLDDT_SCORE: 90.0})], PLDDT_SCORE, job='c')
+
+            self.assertEqual([model[0] for model in store.getTopJobModels(2, firstScored=CHAI_RANK_SCORE)],
+                             ['a_1.cif', 'b_0.cif'])
+            self.assertEqual([model[0] for model in store.getTopJobModels(firstScored=CHAI_RANK_SCORE)][-1],
+                             'c_0.cif')
+            self.assertEqual((store.countJobs(), store.countModels()), (3, 4))
+
+
+class TestFastaReader(BaseTest):
+    def testGzipComplexes(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            fastaFile = os.path.join(tmpDir, 'complexes.fa.gz')
+            with gzip.open(fastaFile, 'wt') as f:
+                f.write('>cplx1|A\nMKVL\nLL\n>cplx1|B\nACGT\n>cplx2|ligand|name=L\nCCO\n')
+            complexes = list(iterFastaComplexes(fastaFile))
+
+        self.assertEqual(complexes, [('cplx1', [('protein', 'MKVLLL'), ('dna', 'ACGT')]),
+                                     ('cplx2', [('ligand', 'CCO')])])
+
+
+class TestJobNames(BaseTest):
+    def testUniqueJobNames(self):
+        usedNames = set()
+        jobNames = [getUniqueJobName(name, usedNames) for name in ('cplx 1', 'cplx_1', '', 'cplx/1')]
+        self.assertEqual(jobNames, ['cplx_1', 'cplx_1_1', 'complex', 'cplx_1_2'])
+        self.assertEqual(getUniqueJobName('', usedNames, 'job'), 'job')
+
+
+class TestMemoryCache(BaseTest):
+    def testFileKeyedLru(self):
+        cache, calls = MemoryCache(2), []
+
+        def compute(name):
+            calls.append(name)
+            return name.upper()
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            files = [os.path.join(tmpDir, f'{name}.pdb') for name in 'abc']
+            for fileName in files:
+                with open(fileName, 'w') as f:
+                    f.write('ATOM\n')
+            for fileName in files[:2] + files[:1] + files[2:] + files[:1]:
+                cache.get(fileName, lambda: compute(os.path.basename(fileName)))
+            # Changed on disk: parsed again
+            with open(files[0], 'a') as f:
+                f.write('END\n')
+            self.assertEqual(cache.get(files[0], lambda: compute('a.pdb')), 'A.PDB')
+
+        self.assertEqual(calls, ['a.pdb', 'b.pdb', 'c.pdb', 'a.pdb'])
+
+
+class TestPredictionCache(BaseTest):
+    def testChunkedClaims(self):
+        predicted, links = [], []
+        targets = [f'target{i}' for i in range(10)] + ['target3']
+        with tempfile.TemporaryDirectory() as tmpDir:
+            cache = FileCache(tmpDir, 1024 ** 2)
+            errors, counts = runWithCache(cache, targets, hashObject, fetch=lambda key, target: False,
+                                          predict=lambda chunk: predicted.append(len(chunk)) or [],
+                                          store=lambda key, target: None,
+                                          link=lambda src, target: links.append(target), chunkSize=4)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(counts, {'hits': 0, 'duplicates': 1, 'misses': 10, 'waited': 0})
+        self.assertEqual(predicted, [4, 4, 2])
+        self.assertEqual(links, ['target3'])
+
+
+class TestFileCache(BaseTest):
+    def testRunningSize(self):
+        walks = []
+
+        class CountingCache(FileCache):
+            def _listEntries(self):
+                walks.append(1)
+                return super()._listEntries()
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            cache, srcFile = CountingCache(os.path.join(tmpDir, 'cache'), 1000), os.path.join(tmpDir, 'entry')
+            with open(srcFile, 'w') as f:
+                f.write('0123456789')
+            for i in range(150):
+                cache.store(hashObject(i), '.txt', srcFile)
+                os.utime(cache.getPath(hashObject(i), '.txt'), (i, i))
+            entries = cache._listEntries()
+            with open(os.path.join(cache.root, '.size')) as f:
+                runningSize = int(f.read())
+
+        # Listed when the size is unknown and when it goes over the maximum, not on every store
+        self.assertLess(len(walks), 10)
+        self.assertEqual(runningSize, sum(size for _, size, _ in entries))
+        self.assertLessEqual(runningSize, 1000)
+        self.assertNotIn(cache.getPath(hashObject(0), '.txt'), [path for _, _, path in entries])
+        self.assertIn(cache.getPath(hashObject(149), '.txt'), [path for _, _, path in entries])
+
+
+class TestWeightsCache(BaseTest):
+    def testPrefetchAndOffline(self):
+        downloads = []
+
+        def download(root):
+            downloads.append(root)
+            os.makedirs(os.path.join(root, 'mols'), exist_ok=True)
+            for fileName in ('boltz2_conf.ckpt', os.path.join('mols', 'ALA.pkl')):
+                if not os.path.exists(os.path.join(root, fileName)):
+                    with open(os.path.join(root, fileName), 'w') as f:
+                        f.write('weights')
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            cache = WeightsCache(os.path.join(tmpDir, 'weights', 'boltz'))
+            with self.assertRaises(Exception):
+                with cache.use(lambda: cache.prefetch(download), offline=True):
+                    pass
+            with cache.use(lambda: cache.prefetch(download)):
+                self.assertEqual(cache.verify(checksums=True), [])
+
+            # Corrupted file with the same size: only found by the checksums, and downloaded again
+            with open(os.path.join(cache.root, 'boltz2_conf.ckpt'), 'w') as f:
+                f.write('WEIGHTS')
+            self.assertEqual(cache.verify(), [])
+            self.assertEqual(cache.verify(checksums=True), ['boltz2_conf.ckpt'])
+            self.assertTrue(cache.prefetch(download))
+            self.assertFalse(cache.prefetch(download))
+
+        self.assertEqual(len(downloads), 2)
+
+
+class TestImportTime(BaseTest):
+    def getImportTimes(self, statement):
+        """Self import time (s) of the modules imported by the statement, from python -X importtime"""
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                                capture_output=True, text=True, check=True)
+        times = {}
+        for line in result.stderr.splitlines():
+            fields = line.split('|')
+            if line.startswith('import time:') and fields[0].split(':')[1].strip().isdigit():
+                times[fields[2].strip()] = int(fields[0].split(':')[1]) / 1e6
+        return times
+
+    def getLoadedModules(self, statement):
+        """Modules loaded after running the statement, also the ones imported through importlib (not logged
+        by -X importtime)"""
+        result = subprocess.run([sys.executable, '-c', f'{statement}\nimport sys\nprint("\\n".join(sys.modules))'],
+                                capture_output=True, text=True, check=True)
+        return set(result.stdout.split())
+
+    def testPluginImport(self):
+        modules = self.getLoadedModules('import biofold')
+        self.assertNotIn('scipion.install.funcs', modules)
+        self.assertNotIn('biofold.protocols', modules)
+
+    def testProtocolImport(self):
+        modules = self.getLoadedModules('from biofold.protocols import ProtChai')
+        self.assertIn('biofold.protocols.protocol_chai', modules)
+        self.assertNotIn('biofold.protocols.protocol_boltz', modules)
+        self.assertNotIn('biofold.protocols.protocol_import_predictions', modules)
 
+        times = self.getImportTimes('import biofold.protocols.protocol_chai')
+        biofoldTime = sum(moduleTime for module, moduleTime in times.items() if module.split('.')[0] == 'biofold')
+        print(f'biofold import time: {biofoldTime * 1000:.1f} ms of {sum(times.values()) * 1000:.1f} ms')
+        self.assertIn('biofold.protocols.protocol_chai', times)
+        self.assertLess(biofoldTime, IMPORT_TIME_FRACTION * sum(times.values()))
 
+    def testViewersImport(self):
+        modules = self.getLoadedModules('import biofold.viewers')
+        self.assertIn('biofold.viewers.viewer_pae', modules)
+        for module in ('protocol_chai', 'protocol_boltz', 'protocol_import_predictions'):
+            self.assertNotIn(f'biofold.protocols.{module}', modules)
+        self.assertNotIn('biofold.utils.utilsPae', modules)
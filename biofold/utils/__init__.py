@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# Module with the helper utilities shared by the biofold protocols
+# **************************************************************************
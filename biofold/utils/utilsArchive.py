@@ -0,0 +1,189 @@
+# **************************************************************************
+# *
+# * Authors:   Blanca Pueche (blanca.pueche@cnb.csis.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import posixpath
+import re
+import shutil
+import tarfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import os
+
+from biofold.utils.utilsConfidence import FULL_DATA_MATRICES, CONFIDENCE_TABLE, getResidueConfidence, getMatrixFile, \
+    streamJsonMatrices, writeConfidenceTable
+from biofold.utils.utilsScores import AF3_RANK_SCORE, PLDDT_SCORE, readSummaryConfidences
+
+# Prediction servers whose result archives can be imported, in the order of the import protocol inputOrigin
+SERVER_ORIGINS = ['AlphaFold3', 'Protenix', 'Chai', 'Boltz']
+# Servers writing AlphaFold3-like summary_confidence(s) and full_data JSON files for each model
+AF3_LIKE_ORIGINS = (0, 1)
+SUMMARY_CONFIDENCE = 'summary_confidence'
+FULL_DATA = 'full_data'
+
+
+def isZipArchive(archivePath):
+    return archivePath.lower().endswith('.zip')
+
+
+def isTarArchive(archivePath):
+    return archivePath.lower().endswith(('.tar.gz', '.tgz', '.tar'))
+
+
+def isSafeMember(name):
+    """Members with absolute paths or going out of the extraction folder are never extracted"""
+    name = name.replace('\\', '/')
+    return not name.startswith('/') and '..' not in posixpath.normpath(name).split('/')
+
+
+def listArchiveMembers(archivePath):
+    """Names of the regular files in a zip or tar archive, read from its index (nothing is decompressed to disk)"""
+    if isZipArchive(archivePath):
+        with zipfile.ZipFile(archivePath) as zipRef:
+            return [info.filename for info in zipRef.infolist() if not info.is_dir()]
+    elif isTarArchive(archivePath):
+        with tarfile.open(archivePath, 'r:*') as tarRef:
+            return [member.name for member in tarRef if member.isfile()]
+    raise Exception("Unsupported file format. Please provide .zip or .tar.gz/.tgz archive.")
+
+
+def extractMembers(archivePath, members, dstDir, threads=1):
+    """Extracts only the given members of a zip or tar archive into dstDir, keeping their relative paths.
+    Zip members are decompressed in parallel threads (zlib releases the GIL). A compressed tar can only be read
+    sequentially, so its members are extracted in a single pass. Returns the extracted relative paths"""
+    members = [name for name in members if isSafeMember(name)]
+    for folder in {os.path.dirname(os.path.join(dstDir, name)) for name in members}:
+        os.makedirs(folder, exist_ok=True)
+
+    if isZipArchive(archivePath):
+        with zipfile.ZipFile(archivePath) as zipRef:
+            def extract(name):
+                with zipRef.open(name) as fIn, open(os.path.join(dstDir, name), 'wb') as fOut:
+                    shutil.copyfileobj(fIn, fOut, 1024 ** 2)
+
+            with ThreadPoolExecutor(max(1, threads)) as executor:
+                list(executor.map(extract, members))
+
+    else:
+        selected = set(members)
+        with tarfile.open(archivePath, 'r:*') as tarRef:
+            for member in tarRef:
+                if member.isfile() and member.name in selected:
+                    with tarRef.extractfile(member) as fIn, open(os.path.join(dstDir, member.name), 'wb') as fOut:
+                        shutil.copyfileobj(fIn, fOut, 1024 ** 2)
+    return members
+
+
+def isServerStructure(name, origin):
+    """Archive members imported for each server (index in SERVER_ORIGINS): the predicted models, never the templates"""
+    parts = name.replace('\\', '/').lower().split('/')
+    if origin == 1:  # protenix
+        return len(parts) > 1 and parts[-2] == "predictions" and parts[-1].endswith(".cif")
+    elif origin == 3:  # boltz
+        return len(parts) > 1 and parts[-2] == "result" and parts[-1].endswith(".pdb")
+    # af3 and chai
+    return "templates" not in parts[:-1] and parts[-1].endswith(".cif")
+
+
+def detectServerOrigin(members):
+    """Server (index in SERVER_ORIGINS) that produced an archive, guessed from its member names. None if unknown"""
+    names = [name.replace('\\', '/').lower() for name in members]
+    if any(isServerStructure(name, 3) for name in names):
+        return 3
+    if any(isServerStructure(name, 1) for name in names):
+        return 1
+    fileNames = [posixpath.basename(name) for name in names]
+    if any('summary_confidences' in name or 'full_data' in name or name == 'terms_of_use.md' for name in fileNames):
+        return 0
+    if any(name.endswith('.cif') for name in fileNames):
+        return 2
+    return None
+
+
+def isServerConfidence(name, origin):
+    """Confidence JSON files of the models of a server archive"""
+    fileName = posixpath.basename(name.replace('\\', '/').lower())
+    return origin in AF3_LIKE_ORIGINS and fileName.endswith('.json') and \
+        (SUMMARY_CONFIDENCE in fileName or FULL_DATA in fileName)
+
+
+def getTrailingIndex(fileName):
+    match = re.search(r'(\d+)$', os.path.splitext(os.path.basename(fileName))[0])
+    return int(match.group(1)) if match else None
+
+
+def getConfidenceFile(modelFile, files, kind):
+    """File of the given kind (summary_confidence or full_data) of a model: in the same folder, with the same
+    prefix (e.g. fold_job_model_0.cif and fold_job_summary_confidences_0.json) and the same model index"""
+    modelName = os.path.splitext(os.path.basename(modelFile))[0]
+    for fileName in files:
+        name = os.path.basename(fileName).lower()
+        if os.path.dirname(fileName) == os.path.dirname(modelFile) and kind in name and \
+                modelName.lower().startswith(name.split(kind)[0]) and \
+                getTrailingIndex(fileName) == getTrailingIndex(modelFile):
+            return fileName
+
+
+def scoreServerModels(dstDir, files, origin):
+    """Scores the models among the extracted files of a server archive (paths relative to dstDir). The models are
+    ranked by the server ranking score if they all have a summary confidence file, by their mean pLDDT otherwise.
+    The full_data matrices are stream-decoded into .npy files and the JSON files removed, and the per-residue
+    confidence of the models is written in the confidence table of dstDir.
+    Returns the [(file, scores)] of the models and the key they are ranked by"""
+    models, confidences = [], []
+    structures = [fileName for fileName in files if isServerStructure(fileName, origin)]
+    files = [os.path.join(dstDir, fileName) for fileName in files]
+    for filePath in [os.path.join(dstDir, fileName) for fileName in structures]:
+        confidences.append((filePath, getResidueConfidence(filePath)))
+        scores = {PLDDT_SCORE: confidences[-1][1]['mean']}
+        summaryFile = getConfidenceFile(filePath, files, SUMMARY_CONFIDENCE)
+        if summaryFile:
+            scores.update(readSummaryConfidences(summaryFile))
+        fullDataFile = getConfidenceFile(filePath, files, FULL_DATA)
+        if fullDataFile and os.path.exists(fullDataFile):
+            streamJsonMatrices(fullDataFile, {key: getMatrixFile(filePath, key) for key in FULL_DATA_MATRICES})
+            os.remove(fullDataFile)
+        models.append((filePath, scores))
+    writeConfidenceTable(confidences, os.path.join(dstDir, CONFIDENCE_TABLE))
+
+    ranked = models and all(scores.get(AF3_RANK_SCORE) is not None for _, scores in models)
+    return models, AF3_RANK_SCORE if ranked else PLDDT_SCORE
+
+
+def importServerArchive(archivePath, dstDir, origin=None, threads=1):
+    """Extracts the structures of a server archive, and their confidence files, into dstDir and scores them.
+    Returns the origin (detected if not given), the [(file, scores)] of the models and the key they are ranked by"""
+    members = listArchiveMembers(archivePath)
+    if origin is None:
+        origin = detectServerOrigin(members)
+        if origin is None:
+            raise Exception(f"Unknown prediction server for {os.path.basename(archivePath)}")
+
+    if not any(isServerStructure(name, origin) for name in members):
+        raise Exception(f"No CIF/PDB files found in {os.path.basename(archivePath)}")
+
+    members = [name for name in members if isServerStructure(name, origin) or isServerConfidence(name, origin)]
+    files = extractMembers(archivePath, members, dstDir, threads=threads)
+    return (origin, *scoreServerModels(dstDir, files, origin))
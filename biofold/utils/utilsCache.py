@@ -0,0 +1,409 @@
+# **************************************************************************
+# *
+# * Authors:   Blanca Pueche (blanca.pueche@cnb.csis.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import fcntl
+import hashlib
+import json
+import shutil
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import os
+
+LOCK_NAME = '.lock'
+# Running size of a FileCache, so the store is only walked when it goes over its maximum size
+SIZE_NAME = '.size'
+# Fraction of its maximum size a FileCache is evicted down to, so a full store is not listed on every write
+EVICT_FRACTION = 0.9
+# Targets claimed (each claim keeps its lock file open) and predicted at a time by runWithCache
+CLAIM_CHUNK_SIZE = 256
+# sha256 and size of the files of a weights directory
+WEIGHTS_MANIFEST = 'manifest.json'
+
+
+def normaliseSequence(sequence):
+    return ''.join(sequence.split()).upper()
+
+
+def hashSequence(sequence):
+    """Content address of a sequence: sha256 of its normalised form (same as the one used by chai-lab MSA files)"""
+    return hashlib.sha256(normaliseSequence(sequence).encode()).hexdigest()
+
+
+def hashFile(filePath, chunkSize=1024 ** 2):
+    fileHash = hashlib.sha256()
+    with open(filePath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunkSize), b''):
+            fileHash.update(chunk)
+    return fileHash.hexdigest()
+
+
+def hashObject(obj):
+    """Content address of a JSON serializable object (canonical: sorted keys, no whitespace)"""
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+def linkOrCopy(srcFile, dstFile):
+    """Hardlinks the file (no extra disk space and it survives the eviction of the source), or copies it
+    if both paths are in different filesystems"""
+    try:
+        os.link(srcFile, dstFile)
+    except OSError:
+        shutil.copyfile(srcFile, dstFile)
+
+
+class FileCache:
+    """
+    Content-addressed file store shared between protocols (and Scipion projects).
+    Entries are files (or directories) named by a key and an extension. Writes and evictions hold an exclusive
+    lock on the store, reads hold a shared one, so concurrent protocols never see half written entries.
+    The store is bounded to maxSize bytes, evicting the least recently used entries (by mtime, refreshed on hit).
+    Its size is kept in a file updated with every write, the entries are only listed when it goes over maxSize.
+    """
+    def __init__(self, root, maxSize):
+        self.root = os.path.abspath(root)
+        self.maxSize = maxSize
+        os.makedirs(self.root, exist_ok=True)
+
+    @contextmanager
+    def lock(self, exclusive=False):
+        with open(os.path.join(self.root, LOCK_NAME), 'a') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    def getPath(self, key, ext=''):
+        return os.path.join(self.root, key[:2], f'{key}{ext}')
+
+    def contains(self, key, ext=''):
+        return os.path.exists(self.getPath(key, ext))
+
+    def fetch(self, key, ext, dstFile):
+        """Copies the entry to dstFile and marks it as recently used. Returns False on a miss"""
+        with self.lock():
+            cachePath = self.getPath(key, ext)
+            if not os.path.exists(cachePath):
+                return False
+            os.makedirs(os.path.dirname(os.path.abspath(dstFile)), exist_ok=True)
+            shutil.copyfile(cachePath, dstFile)
+            os.utime(cachePath)
+        return True
+
+    def load(self, key, ext, loader):
+        """Returns loader(entryPath) read in place (e.g. memory-mapped) and marks the entry as recently used.
+        Returns None on a miss"""
+        with self.lock():
+            cachePath = self.getPath(key, ext)
+            if not os.path.exists(cachePath):
+                return None
+            os.utime(cachePath)
+            return loader(cachePath)
+
+    def store(self, key, ext, srcFile):
+        """Atomically adds srcFile to the store and evicts the least recently used entries beyond maxSize"""
+        cachePath = self.getPath(key, ext)
+        os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+        with self.lock(exclusive=True):
+            size = self._readSize() - getEntrySize(cachePath)
+            fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(cachePath), prefix='.tmp')
+            os.close(fd)
+            shutil.copyfile(srcFile, tmpPath)
+            os.replace(tmpPath, cachePath)
+            self._updateSize(size + getEntrySize(cachePath))
+
+    def fetchDir(self, key, dstDir, rename=None):
+        """Links the files of a directory entry into dstDir (renamed by rename(fileName) if given)
+        and marks it as recently used. Returns False on a miss"""
+        with self.lock():
+            cachePath = self.getPath(key)
+            if not os.path.isdir(cachePath):
+                return False
+            os.makedirs(dstDir, exist_ok=True)
+            for fileName in os.listdir(cachePath):
+                linkOrCopy(os.path.join(cachePath, fileName), os.path.join(dstDir, rename(fileName) if rename else fileName))
+            os.utime(cachePath)
+        return True
+
+    def storeDir(self, key, srcDir, rename=None):
+        """Atomically adds the files of srcDir as a directory entry (renamed by rename(fileName) if given)"""
+        cachePath = self.getPath(key)
+        os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+        with self.lock(exclusive=True):
+            size = self._readSize() - getEntrySize(cachePath)
+            tmpPath = tempfile.mkdtemp(dir=os.path.dirname(cachePath), prefix='.tmp')
+            for fileName in os.listdir(srcDir):
+                if os.path.isfile(os.path.join(srcDir, fileName)):
+                    linkOrCopy(os.path.join(srcDir, fileName),
+                               os.path.join(tmpPath, rename(fileName) if rename else fileName))
+            shutil.rmtree(cachePath, ignore_errors=True)
+            os.replace(tmpPath, cachePath)
+            self._updateSize(size + getEntrySize(cachePath))
+
+    def claim(self, key, wait=True):
+        """Exclusive per-key lock, held while the entry is computed so concurrent requests of the same key wait
+        for it instead of computing it again. Returns the lock handle (None if not waiting and already claimed)"""
+        lockPath = os.path.join(self.root, key[:2], f'.{key}.lock')
+        os.makedirs(os.path.dirname(lockPath), exist_ok=True)
+        lockFile = open(lockPath, 'a')
+        try:
+            fcntl.flock(lockFile, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lockFile.close()
+            return None
+        return lockFile
+
+    def release(self, claimHandle):
+        fcntl.flock(claimHandle, fcntl.LOCK_UN)
+        claimHandle.close()
+
+    def _listEntries(self):
+        """Returns the (mtime, size, path) of every entry"""
+        entries = []
+        for shardName in os.listdir(self.root):
+            shardPath = os.path.join(self.root, shardName)
+            if not os.path.isdir(shardPath):
+                continue
+            for entryName in os.listdir(shardPath):
+                if entryName.startswith('.'):
+                    continue
+                entryPath = os.path.join(shardPath, entryName)
+                entries.append((os.stat(entryPath).st_mtime, getDiskSize(entryPath), entryPath))
+        return entries
+
+    def _readSize(self):
+        """Running size of the store (called with the exclusive lock), computed from its entries if unknown"""
+        try:
+            with open(os.path.join(self.root, SIZE_NAME)) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return sum(size for _, size, _ in self._listEntries())
+
+    def _updateSize(self, size):
+        """Stores the running size of the store (called with the exclusive lock), evicting the least recently used
+        entries if it is over maxSize"""
+        if size > self.maxSize:
+            size = self._evict()
+        with open(os.path.join(self.root, SIZE_NAME), 'w') as f:
+            f.write(str(size))
+
+    def _evict(self):
+        """Removes the least recently used entries beyond EVICT_FRACTION of maxSize. Returns the size of the store"""
+        entries = self._listEntries()
+        totalSize = sum(size for _, size, _ in entries)
+        for _, size, entryPath in sorted(entries):
+            if totalSize <= EVICT_FRACTION * self.maxSize:
+                break
+            if os.path.isdir(entryPath):
+                shutil.rmtree(entryPath, ignore_errors=True)
+            else:
+                os.remove(entryPath)
+            totalSize -= size
+        return totalSize
+
+
+class WeightsCache(FileCache):
+    """
+    Shared directory with the model weights (and CCD) of a tool, downloaded once (at install time or by the first
+    protocol) instead of by every run on every node. Downloads hold an exclusive lock on it and predictions a
+    shared one, so the weights are never rewritten under a running job. A manifest records the sha256 and size
+    of every file: the sizes are checked before each run, the checksums on every download.
+    """
+    def __init__(self, root):
+        super().__init__(root, maxSize=None)
+
+    def getManifestFile(self):
+        return os.path.join(self.root, WEIGHTS_MANIFEST)
+
+    def listFiles(self):
+        """Relative paths of the weight files (hidden and temporary files excluded)"""
+        files = []
+        for dirPath, dirNames, fileNames in os.walk(self.root):
+            dirNames[:] = [dirName for dirName in dirNames if not dirName.startswith('.')]
+            files += [os.path.relpath(os.path.join(dirPath, fileName), self.root) for fileName in fileNames
+                      if not fileName.startswith('.') and fileName != WEIGHTS_MANIFEST]
+        return sorted(files)
+
+    def writeManifest(self):
+        manifest = {fileName: {'sha256': hashFile(os.path.join(self.root, fileName)),
+                               'size': os.path.getsize(os.path.join(self.root, fileName))}
+                    for fileName in self.listFiles()}
+        tmpFile = self.getManifestFile() + '.tmp'
+        with open(tmpFile, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmpFile, self.getManifestFile())
+
+    def verify(self, checksums=False):
+        """Returns the files that are missing or do not match the manifest (the manifest itself if missing)"""
+        if not os.path.exists(self.getManifestFile()):
+            return [WEIGHTS_MANIFEST]
+        with open(self.getManifestFile()) as f:
+            manifest = json.load(f)
+        invalid = []
+        for fileName, info in manifest.items():
+            filePath = os.path.join(self.root, fileName)
+            if not os.path.exists(filePath) or os.path.getsize(filePath) != info['size'] or \
+                    (checksums and hashFile(filePath) != info['sha256']):
+                invalid.append(fileName)
+        return invalid
+
+    def prefetch(self, download):
+        """Runs download(root) under the exclusive lock if any file is missing or corrupted, and writes the
+        manifest of the downloaded files. Returns whether anything was downloaded"""
+        with self.lock(exclusive=True):
+            invalid = self.verify(checksums=True)
+            if not invalid:
+                return False
+            # The tools only download the files that do not exist
+            for fileName in invalid:
+                if fileName != WEIGHTS_MANIFEST and os.path.exists(os.path.join(self.root, fileName)):
+                    os.remove(os.path.join(self.root, fileName))
+            download(self.root)
+            self.writeManifest()
+        return True
+
+    @contextmanager
+    def use(self, prefetch, offline=False):
+        """Holds a shared lock on the weights while the block runs. Missing weights are fetched first by
+        prefetch() (which takes the exclusive lock itself), or raise at once in offline mode"""
+        with self.lock():
+            invalid = self.verify()
+        if invalid:
+            if offline:
+                raise Exception(f"Model weights missing in {self.root} ({', '.join(invalid[:5])}) and biofold is "
+                                f"in offline mode. Download them on a node with network access first.")
+            prefetch()
+        with self.lock():
+            yield
+
+
+def getEntrySize(path):
+    """Disk size of a cache entry, 0 if it does not exist"""
+    return getDiskSize(path) if os.path.exists(path) else 0
+
+
+def getDiskSize(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(dirPath, fileName))
+               for dirPath, _, fileNames in os.walk(path) for fileName in fileNames)
+
+
+def getFileKey(filePath):
+    """Identity of the file content for in-memory caches: its path, modification time and size"""
+    stat = os.stat(filePath)
+    return os.path.abspath(filePath), stat.st_mtime_ns, stat.st_size
+
+
+class MemoryCache:
+    """
+    In-process cache of the values computed from files, bounded to the maxSize least recently used entries.
+    Entries are keyed on getFileKey, so a file changed on disk is computed again.
+    """
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+
+    def get(self, filePath, compute, *args):
+        """Returns compute() for the file (and args), computing it only on a miss"""
+        key = (getFileKey(filePath),) + args
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        value = compute()
+        self.entries[key] = value
+        while len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+        return value
+
+
+def runWithCache(cache, targets, getKey, fetch, predict, store, link, chunkSize=CLAIM_CHUNK_SIZE):
+    """Predicts only the targets whose result is not in the cache, predicting identical targets once.
+    Targets being predicted by another process are waited for, and predicted here if that process fails.
+    Missing targets are claimed and predicted in chunks of chunkSize, every claim keeps its lock file open.
+        getKey(target): cache key of the target
+        fetch(key, target): reuses the cached result of the target, returns False on a miss
+        predict(targets): predicts the targets, returns the list of (job, exception) that failed
+        store(key, target): stores the result of a predicted target in the cache (if it is valid)
+        link(srcTarget, target): reuses the result of srcTarget for the identical target
+    Returns the list of (job, exception) that failed and the counters of the run, for the protocol log
+    (see getCacheSummary)"""
+    representatives, duplicates, misses, nHits = {}, [], [], 0
+    for target in targets:
+        key = getKey(target)
+        if key in representatives:
+            duplicates.append((representatives[key], target))
+        elif fetch(key, target):
+            representatives[key], nHits = target, nHits + 1
+        else:
+            representatives[key] = target
+            misses.append(key)
+
+    def predictClaimed(claimed):
+        try:
+            errors = predict([representatives[key] for key in claimed]) if claimed else []
+            for key in claimed:
+                store(key, representatives[key])
+            return errors
+        finally:
+            for claim in claimed.values():
+                cache.release(claim)
+
+    errors, waiting = [], []
+    for start in range(0, len(misses), chunkSize):
+        claims = {}
+        for key in misses[start:start + chunkSize]:
+            claim = cache.claim(key, wait=False)
+            if claim:
+                claims[key] = claim
+            else:
+                waiting.append(key)
+        errors += predictClaimed(claims)
+
+    claims, nWaited = {}, 0
+    for key in waiting:
+        claim = cache.claim(key)
+        if fetch(key, representatives[key]):
+            cache.release(claim)
+            nWaited += 1
+            continue
+        claims[key] = claim
+        if len(claims) == chunkSize:
+            errors += predictClaimed(claims)
+            claims = {}
+    errors += predictClaimed(claims)
+
+    for srcTarget, target in duplicates:
+        link(srcTarget, target)
+    counts = {'hits': nHits, 'duplicates': len(duplicates), 'misses': len(misses), 'waited': nWaited}
+    return errors, counts
+
+
+def getCacheSummary(counts):
+    """Log line of the counters of a runWithCache run"""
+    return (f"Prediction cache: {counts['hits']} hits, {counts['duplicates']} duplicated targets, "
+            f"{counts['misses']} misses ({counts['waited']} of them predicted meanwhile by other protocols)")
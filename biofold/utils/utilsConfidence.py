@@ -0,0 +1,327 @@
+# **************************************************************************
+# *
+# * Authors:   Blanca Pueche (blanca.pueche@cnb.csis.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import re
+
+import numpy as np
+import os
+
+# Per-residue confidence of ModelCIF files (e.g. AlphaFold DB), preferred over the atom B-factors when present
+QA_LOCAL_CATEGORY = '_ma_qa_metric_local'
+QA_LOCAL_COLUMNS = ['label_asym_id', 'label_seq_id', 'metric_value', 'model_id']
+ATOM_SITE_CATEGORY = '_atom_site'
+ATOM_SITE_COLUMNS = ['auth_asym_id', 'label_asym_id', 'auth_seq_id', 'label_seq_id', 'pdbx_PDB_ins_code',
+                     'B_iso_or_equiv', 'pdbx_PDB_model_num']
+
+# Token x token matrices of the AlphaFold3/Protenix full_data JSON files, stored as float16 .npy next to the model
+FULL_DATA_MATRICES = ('pae', 'contact_probs')
+# Characters of a large JSON file read at once when stream-decoding its matrices
+JSON_CHUNK_SIZE = 4 * 1024 ** 2
+
+# Per-residue confidence of all the models of an output set, one row per (model, residue)
+CONFIDENCE_TABLE = 'residueConfidence.npz'
+# pLDDT from which a residue is confident (0.7 for the models with pLDDT in [0, 1])
+CONFIDENT_PLDDT = 70
+# Residue number of the residue ids with no number
+NO_RESIDUE_NUMBER = -1
+# Summary of the residue confidence of a model registered as attributes of its AtomStruct
+CONFIDENCE_ATTRIBUTES = {'mean_plddt': 'meanPlddt', 'min_plddt': 'minPlddt', 'confident_fraction': 'confidentFraction'}
+
+CIF_TOKEN = re.compile(r"""'(?:[^']|'(?=\S))*'|"(?:[^"]|"(?=\S))*"|\S+""")
+
+
+def unquote(values):
+    values = np.array(values)
+    quoted = np.char.startswith(values, "'") | np.char.startswith(values, '"')
+    if quoted.any():
+        values[quoted] = [value[1:-1] for value in values[quoted]]
+    return values
+
+
+def readCifLoops(cifFile, categories):
+    """Reads the loop_ tables of the given categories ({category: [columns]}) of a mmCIF file in a single pass.
+    Returns {category: {column: numpy array of strings}} with the columns found"""
+    tables, columns, category, lines = {}, [], None, []
+
+    def closeLoop():
+        if category not in categories or not columns or not lines:
+            return
+        text = ''.join(lines)
+        tokens = text.split()
+        if len(tokens) != len(lines) * len(columns):
+            # Quoted values with spaces or rows split in several lines
+            tokens = CIF_TOKEN.findall(text)
+            tokens = tokens[:len(tokens) - len(tokens) % len(columns)]
+        tables[category] = {column: unquote(tokens[i::len(columns)]) for i, column in enumerate(columns)
+                            if column in categories[category]}
+
+    with open(cifFile) as f:
+        inHeader = False
+        for line in f:
+            if line.startswith('loop_'):
+                closeLoop()
+                columns, category, lines, inHeader = [], None, [], True
+            elif inHeader and line.startswith('_'):
+                category, column = line.split()[0].split('.', 1)
+                columns.append(column)
+            elif line.startswith(('_', '#', 'data_')):
+                closeLoop()
+                columns, category, lines, inHeader = [], None, [], False
+            elif category is not None:
+                inHeader = False
+                if category in categories and line.strip():
+                    lines.append(line)
+        closeLoop()
+    return tables
+
+
+def readPdbAtoms(pdbFile):
+    """Returns the (chains, residues, bFactors) arrays of the ATOM/HETATM records of the first model of a PDB file"""
+    chains, residues, bFactors = [], [], []
+    with open(pdbFile) as f:
+        for line in f:
+            if line.startswith(('ATOM', 'HETATM')):
+                chains.append(line[21])
+                residues.append(line[22:27].strip())
+                bFactors.append(line[60:66])
+            elif line.startswith('ENDMDL'):
+                break
+    return np.array(chains), np.array(residues), np.array(bFactors, dtype=float) if bFactors else np.array([])
+
+
+def getFirstColumn(table, columns):
+    for column in columns:
+        if column in table:
+            return table[column]
+
+
+def readCifConfidence(cifFile):
+    """Returns the (chains, residues, values, source) of the confidence values of a mmCIF file: per residue from
+    _ma_qa_metric_local if present, per atom (ATOM and HETATM) from the B-factors of the first model otherwise"""
+    tables = readCifLoops(cifFile, {QA_LOCAL_CATEGORY: QA_LOCAL_COLUMNS, ATOM_SITE_CATEGORY: ATOM_SITE_COLUMNS})
+    if QA_LOCAL_CATEGORY in tables:
+        table = tables[QA_LOCAL_CATEGORY]
+        if 'model_id' in table:
+            table = {column: values[table['model_id'] == table['model_id'][0]] for column, values in table.items()}
+        return (table['label_asym_id'], table['label_seq_id'], table['metric_value'].astype(float),
+                QA_LOCAL_CATEGORY)
+
+    table = tables.get(ATOM_SITE_CATEGORY)
+    if table is None or 'B_iso_or_equiv' not in table:
+        raise Exception(f"No confidence field in {cifFile}")
+    if 'pdbx_PDB_model_num' in table:
+        table = {column: values[table['pdbx_PDB_model_num'] == table['pdbx_PDB_model_num'][0]]
+                 for column, values in table.items()}
+
+    chains = getFirstColumn(table, ['auth_asym_id', 'label_asym_id'])
+    residues = getFirstColumn(table, ['auth_seq_id', 'label_seq_id'])
+    if 'pdbx_PDB_ins_code' in table:
+        residues = np.char.add(residues, np.char.replace(np.char.replace(table['pdbx_PDB_ins_code'], '?', ''), '.', ''))
+    return chains, residues, table['B_iso_or_equiv'].astype(float), ATOM_SITE_CATEGORY
+
+
+def groupByResidue(chains, residues, values):
+    """Mean of the values of each (chain, residue), in order of appearance.
+    Returns the (chains, residues, means) arrays with one element per residue"""
+    keys = np.char.add(np.char.add(chains.astype(str), '\x00'), residues.astype(str))
+    _, firstIdx, groups = np.unique(keys, return_index=True, return_inverse=True)
+    groups = groups.ravel()
+    means = np.bincount(groups, weights=values) / np.bincount(groups)
+    order = np.argsort(firstIdx)
+    return chains[firstIdx[order]], residues[firstIdx[order]], means[order]
+
+
+def getResidueConfidence(structFile):
+    """Per-residue, per-chain and global confidence (pLDDT or B-factor) of a mmCIF or PDB file.
+    Returns a dictionary with the per-residue 'chains', 'residues' and 'values' arrays, the 'chainMeans'
+    ({chain: mean of its residues}), the global 'mean' of the residues and the 'source' of the values"""
+    if structFile.lower().endswith('.cif'):
+        chains, residues, values, source = readCifConfidence(structFile)
+    elif structFile.lower().endswith('.pdb'):
+        (chains, residues, values), source = readPdbAtoms(structFile), 'b_factor'
+    else:
+        raise Exception(f"Unsupported file type for confidence extraction: {structFile}")
+
+    if not len(values):
+        raise Exception(f"No confidence values found in {structFile}")
+
+    resChains, resIds, resValues = groupByResidue(chains, residues, values)
+    chainIds, chainIdx = np.unique(resChains, return_inverse=True)
+    chainIdx = chainIdx.ravel()
+    chainMeans = np.bincount(chainIdx, weights=resValues) / np.bincount(chainIdx)
+    return {'chains': resChains, 'residues': resIds, 'values': resValues, 'source': source,
+            'chainMeans': {str(chain): float(mean) for chain, mean in zip(chainIds, chainMeans)},
+            'mean': float(resValues.mean())}
+
+
+def getMeanConfidence(structFile):
+    return getResidueConfidence(structFile)['mean']
+
+
+def getMatrixFile(modelFile, key):
+    """.npy file with the key matrix (e.g. pae) of a model"""
+    return f'{os.path.splitext(modelFile)[0]}_{key}.npy'
+
+
+def streamJsonMatrices(jsonFile, outFiles, chunkSize=JSON_CHUNK_SIZE):
+    """Stream-decodes the square numeric matrices of the top-level keys of a large JSON file (e.g. the pae of an
+    AlphaFold3 full_data file) into float16 .npy files, given as {key: npyFile}. The file is read in chunks and the
+    complete rows of each chunk are parsed by numpy into the memory-mapped output. Returns the keys decoded"""
+    keyRegex = re.compile(r'"(%s)"\s*:\s*\[' % '|'.join(re.escape(key) for key in outFiles))
+    matrixEnd = re.compile(r'\]\s*\]')
+    decoded, key, matrix, nRows, buffer = [], None, None, 0, ''
+    with open(jsonFile) as f:
+        for chunk in iter(lambda: f.read(chunkSize), ''):
+            buffer += chunk
+            while True:
+                if key is None:
+                    match = keyRegex.search(buffer)
+                    if not match:
+                        # Keeps the end of the chunk, in case a key is split between two chunks
+                        buffer = buffer[-64:]
+                        break
+                    key, matrix, nRows, buffer = match.group(1), None, 0, buffer[match.end():]
+
+                rest = buffer.lstrip(' ,\r\n\t')
+                if rest.startswith(']'):
+                    # End of the matrix
+                    if matrix is not None:
+                        if nRows != len(matrix):
+                            raise Exception(f"{key} of {jsonFile} is not a square numeric matrix")
+                        matrix.flush()
+                        decoded.append(key)
+                    key, matrix, buffer = None, None, rest[1:]
+                    continue
+
+                # Complete rows in the buffer, up to the end of the matrix if it is there
+                end = matrixEnd.search(buffer)
+                cut = end.start() + 1 if end else buffer.rfind(']') + 1
+                if cut <= 0:
+                    break
+                rowsText, buffer = buffer[:cut], buffer[cut:]
+                nNewRows = rowsText.count('[')
+                values = np.fromstring(rowsText.replace('[', ' ').replace(']', ' ').strip(' ,\r\n\t'),
+                                       dtype=np.float32, sep=',')
+                if matrix is None:
+                    nCols = len(values) // nNewRows
+                    matrix = np.lib.format.open_memmap(outFiles[key], mode='w+', dtype=np.float16,
+                                                       shape=(nCols, nCols))
+                if nRows + nNewRows > len(matrix) or len(values) != nNewRows * len(matrix):
+                    raise Exception(f"{key} of {jsonFile} is not a square numeric matrix")
+                matrix[nRows:nRows + nNewRows] = values.reshape(nNewRows, -1)
+                nRows += nNewRows
+    return decoded
+
+
+def getResidueNumbers(residues):
+    """Residue numbers of the residue ids, without their insertion codes. Ids with no number ('.' or '?',
+    allowed by ModelCIF for non-polymer rows) are numbered NO_RESIDUE_NUMBER"""
+    try:
+        return residues.astype(np.int32)
+    except ValueError:
+        matches = [re.match(r'-?\d+', residue) for residue in residues]
+        return np.array([int(match.group()) if match else NO_RESIDUE_NUMBER for match in matches], dtype=np.int32)
+
+
+def writeConfidenceTable(confidences, tableFile):
+    """Writes the per-residue confidence of the models, given as (modelFile, getResidueConfidence dictionary), in a
+    single columnar file: 'files' has one row per model, and 'model' (index in files), 'chain', 'residue'
+    (id with insertion code), 'residueNumber' and 'value' one row per residue. Returns the table"""
+    files, columns = [], {'model': [], 'chain': [], 'residue': [], 'value': []}
+    for modelIdx, (modelFile, confidence) in enumerate(confidences):
+        files.append(modelFile)
+        columns['model'].append(np.full(len(confidence['values']), modelIdx, dtype=np.int32))
+        columns['chain'].append(confidence['chains'].astype(str))
+        columns['residue'].append(confidence['residues'].astype(str))
+        columns['value'].append(confidence['values'].astype(np.float32))
+
+    table = {key: np.concatenate(arrays) if arrays else np.array([]) for key, arrays in columns.items()}
+    table['model'] = table['model'].astype(np.int32)
+    table['residueNumber'] = getResidueNumbers(table['residue'])
+    table['files'] = np.array(files, dtype=str)
+    saveConfidenceTable(table, tableFile)
+    return table
+
+
+def saveConfidenceTable(table, tableFile):
+    tmpFile = f'{tableFile}.tmp.npz'
+    np.savez(tmpFile, **table)
+    os.replace(tmpFile, tableFile)
+
+
+def readConfidenceTable(tableFile):
+    with np.load(tableFile) as data:
+        return {key: data[key] for key in data.files}
+
+
+def mergeConfidenceTables(tableFiles, tableFile):
+    """Joins the tables of several jobs in a single table"""
+    tables = [readConfidenceTable(path) for path in tableFiles]
+    offsets = np.cumsum([0] + [len(table['files']) for table in tables[:-1]])
+    merged = {key: np.concatenate([table[key] for table in tables]) for key in tables[0]} if tables else {}
+    if tables:
+        merged['model'] = np.concatenate([table['model'] + offset for table, offset in zip(tables, offsets)])
+        saveConfidenceTable(merged, tableFile)
+    return merged
+
+
+def getConfidentThresholds(table):
+    """Confident pLDDT of each model, on the scale of its values"""
+    maxValues = np.full(len(table['files']), -np.inf)
+    np.maximum.at(maxValues, table['model'], table['value'])
+    return np.where(maxValues <= 1, CONFIDENT_PLDDT / 100, CONFIDENT_PLDDT)
+
+
+def getConfidenceSummaries(table):
+    """Summary of the residue confidence of each model, as {modelFile: {key: value}} with the CONFIDENCE_ATTRIBUTES
+    keys: the mean and minimum pLDDT of its residues and the fraction of confident residues"""
+    nModels, models, values = len(table['files']), table['model'], table['value']
+    counts = np.bincount(models, minlength=nModels)
+    means = np.bincount(models, weights=values, minlength=nModels) / np.maximum(counts, 1)
+    minValues = np.full(nModels, np.inf)
+    np.minimum.at(minValues, models, values)
+    confident = values >= getConfidentThresholds(table)[models]
+    fractions = np.bincount(models, weights=confident, minlength=nModels) / np.maximum(counts, 1)
+    return {str(modelFile): {'mean_plddt': float(mean), 'min_plddt': float(minValue),
+                             'confident_fraction': float(fraction)}
+            for modelFile, mean, minValue, fraction, count in zip(table['files'], means, minValues, fractions, counts)
+            if count}
+
+
+def selectConfidentModels(table, minValue, chain=None, first=None, last=None):
+    """Models whose residues of the chain (all if None) numbered first to last have all a confidence of at least
+    minValue, e.g. residues 120-180 of chain A with pLDDT > 70. Returns their files"""
+    mask = np.ones(len(table['value']), dtype=bool)
+    if chain is not None:
+        mask &= table['chain'] == chain
+    if first is not None:
+        mask &= table['residueNumber'] >= first
+    if last is not None:
+        mask &= table['residueNumber'] <= last
+
+    nModels = len(table['files'])
+    selected = np.bincount(table['model'][mask], minlength=nModels)
+    failed = np.bincount(table['model'][mask & (table['value'] < minValue)], minlength=nModels)
+    return [str(modelFile) for modelFile in table['files'][(selected > 0) & (failed == 0)]]
@@ -0,0 +1,152 @@
+# **************************************************************************
+# *
+# * Authors:   Blanca Pueche (blanca.pueche@cnb.csis.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import gzip
+
+import os
+
+from biofold.constants import CHAI_ENTITIES
+
+DNA_LETTERS = set("ACGT")
+RNA_LETTERS = set("ACGU")
+PROTEIN_LETTERS = set("ACDEFGHIKLMNPQRSTVWY")
+
+# Letters accepted in the sequences of each entity type (ambiguity codes included). Ligands are SMILES or CCD codes
+VALID_LETTERS = {'protein': PROTEIN_LETTERS | set("XBZUO"), 'dna': DNA_LETTERS | set("N"),
+                 'rna': RNA_LETTERS | set("N")}
+
+# Line width of the written fasta sequences
+FASTA_WIDTH = 80
+
+
+def openFasta(fastaPath, mode='rt'):
+    """Opens a fasta file, gzip compressed if it ends with .gz"""
+    if fastaPath.endswith('.gz'):
+        return gzip.open(fastaPath, mode)
+    return open(fastaPath, mode)
+
+
+def isFastaFile(fileName):
+    name = fileName[:-len('.gz')] if fileName.endswith('.gz') else fileName
+    return os.path.splitext(name)[1].lower() in ('.fasta', '.fa', '.faa', '.fna')
+
+
+def getFastaName(fileName):
+    """File name without the fasta (and .gz) extensions"""
+    name = os.path.basename(fileName)
+    name = name[:-len('.gz')] if name.endswith('.gz') else name
+    return os.path.splitext(name)[0]
+
+
+def iterFastaRecords(fastaPath):
+    """Yields the (header, sequence) records of a fasta file one by one, so only one record is kept in memory"""
+    header, seqLines = None, []
+    with openFasta(fastaPath) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('>'):
+                if header is not None:
+                    yield header, ''.join(seqLines)
+                header, seqLines = line[1:].strip(), []
+            elif line and header is not None:
+                seqLines.append(line)
+    if header is not None:
+        yield header, ''.join(seqLines)
+
+
+def guessEntityType(sequence):
+    seqSet = set(sequence.upper())
+
+    # check for RNA (U present, T absent)
+    if "U" in seqSet and "T" not in seqSet:
+        return "rna"
+    # check for DNA (T present, U absent)
+    elif "T" in seqSet and "U" not in seqSet and seqSet <= DNA_LETTERS:
+        return "dna"
+    # protein otherwise
+    return "protein"
+
+
+def getHeaderEntity(header, sequence):
+    """Entity type given in a fasta header field (e.g. >protein|name=A), guessed from the sequence otherwise"""
+    for field in header.split('|'):
+        if field.strip().lower() in CHAI_ENTITIES:
+            return field.strip().lower()
+    return guessEntityType(sequence)
+
+
+def getHeaderName(header):
+    """Record name of a fasta header: the name= field if any, the header otherwise"""
+    if '|name=' in header:
+        return header.split('|name=')[-1].strip()
+    return header.strip()
+
+
+def getComplexName(header):
+    """Complex a record of a multi-complex fasta belongs to: first word of the header before any '|'"""
+    words = header.split('|')[0].split()
+    return words[0] if words else 'complex'
+
+
+def validateSequence(sequence, entityType, recordName=''):
+    if not sequence:
+        raise Exception(f"Empty sequence in fasta record {recordName}")
+    invalid = set(sequence.upper()) - VALID_LETTERS.get(entityType, set(sequence.upper()))
+    if invalid:
+        raise Exception(f"Invalid characters {', '.join(sorted(invalid))} in the {entityType} sequence of "
+                        f"fasta record {recordName}")
+
+
+def iterFastaEntities(fastaPath):
+    """Yields the validated (name, entityType, sequence) of the records of a fasta file.
+    Records with no name are named seq<i>"""
+    for i, (header, sequence) in enumerate(iterFastaRecords(fastaPath)):
+        name = getHeaderName(header) or f'seq{i + 1}'
+        entityType = getHeaderEntity(header, sequence)
+        validateSequence(sequence, entityType, name)
+        yield name, entityType, sequence
+
+
+def iterFastaComplexes(fastaPath):
+    """Splits a multi-complex fasta in its complexes, yielding (complexName, [(entityType, sequence)]).
+    The records of a complex must be consecutive, so only one complex is kept in memory"""
+    complexName, entities = None, []
+    for header, sequence in iterFastaRecords(fastaPath):
+        entityType = getHeaderEntity(header, sequence)
+        validateSequence(sequence, entityType, header)
+        name = getComplexName(header)
+        if name != complexName and entities:
+            yield complexName, entities
+            entities = []
+        complexName = name
+        entities.append((entityType, sequence))
+    if entities:
+        yield complexName, entities
+
+
+def writeFastaRecord(f, header, sequence):
+    f.write(f">{header}\n")
+    for i in range(0, len(sequence), FASTA_WIDTH):
+        f.write(sequence[i:i + FASTA_WIDTH] + "\n")
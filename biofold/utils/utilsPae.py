@@ -0,0 +1,194 @@
+# **************************************************************************
+# *
+# * Authors:   Blanca Pueche (blanca.pueche@cnb.csis.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import json
+import math
+import shutil
+import tempfile
+
+import numpy as np
+import os
+
+from biofold.utils.utilsConfidence import ATOM_SITE_CATEGORY, readCifLoops, getFirstColumn, getMatrixFile
+
+# Side of the tiles read by the PAE viewer. The coarsest level of a pyramid fits in one tile
+PAE_TILE_SIZE = 256
+# Rows of a matrix processed at once when building its pyramid
+PAE_STRIPE_ROWS = 1024
+PYRAMID_INFO = 'pyramid.json'
+TOKEN_COLUMNS = ['group_PDB', 'auth_asym_id', 'label_asym_id', 'auth_seq_id', 'label_seq_id', 'pdbx_PDB_model_num']
+
+
+def getMatrixFiles(modelFile, key='pae'):
+    """Files the key matrix (pae or pde) of a model can be in: written by boltz (--write_full_pae), by the chai batch
+    script or by the import of AlphaFold3/Protenix full_data files"""
+    folder, name = os.path.dirname(modelFile), os.path.splitext(os.path.basename(modelFile))[0]
+    return [os.path.join(folder, f'{key}_{name}.npz'),
+            os.path.join(folder, f"{name.replace('pred.', f'{key}.', 1)}.npy"),
+            getMatrixFile(modelFile, key)]
+
+
+def findMatrixFile(modelFile, key='pae'):
+    for matrixFile in getMatrixFiles(modelFile, key):
+        if os.path.exists(matrixFile):
+            return matrixFile
+
+
+def loadMatrix(matrixFile, key='pae'):
+    """Memory-maps a .npy matrix, loads a .npz one (boltz writes them compressed)"""
+    if matrixFile.endswith('.npy'):
+        return np.load(matrixFile, mmap_mode='r')
+    with np.load(matrixFile) as data:
+        return data[key] if key in data.files else data[data.files[0]]
+
+
+def getChainTokens(structFile):
+    """Returns the [(chain, nTokens)] of the first model of a structure, in token order: one token per residue of
+    the polymers (ATOM) and one per atom of the other molecules (HETATM), as AlphaFold3, boltz and chai tokenize"""
+    if structFile.lower().endswith('.cif'):
+        table = readCifLoops(structFile, {ATOM_SITE_CATEGORY: TOKEN_COLUMNS}).get(ATOM_SITE_CATEGORY, {})
+        if 'pdbx_PDB_model_num' in table:
+            table = {column: values[table['pdbx_PDB_model_num'] == table['pdbx_PDB_model_num'][0]]
+                     for column, values in table.items()}
+        groups = table.get('group_PDB')
+        chains = getFirstColumn(table, ['label_asym_id', 'auth_asym_id'])
+        residues = getFirstColumn(table, ['label_seq_id', 'auth_seq_id'])
+    else:
+        records = []
+        with open(structFile) as f:
+            for line in f:
+                if line.startswith(('ATOM', 'HETATM')):
+                    records.append((line[:6].strip(), line[21], line[22:27].strip()))
+                elif line.startswith('ENDMDL'):
+                    break
+        groups, chains, residues = (np.array(column) for column in zip(*records)) if records else (None,) * 3
+
+    if groups is None or chains is None or residues is None or not len(groups):
+        return []
+
+    # A new token on every HETATM atom and on every change of polymer residue
+    keys = np.char.add(np.char.add(chains.astype(str), '\x00'), residues.astype(str))
+    newToken = np.ones(len(keys), dtype=bool)
+    newToken[1:] = (keys[1:] != keys[:-1]) | (groups[1:] == 'HETATM')
+    tokenChains = chains[newToken]
+    newChain = np.flatnonzero(np.r_[True, tokenChains[1:] != tokenChains[:-1]])
+    counts = np.diff(np.r_[newChain, len(tokenChains)])
+    return [(str(tokenChains[start]), int(count)) for start, count in zip(newChain, counts)]
+
+
+def getPyramidDir(matrixFile):
+    return f'{os.path.splitext(matrixFile)[0]}_tiles'
+
+
+def downsampleLevel(src, dst, stripeRows=PAE_STRIPE_ROWS):
+    """Writes in dst the 2x2 block means of src, stripe by stripe (the last row and column are kept if odd)"""
+    for start in range(0, len(src), 2 * stripeRows):
+        block = np.asarray(src[start:start + 2 * stripeRows], dtype=np.float32)
+        if len(block) % 2:
+            block = np.vstack([block, block[-1:]])
+        if block.shape[1] % 2:
+            block = np.hstack([block, block[:, -1:]])
+        dst[start // 2:start // 2 + len(block) // 2] = \
+            block.reshape(len(block) // 2, 2, block.shape[1] // 2, 2).mean(axis=(1, 3))
+
+
+def buildPyramid(matrixFile, key='pae', structFile=None, tileSize=PAE_TILE_SIZE):
+    """Builds once, next to the matrix, its multiresolution pyramid of float16 .npy levels: level 0 is the full
+    matrix and each level halves the previous one, down to one tile. The chain blocks of the model are stored with
+    it if its token count matches the matrix. Returns the pyramid folder"""
+    pyramidDir = getPyramidDir(matrixFile)
+    if os.path.exists(os.path.join(pyramidDir, PYRAMID_INFO)):
+        return pyramidDir
+
+    tmpDir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(matrixFile)), prefix='.tiles_')
+    try:
+        matrix = loadMatrix(matrixFile, key)
+        if matrix.ndim == 3:
+            # One matrix per sample
+            matrix = matrix[0]
+        if isinstance(matrix, np.memmap) and matrix.dtype == np.float16 and matrix.ndim == 2:
+            # Level 0 is the stored matrix itself
+            levels, src = [os.path.relpath(matrixFile, pyramidDir)], matrix
+        else:
+            levels, src = ['level_0.npy'], np.lib.format.open_memmap(os.path.join(tmpDir, 'level_0.npy'), mode='w+',
+                                                                      dtype=np.float16, shape=matrix.shape)
+            for start in range(0, len(matrix), PAE_STRIPE_ROWS):
+                src[start:start + PAE_STRIPE_ROWS] = matrix[start:start + PAE_STRIPE_ROWS]
+        while max(src.shape) > tileSize:
+            levels.append(f'level_{len(levels)}.npy')
+            dst = np.lib.format.open_memmap(os.path.join(tmpDir, levels[-1]), mode='w+', dtype=np.float16,
+                                            shape=tuple(math.ceil(side / 2) for side in src.shape))
+            downsampleLevel(src, dst)
+            dst.flush()
+            src = dst
+
+        chains = getChainTokens(structFile) if structFile else []
+        if sum(count for _, count in chains) != matrix.shape[0]:
+            chains = []
+        with open(os.path.join(tmpDir, PYRAMID_INFO), 'w') as f:
+            json.dump({'key': key, 'shape': list(matrix.shape), 'levels': levels, 'tileSize': tileSize,
+                       'chains': chains}, f)
+        # Pyramid left incomplete by an interrupted viewer
+        shutil.rmtree(pyramidDir, ignore_errors=True)
+        os.replace(tmpDir, pyramidDir)
+    except OSError:
+        # Built meanwhile by another viewer
+        if not os.path.exists(os.path.join(pyramidDir, PYRAMID_INFO)):
+            raise
+    finally:
+        shutil.rmtree(tmpDir, ignore_errors=True)
+    return pyramidDir
+
+
+class PaePyramid:
+    """
+    Read access to a PAE/PDE pyramid: the levels are memory-mapped, so reading a region only reads the pages
+    (tiles) of the level it is shown at.
+    """
+    def __init__(self, pyramidDir):
+        with open(os.path.join(pyramidDir, PYRAMID_INFO)) as f:
+            info = json.load(f)
+        self.key, self.shape, self.tileSize, self.chains = info['key'], info['shape'], info['tileSize'], info['chains']
+        self.levels = [np.load(os.path.join(pyramidDir, level), mmap_mode='r') for level in info['levels']]
+
+    def getChainBoundaries(self):
+        """Token indexes where each chain starts, but the first one"""
+        return list(np.cumsum([count for _, count in self.chains])[:-1])
+
+    def getLevel(self, span, pixels):
+        """Coarsest level with at least one value per screen pixel for a region of span tokens"""
+        level = int(math.floor(math.log2(max(span / max(pixels, 1), 1))))
+        return min(level, len(self.levels) - 1)
+
+    def read(self, rows, cols, pixels):
+        """Values of the (first, last) rows and columns region at the resolution of the pixels it is shown in.
+        Returns the values and the region they cover, as a matplotlib (left, right, bottom, top) extent"""
+        level = self.getLevel(max(rows[1] - rows[0], cols[1] - cols[0]), pixels)
+        scale, data = 2 ** level, self.levels[level]
+        r0, r1 = max(0, int(rows[0] // scale)), min(data.shape[0], int(math.ceil(rows[1] / scale)))
+        c0, c1 = max(0, int(cols[0] // scale)), min(data.shape[1], int(math.ceil(cols[1] / scale)))
+        values = np.asarray(data[r0:r1, c0:c1], dtype=np.float32)
+        extent = (c0 * scale, min(c1 * scale, self.shape[1]), min(r1 * scale, self.shape[0]), r0 * scale)
+        return values, extent
@@ -0,0 +1,139 @@
+# **************************************************************************
+# *
+# * Authors:   Blanca Pueche (blanca.pueche@cnb.csis.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import re
+import subprocess
+
+import os
+
+# Rough memory model of a boltz-2 prediction, fitted to be on the safe side (GB).
+# The trunk (pair representation and triangular updates) grows with tokens^2, the MSA module with
+# depth * tokens and every diffusion sample run in parallel adds its own tokens^2 pair bias.
+MODEL_GB = 6.0
+TRUNK_GB_PER_TOKEN2 = 3.0e-6
+MSA_GB_PER_SEQ_TOKEN = 1.5e-7
+SAMPLE_GB_PER_TOKEN2 = 6.0e-7
+HOST_BASE_GB = 8.0
+HOST_GB_PER_TOKEN2 = 1.0e-6
+# Fraction of the device memory the plan can use, the rest is left to CUDA context and fragmentation
+MEMORY_MARGIN = 0.9
+DEFAULT_GPU_GB = 24.0
+
+SUBSAMPLED_MSA_SIZES = [1024, 512, 256, 128]
+CCD_TOKENS = 30
+SMILES_ATOM = re.compile(r'\[[^\]]+\]|Br|Cl|[BCNOPSFI]|[bcnops]')
+
+
+def countSmilesAtoms(smiles):
+    """Heavy atoms of a SMILES, each ligand atom is a boltz token"""
+    return len([atom for atom in SMILES_ATOM.findall(smiles) if not atom.startswith('[H')])
+
+
+def countTokens(sequences):
+    """Number of tokens of a boltz input sequences list (one per residue/nucleotide, one per ligand atom)"""
+    tokens = 0
+    for item in sequences:
+        entityType, body = next(iter(item.items()))
+        copies = len(body["id"]) if isinstance(body["id"], list) else 1
+        if body.get("sequence"):
+            tokens += copies * len(body["sequence"])
+        elif body.get("smiles"):
+            tokens += copies * countSmilesAtoms(body["smiles"])
+        else:
+            tokens += copies * CCD_TOKENS
+    return tokens
+
+
+def countYamlTokens(yamlFile):
+    """Approximate number of tokens of a boltz YAML not written by biofold (copies are not considered)"""
+    tokens = 0
+    with open(yamlFile) as f:
+        for line in f:
+            match = re.match(r'\s*(sequence|smiles|ccd):\s*["\']?([^"\'\s]+)', line)
+            if match:
+                key, value = match.groups()
+                tokens += len(value) if key == 'sequence' else \
+                    countSmilesAtoms(value) if key == 'smiles' else CCD_TOKENS
+    return tokens
+
+
+def getGpuMemory(devices):
+    """Total memory (GB) of the smallest of the devices, None if it cannot be queried"""
+    try:
+        output = subprocess.run(['nvidia-smi', '--query-gpu=memory.total', '--format=csv,noheader,nounits',
+                                 '-i', ','.join(map(str, devices))],
+                                capture_output=True, text=True, check=True, timeout=30).stdout
+        return min(float(line) for line in output.split()) / 1024
+    except (OSError, subprocess.SubprocessError, ValueError):
+        return None
+
+
+def getHostMemory():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 3
+
+
+def estimateGpuMemory(tokens, msaDepth, parallelSamples):
+    return MODEL_GB + TRUNK_GB_PER_TOKEN2 * tokens ** 2 + MSA_GB_PER_SEQ_TOKEN * msaDepth * tokens + \
+           parallelSamples * SAMPLE_GB_PER_TOKEN2 * tokens ** 2
+
+
+def estimateHostMemory(tokens):
+    return HOST_BASE_GB + HOST_GB_PER_TOKEN2 * tokens ** 2
+
+
+def planBoltzLaunch(tokens, samples, gpuMemory=None, hostMemory=None, threads=1, useGpu=True):
+    """Chooses the fastest boltz launch settings whose estimated peak memory fits in the device:
+    as many parallel diffusion samples as possible with the deepest subsampled MSA that fits"""
+    hostMemory = hostMemory or getHostMemory()
+    budget = MEMORY_MARGIN * (gpuMemory or DEFAULT_GPU_GB)
+    plan = {'tokens': tokens, 'accelerator': 'gpu' if useGpu else 'cpu',
+            'num_workers': max(0, min(threads - 1, 4)), 'gpu_memory': gpuMemory,
+            'max_parallel_samples': 1, 'num_subsampled_msa': SUBSAMPLED_MSA_SIZES[0], 'fits': True}
+
+    if useGpu:
+        fitting = [msaSize for msaSize in SUBSAMPLED_MSA_SIZES if estimateGpuMemory(tokens, msaSize, 1) <= budget]
+        if fitting:
+            msaSize = fitting[0]
+            parallel = 1
+            while parallel < samples and estimateGpuMemory(tokens, msaSize, parallel + 1) <= budget:
+                parallel += 1
+            plan.update({'num_subsampled_msa': msaSize, 'max_parallel_samples': parallel})
+        elif estimateHostMemory(tokens) <= MEMORY_MARGIN * hostMemory:
+            # Too big for the device, but it can still run (slowly) on the host
+            plan['accelerator'] = 'cpu'
+        else:
+            plan.update({'num_subsampled_msa': SUBSAMPLED_MSA_SIZES[-1], 'fits': False})
+
+    plan['estimated_gpu_memory'] = estimateGpuMemory(tokens, plan['num_subsampled_msa'], plan['max_parallel_samples'])\
+        if plan['accelerator'] == 'gpu' else 0.0
+    plan['estimated_host_memory'] = estimateHostMemory(tokens)
+    return plan
+
+
+def getPlanArgs(plan):
+    return [f"--accelerator {plan['accelerator']}",
+            f"--max_parallel_samples {plan['max_parallel_samples']}",
+            f"--num_subsampled_msa {plan['num_subsampled_msa']}",
+            f"--num_workers {plan['num_workers']}"]
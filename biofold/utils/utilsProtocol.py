@@ -0,0 +1,104 @@
+# **************************************************************************
+# *
+# * Authors:   Blanca Pueche (blanca.pueche@cnb.csis.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import re
+
+from pwchem import Plugin
+
+from biofold.constants import BIOFOLD_CACHE, MSA_CACHE_SIZE, PREDICTION_CACHE_SIZE, WEIGHTS_DIR, BIOFOLD_OFFLINE, \
+    OFFLINE_ENVIRON
+from biofold.utils.utilsCache import FileCache, WeightsCache
+from biofold.utils.utilsConfidence import CONFIDENCE_TABLE
+from biofold.utils.utilsResume import CompletionMarkers
+from biofold.utils.utilsScheduler import CPU_DEVICE, parseGpuList, runCondaJob
+from biofold.utils.utilsScores import ScoreStore
+
+
+def getUniqueJobName(name, usedNames, default='complex'):
+    """Job name of the name (as a file name) not in usedNames, which it is added to"""
+    jobName = re.sub(r'[^\w.-]', '_', name) or default
+    baseName, i = jobName, 1
+    while jobName in usedNames:
+        jobName = f"{baseName}_{i}"
+        i += 1
+    usedNames.add(jobName)
+    return jobName
+
+
+class ScoredModelsMixin:
+    """
+    Score store and confidence table of the protocols registering scored models
+    """
+    def getScoreStore(self):
+        return ScoreStore(self._getExtraPath('scores.sqlite'))
+
+    def getConfidenceTableFile(self):
+        return self._getExtraPath(CONFIDENCE_TABLE)
+
+
+class PredictionMixin(ScoredModelsMixin):
+    """
+    Devices, completion markers and site caches of the prediction protocols.
+    Protocols set _engineDic (BOLTZ_DIC, CHAI_DIC) and have the useGpu and gpuList params
+    """
+    _engineDic = None
+
+    def getDevices(self):
+        if not self.useGpu.get():
+            return [CPU_DEVICE]
+        return parseGpuList(self.gpuList.get()) or ['0']
+
+    def getDeviceStatsFile(self):
+        return self._getExtraPath('device_stats.json')
+
+    def getMarkers(self):
+        return CompletionMarkers(self._getExtraPath('done'))
+
+    def getMsaCache(self):
+        return FileCache(os.path.join(Plugin.getVar(BIOFOLD_CACHE), 'msa'), MSA_CACHE_SIZE)
+
+    def getResultCache(self):
+        return FileCache(os.path.join(Plugin.getVar(BIOFOLD_CACHE), 'predictions'), PREDICTION_CACHE_SIZE)
+
+    def getWeightsCache(self):
+        return WeightsCache(os.path.join(Plugin.getVar(BIOFOLD_CACHE), WEIGHTS_DIR, self._engineDic['name']))
+
+    def isOffline(self):
+        return str(Plugin.getVar(BIOFOLD_OFFLINE)).lower() in ('true', 'yes', '1')
+
+    def getJobEnviron(self):
+        """Environment of the prediction jobs, None to inherit the protocol one"""
+        return dict(os.environ, **OFFLINE_ENVIRON) if self.isOffline() else None
+
+    def prefetchWeights(self):
+        """Downloads the model weights into the shared weights cache (in the environment of the engine)"""
+        scriptPath = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "scripts", "prefetchWeights.py"))
+        runCondaJob(
+            Plugin.getEnvActivationCommand(self._engineDic),
+            program=f"python {scriptPath}",
+            args=f"{self._engineDic['name']} {self.getWeightsCache().root}",
+            logFile=os.path.abspath(self._getPath('logs', 'prefetch_weights.log'))
+        )
@@ -0,0 +1,95 @@
+# **************************************************************************
+# *
+# * Authors:   Blanca Pueche (blanca.pueche@cnb.csis.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import json
+import zipfile
+
+import os
+
+
+def isValidStructure(structFile):
+    """Whether the CIF/PDB file is complete enough to be registered: it has atom records
+    (and the _atom_site loop they belong to, for CIF files)"""
+    if not os.path.exists(structFile) or not os.path.getsize(structFile):
+        return False
+
+    isCif, hasLoop = structFile.lower().endswith('.cif'), False
+    with open(structFile, errors='replace') as f:
+        for line in f:
+            if line.startswith('_atom_site.'):
+                hasLoop = True
+            elif line.startswith(('ATOM', 'HETATM')) and (hasLoop or not isCif):
+                return True
+    return False
+
+
+def isValidJson(jsonFile):
+    try:
+        with open(jsonFile) as f:
+            json.load(f)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def isValidBoltzPrediction(predFolder):
+    """A boltz predictions/<job> folder is valid if every CIF model is parseable and has its confidence file"""
+    if not os.path.isdir(predFolder):
+        return False
+    cifFiles = [name for name in os.listdir(predFolder) if name.lower().endswith('.cif')]
+    return bool(cifFiles) and all(
+        isValidStructure(os.path.join(predFolder, name)) and
+        isValidJson(os.path.join(predFolder, f'confidence_{os.path.splitext(name)[0]}.json'))
+        for name in cifFiles)
+
+
+def isValidChaiPrediction(resultsDir):
+    """A chai output folder is valid if every CIF model is parseable and has its scores npz"""
+    if not os.path.isdir(resultsDir):
+        return False
+    cifFiles = [name for name in os.listdir(resultsDir) if name.lower().endswith('.cif')]
+    return bool(cifFiles) and all(
+        isValidStructure(os.path.join(resultsDir, name)) and
+        zipfile.is_zipfile(os.path.join(resultsDir, name.replace('pred.', 'scores.').replace('.cif', '.npz')))
+        for name in cifFiles)
+
+
+class CompletionMarkers:
+    """Per-target completion markers, so resumed runs only resubmit the targets with no valid output"""
+    def __init__(self, markersDir):
+        self.markersDir = markersDir
+        os.makedirs(markersDir, exist_ok=True)
+
+    def getMarker(self, target):
+        return os.path.join(self.markersDir, f'{target}.done')
+
+    def isDone(self, target):
+        return os.path.exists(self.getMarker(target))
+
+    def markDone(self, target):
+        open(self.getMarker(target), 'w').close()
+
+    def getDone(self):
+        return {name[:-len('.done')] for name in os.listdir(self.markersDir) if name.endswith('.done')}
@@ -0,0 +1,140 @@
+# **************************************************************************
+# *
+# * Authors:   Blanca Pueche (blanca.pueche@cnb.csis.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import json
+import re
+import subprocess
+import threading
+import time
+from collections import deque
+
+import os
+
+CPU_DEVICE = 'cpu'
+
+
+def parseGpuList(gpuList):
+    """Returns the list of device ids in a comma (or space) separated gpuList string"""
+    return [gpu for gpu in re.split(r'[,\s]+', gpuList or '') if gpu]
+
+
+def splitInShards(items, nShards, cost=None):
+    """Splits the items in at most nShards lists, longest first, balancing the accumulated cost of each shard"""
+    cost = cost or (lambda item: 1)
+    items = sorted(items, key=cost, reverse=True)
+    nShards = max(1, min(nShards, len(items)))
+    shards, loads = [[] for _ in range(nShards)], [0] * nShards
+    for item in items:
+        idx = loads.index(min(loads))
+        shards[idx].append(item)
+        loads[idx] += cost(item)
+    # Largest shards first, so the small ones fill the tail of the queue
+    return sorted([shard for shard in shards if shard], key=lambda shard: sum(map(cost, shard)), reverse=True)
+
+
+def getDeviceEnviron(device, env=None):
+    """Returns a copy of the environment restricted to the given device, leaving os.environ untouched"""
+    env = dict(os.environ if env is None else env)
+    if device is not None and device != CPU_DEVICE:
+        env['CUDA_VISIBLE_DEVICES'] = str(device)
+    return env
+
+
+def runCondaJob(activationCmd, program, args, device=None, cwd=None, logFile=None, env=None):
+    """Runs program in its conda environment in a subprocess with its own device environment"""
+    command = f'{activationCmd} && {program} {args}'
+    with open(logFile, 'a') if logFile else open(os.devnull, 'w') as log:
+        log.write(f'{command}\n')
+        log.flush()
+        subprocess.run(command, shell=True, executable='/bin/bash', check=True, cwd=cwd,
+                       env=getDeviceEnviron(device, env), stdout=log, stderr=subprocess.STDOUT)
+
+
+class DeviceScheduler:
+    """
+    Runs a queue of jobs over a pool of devices, with one worker thread (and one subprocess at a time) per device.
+    Devices pull the next pending job from the shared queue as soon as they are idle, so a long job only keeps
+    its own device busy while the rest of the queue is consumed by the others.
+    """
+    def __init__(self, devices):
+        self.devices = list(devices) or [CPU_DEVICE]
+        self.stats = {}
+        self.wallTime = 0.0
+
+    def run(self, jobs, runner):
+        """Runs runner(device, job) for every job. Returns the list of (job, exception) of the failed ones"""
+        queue, lock, errors = deque(jobs), threading.Lock(), []
+        startTime = time.time()
+
+        def deviceWorker(device):
+            busyTime, nJobs = 0.0, 0
+            while True:
+                with lock:
+                    if not queue:
+                        break
+                    job = queue.popleft()
+
+                jobStart = time.time()
+                try:
+                    runner(device, job)
+                except Exception as e:
+                    with lock:
+                        errors.append((job, e))
+                busyTime += time.time() - jobStart
+                nJobs += 1
+
+            with lock:
+                devStats = self.stats.setdefault(str(device), {'jobs': 0, 'busy': 0.0})
+                devStats['jobs'] += nJobs
+                devStats['busy'] += busyTime
+
+        threads = [threading.Thread(target=deviceWorker, args=(device,), daemon=True) for device in self.devices]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.wallTime += max(time.time() - startTime, 1e-6)
+        for devStats in self.stats.values():
+            devStats['wall'] = self.wallTime
+            devStats['utilisation'] = devStats['busy'] / self.wallTime
+        return errors
+
+    def writeStats(self, statsFile):
+        with open(statsFile, 'w') as f:
+            json.dump(self.stats, f, indent=2)
+
+
+def getDeviceSummary(statsFile):
+    """Returns the summary lines with the per-device utilisation stored in statsFile"""
+    summary = []
+    if os.path.exists(statsFile):
+        with open(statsFile) as f:
+            stats = json.load(f)
+        summary.append("Device utilisation:")
+        for device, devStats in sorted(stats.items()):
+            summary.append(f"  {device}: {devStats['jobs']} jobs, busy {devStats['busy']:.1f} s "
+                           f"({100 * devStats['utilisation']:.0f}%)")
+    return summary
@@ -0,0 +1,247 @@
+# **************************************************************************
+# *
+# * Authors:   Blanca Pueche (blanca.pueche@cnb.csis.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import json
+import re
+import sqlite3
+
+import numpy as np
+import os
+
+# Boltz confidence_*.json keys registered as attributes of the predicted AtomStructs
+BOLTZ_SCORES = {'confidence_score': 'confidenceScore', 'ptm': 'ptm', 'iptm': 'iptm', 'complex_plddt': 'complexPlddt'}
+BOLTZ_RANK_SCORE = 'confidence_score'
+# Boltz affinity_*.json keys, the table of a ligand screening is sorted by the binder probability
+BOLTZ_AFFINITY_SCORES = {'affinity_pred_value': 'affinityPred', 'affinity_probability_binary': 'affinityProbability'}
+BOLTZ_AFFINITY_RANK_SCORE = 'affinity_probability_binary'
+# Chai scores.model_idx_*.npz keys registered as attributes of the predicted AtomStructs, ranked as chai does
+CHAI_SCORES = {'aggregate_score': 'aggregateScore', 'ptm': 'ptm', 'iptm': 'iptm',
+               'has_inter_chain_clashes': 'hasClashes'}
+CHAI_RANK_SCORE = 'aggregate_score'
+# chai scores with one flag per chain, reduced to whether any chain has it
+CHAI_CHAIN_FLAGS = ('has_inter_chain_clashes',)
+# AlphaFold3/Protenix summary_confidence(s) keys registered as attributes of the imported AtomStructs, ranked as
+# the servers do. chain_pair_iptm is kept in the score store only
+AF3_SCORES = {'ranking_score': 'rankingScore', 'ptm': 'ptm', 'iptm': 'iptm',
+              'fraction_disordered': 'fractionDisordered', 'has_clash': 'hasClash'}
+AF3_RANK_SCORE = 'ranking_score'
+AF3_CHAIN_PAIR_SCORE = 'chain_pair_iptm'
+# Mean per-residue pLDDT, ranking score of the models with no score files of their engine
+PLDDT_SCORE = 'mean_plddt'
+# Prefixes of the files boltz names after the job in predictions/<job>
+BOLTZ_FILE_PREFIXES = ('confidence_', 'pre_affinity_', 'affinity_', 'plddt_', 'pae_', 'pde_', '')
+
+
+def readJsonScores(jsonFile, keys):
+    """Reads the numeric scores of the given keys in a small JSON score file (missing keys are None)"""
+    with open(jsonFile) as f:
+        return getNumericScores(json.load(f), keys)
+
+
+def getNumericScores(data, keys):
+    return {key: (float(data[key]) if isinstance(data.get(key), (int, float)) else None) for key in keys}
+
+
+def readSummaryConfidences(jsonFile):
+    """Reads the scores of an AlphaFold3/Protenix summary_confidence(s) JSON file, with its chain pair ipTM matrix"""
+    with open(jsonFile) as f:
+        data = json.load(f)
+    scores = getNumericScores(data, AF3_SCORES)
+    if data.get(AF3_CHAIN_PAIR_SCORE) is not None:
+        scores[AF3_CHAIN_PAIR_SCORE] = data[AF3_CHAIN_PAIR_SCORE]
+    return scores
+
+
+def readNpzScores(npzFile, keys, flagKeys=()):
+    """Reads the given keys of a npz score file, loading only those members. Arrays are reduced to their first
+    value, but the per chain flags of flagKeys, reduced to whether any of them is set"""
+    scores = {}
+    with np.load(npzFile) as data:
+        for key in keys:
+            if key not in data.files:
+                scores[key] = None
+            elif key in flagKeys:
+                scores[key] = float(np.any(data[key]))
+            else:
+                scores[key] = float(np.asarray(data[key]).ravel()[0])
+    return scores
+
+
+def getModelIndex(fileName):
+    match = re.search(r'model_(?:idx_)?(\d+)', fileName)
+    return int(match.group(1)) if match else 0
+
+
+def getBoltzModels(predFolder):
+    """Returns the [(cifFile, scores)] of every diffusion sample in a boltz predictions/<job> folder,
+    with the scores parsed from its confidence_<job>_model_<i>.json"""
+    jobName, models = os.path.basename(predFolder), []
+    for fileName in sorted(os.listdir(predFolder), key=getModelIndex):
+        if not fileName.lower().endswith('.cif'):
+            continue
+        modelName = os.path.splitext(fileName)[0]
+        confFile = os.path.join(predFolder, f'confidence_{modelName}.json')
+        if not os.path.exists(confFile):
+            confFile = os.path.join(predFolder, f'confidence_{jobName}_model_{getModelIndex(fileName)}.json')
+        scores = readJsonScores(confFile, BOLTZ_SCORES) if os.path.exists(confFile) else {}
+        models.append((os.path.join(predFolder, fileName), scores))
+    return models
+
+
+def getChaiModels(resultsDir):
+    """Returns the [(cifFile, scores)] of every model in a chai output folder, with the scores parsed from its
+    scores.model_idx_<i>.npz"""
+    models = []
+    for fileName in sorted(os.listdir(resultsDir), key=getModelIndex):
+        if not fileName.lower().endswith('.cif'):
+            continue
+        npzFile = os.path.join(resultsDir, f'scores.model_idx_{getModelIndex(fileName)}.npz')
+        scores = readNpzScores(npzFile, CHAI_SCORES, CHAI_CHAIN_FLAGS) if os.path.exists(npzFile) else {}
+        models.append((os.path.join(resultsDir, fileName), scores))
+    return models
+
+
+def renameBoltzFile(fileName, oldJob, newJob):
+    """Renames a file of a boltz predictions/<oldJob> folder as if it had been predicted in job newJob"""
+    for prefix in BOLTZ_FILE_PREFIXES:
+        rest = fileName[len(prefix) + len(oldJob):]
+        if fileName.startswith(prefix + oldJob) and (rest.startswith('_model_') or rest.startswith('.')):
+            return prefix + newJob + rest
+    return fileName
+
+
+def getBestModel(models, scoreKey):
+    """Returns the (file, scores) with the highest scoreKey (the first model if none is scored)"""
+    return max(models, key=lambda model: model[1].get(scoreKey) if model[1].get(scoreKey) is not None
+               else float('-inf'))
+
+
+def getBoltzAffinity(predFolder):
+    """Returns the affinity scores of a boltz predictions/<job> folder ({} if no affinity was predicted)"""
+    affFile = os.path.join(predFolder, f'affinity_{os.path.basename(predFolder)}.json')
+    return readJsonScores(affFile, BOLTZ_AFFINITY_SCORES) if os.path.exists(affFile) else {}
+
+
+def writeScoresTable(rows, columns, tableFile, sortKey=None):
+    """Writes the score rows (dictionaries) in a tab separated table sorted by sortKey (descending)"""
+    if sortKey:
+        rows = sorted(rows, key=lambda row: row.get(sortKey) if row.get(sortKey) is not None else float('-inf'),
+                      reverse=True)
+    with open(tableFile, 'w') as f:
+        f.write('\t'.join(columns) + '\n')
+        for row in rows:
+            f.write('\t'.join('' if row.get(col) is None else str(row[col]) for col in columns) + '\n')
+    return rows
+
+
+class ScoreStore:
+    """
+    Per-protocol SQLite store of the scores of the predicted models, written once by the scoring step and queried
+    by the output step, the summary and the viewers (with no log or model parsing).
+    Each model is a row with its file, job, ranking score and all its scores (JSON).
+    """
+    def __init__(self, dbFile):
+        self.dbFile = dbFile
+
+    def exists(self):
+        return os.path.exists(self.dbFile)
+
+    def connect(self):
+        conn = sqlite3.connect(self.dbFile)
+        conn.execute('CREATE TABLE IF NOT EXISTS models (file TEXT PRIMARY KEY, job TEXT, rank REAL, scores TEXT)')
+        conn.execute('CREATE INDEX IF NOT EXISTS models_job ON models (job, rank)')
+        conn.execute('CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)')
+        return conn
+
+    def setModels(self, models, rankKey, job=''):
+        """Replaces the [(file, scores)] models of the job, ranked by their rankKey score"""
+        with self.connect() as conn:
+            conn.execute('DELETE FROM models WHERE job = ?', (job,))
+            conn.executemany('INSERT OR REPLACE INTO models VALUES (?, ?, ?, ?)',
+                             [(modelFile, job, scores.get(rankKey), json.dumps(scores)) for modelFile, scores in models])
+        conn.close()
+
+    def query(self, sql, args=()):
+        if not self.exists():
+            return []
+        conn = self.connect()
+        try:
+            return [(modelFile, job, json.loads(scores)) for modelFile, job, scores in conn.execute(sql, args)]
+        finally:
+            conn.close()
+
+    def getModels(self, job=None, limit=-1, offset=0):
+        """Returns the [(file, job, scores)] of the models (of the job if given) from best to worst.
+        limit and offset select a page of them"""
+        where, args = ('WHERE job = ?', (job,)) if job is not None else ('', ())
+        return self.query(f'SELECT file, job, scores FROM models {where} '
+                          f'ORDER BY rank IS NULL, rank DESC, file LIMIT ? OFFSET ?', args + (limit, offset))
+
+    def getBestModel(self, job=None):
+        models = self.getModels(job, limit=1)
+        return models[0] if models else None
+
+    def getBestModels(self):
+        """Returns the (file, job, scores) of the best model of every job"""
+        return self.query('SELECT file, job, scores FROM models AS m WHERE file = (SELECT file FROM models '
+                          'WHERE job = m.job ORDER BY rank IS NULL, rank DESC, file LIMIT 1) ORDER BY job')
+
+    def getTopJobModels(self, limit=-1, offset=0, firstScored=None):
+        """Returns the (file, job, scores) of the best model of every job, from the best ranked job.
+        If firstScored is given, the jobs whose best model has that score go first (jobs ranked by another score)"""
+        tier, args = ('json_extract(scores, ?) IS NULL, ', (f'$."{firstScored}"',)) if firstScored else ('', ())
+        return self.query('SELECT file, job, scores FROM models AS m WHERE file = (SELECT file FROM models '
+                          'WHERE job = m.job ORDER BY rank IS NULL, rank DESC, file LIMIT 1) '
+                          f'ORDER BY {tier}rank IS NULL, rank DESC, job LIMIT ? OFFSET ?', args + (limit, offset))
+
+    def count(self, sql):
+        if not self.exists():
+            return 0
+        conn = self.connect()
+        try:
+            return conn.execute(sql).fetchone()[0]
+        finally:
+            conn.close()
+
+    def countModels(self):
+        return self.count('SELECT COUNT(*) FROM models')
+
+    def countJobs(self):
+        return self.count('SELECT COUNT(DISTINCT job) FROM models')
+
+    def setInfo(self, key, value):
+        with self.connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO info VALUES (?, ?)', (key, json.dumps(value)))
+        conn.close()
+
+    def getInfo(self, key, default=None):
+        if not self.exists():
+            return default
+        conn = self.connect()
+        try:
+            row = conn.execute('SELECT value FROM info WHERE key = ?', (key,)).fetchone()
+            return json.loads(row[0]) if row else default
+        finally:
+            conn.close()
@@ -0,0 +1,124 @@
+# **************************************************************************
+# *
+# * Authors:   Blanca Pueche (blanca.pueche@cnb.csis.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import fcntl
+import json
+import socket
+import subprocess
+import tempfile
+import time
+
+import os
+
+from biofold.utils.utilsScheduler import getDeviceEnviron
+
+# Seconds a job waits for a message of the worker, which sends a heartbeat every 30 s while the job is queued or runs
+WORKER_HEARTBEAT_TIMEOUT = 120
+
+
+def getWorkerSocket(name, device):
+    """Node-local socket of the worker of a device (kept short, Unix socket paths are limited to ~100 chars)"""
+    return os.path.join(tempfile.gettempdir(), f'biofold_{os.getuid()}', f'{name}_{device}.sock')
+
+
+def sendRequest(socketPath, request, timeout=None):
+    """Sends a request to a worker and yields its JSON answers"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.settimeout(timeout)
+        conn.connect(socketPath)
+        conn.sendall((json.dumps(request) + '\n').encode())
+        with conn.makefile('r') as reader:
+            for line in reader:
+                yield json.loads(line)
+
+
+def isWorkerAlive(socketPath):
+    """Whether a worker process holds the pid lock of the socket (it may still be loading boltz)"""
+    pidFile = socketPath + '.pid'
+    if not os.path.exists(pidFile):
+        return False
+    with open(pidFile, 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        fcntl.flock(f, fcntl.LOCK_UN)
+    return False
+
+
+def pingWorker(socketPath, timeout=5):
+    """Health check: returns the worker status, or None if no worker is alive on the socket"""
+    if not os.path.exists(socketPath):
+        return None
+    try:
+        answer = next(sendRequest(socketPath, {'cmd': 'ping'}, timeout), None)
+    except (OSError, ValueError):
+        return None
+    return answer if answer and answer.get('status') == 'ok' else None
+
+
+def startWorker(activationCmd, scriptPath, socketPath, device, idleTimeout, cwd=None, logFile=None,
+                startTimeout=300, env=None):
+    """Starts a detached worker on the device unless one is already alive (answering or loading).
+    Returns whether it is ready"""
+    os.makedirs(os.path.dirname(socketPath), exist_ok=True)
+    with open(socketPath + '.lock', 'a') as lockFile:
+        # Only one protocol starts the worker of a device, the rest wait for it
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        if pingWorker(socketPath):
+            return True
+
+        if not isWorkerAlive(socketPath):
+            command = f'{activationCmd} && python {scriptPath} --socket {socketPath} --idle_timeout {idleTimeout}'
+            with open(logFile or os.devnull, 'a') as log:
+                subprocess.Popen(command, shell=True, executable='/bin/bash', cwd=cwd,
+                                 env=getDeviceEnviron(device, env), stdout=log, stderr=subprocess.STDOUT,
+                                 start_new_session=True)
+
+        deadline = time.time() + startTimeout
+        while time.time() < deadline:
+            if pingWorker(socketPath):
+                return True
+            time.sleep(2)
+    return False
+
+
+def submitJob(socketPath, args, outDir, onOutput=None, timeout=WORKER_HEARTBEAT_TIMEOUT):
+    """Runs a prediction in the worker, calling onOutput with every output folder. Returns the output folders.
+    Raises ConnectionError if the worker goes away or sends nothing (not even a heartbeat) for timeout seconds"""
+    outputs = []
+    try:
+        for answer in sendRequest(socketPath, {'cmd': 'predict', 'args': args, 'outDir': outDir}, timeout):
+            if answer['status'] == 'output':
+                outputs.append(answer['path'])
+                if onOutput:
+                    onOutput(answer['path'])
+            elif answer['status'] == 'error':
+                raise Exception(f"Worker job failed: {answer['message']}")
+            elif answer['status'] == 'done':
+                return outputs
+    except socket.timeout:
+        raise ConnectionError(f'Worker sent nothing for {timeout} s')
+    raise ConnectionError('Worker connection closed before the job finished')
@@ -4,4 +4,5 @@
 # Find documentation here: https://scipion-em.github.io/docs/docs/developer/creating-a-viewer
 # **************************************************************************
 
-from .viewer_alphafold3 import ProtAlphaFold3Viewer
+from .viewer_models import ProtBiofoldModelsViewer
+from .viewer_pae import ProtBiofoldPaeViewer
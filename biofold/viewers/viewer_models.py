@@ -0,0 +1,123 @@
+# **************************************************************************
+# *
+# * Authors:   Blanca Pueche (blanca.pueche@cnb.csis.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+
+import pyworkflow.protocol.params as params
+from pyworkflow.viewer import ProtocolViewer, DESKTOP_TKINTER
+
+from biofold.protocols import ProtocolTargets
+
+# ChimeraX palettes of the AlphaFold pLDDT colours, for pLDDT in [0, 100] and in [0, 1]
+PLDDT_PALETTE = 'alphafold'
+PLDDT_PALETTE_UNIT = '0,#ff7d45:0.5,#ff7d45:0.7,#ffdb13:0.9,#65cbf3:1,#0053d6'
+
+
+class ProtBiofoldModelsViewer(ProtocolViewer):
+    """ Opens a page of the predicted models in ChimeraX, from the best ranked one, aligned to the first model of
+    the page and coloured by pLDDT. The ChimeraX session of each page is saved and reopened while the scores of the
+    protocol do not change. """
+    _label = 'viewer predicted models'
+    _targets = ProtocolTargets('ProtImportPredictions', 'ProtBoltz', 'ProtChai')
+    _environments = [DESKTOP_TKINTER]
+
+    def _defineParams(self, form):
+        form.addSection(label='Predicted models')
+        form.addParam('modelsOrigin', params.EnumParam, default=0,
+                      label='Models: ', choices=['All models', 'Best model of each job'],
+                      help='All models: every model of the protocol (or of a job), from the best ranked one.\n'
+                           'Best model of each job: the best model of every job of a batch or bulk run.')
+        form.addParam('jobName', params.StringParam, default='', condition='modelsOrigin == 0',
+                      label='Job: ', help='Show only the models of this job. All the jobs if empty.')
+        form.addParam('nModels', params.IntParam, default=5,
+                      label='Models per page: ', help='Number of models opened in ChimeraX.')
+        form.addParam('page', params.IntParam, default=1,
+                      label='Page: ', help='Page of models to open, page 1 starts with the best ranked model.')
+        form.addParam('displayModels', params.LabelParam,
+                      label='Display models in ChimeraX: ')
+
+    def _getVisualizeDict(self):
+        return {'displayModels': self._showModels}
+
+    def _showModels(self, paramName=None):
+        store = self.protocol.getScoreStore()
+        modelFiles = self.getPageModels(store)
+        if not modelFiles:
+            return [self.errorMessage('No models found in this page.', title='No models')]
+
+        sessionFile = os.path.abspath(self.getViewerPath(f'{self.getPageName()}.cxs'))
+        fnCmd = self.getViewerPath(f'{self.getPageName()}.cxc')
+        # The session is valid while the score store (and so the ranking) does not change
+        if not os.path.exists(sessionFile) or os.path.getmtime(sessionFile) < os.path.getmtime(store.dbFile):
+            self.writeModelsCommands(fnCmd, modelFiles, sessionFile)
+        else:
+            with open(fnCmd, 'w') as f:
+                f.write(f"open {sessionFile}\n")
+
+        from pwem.viewers import Chimera
+        Chimera.runProgram(Chimera.getProgram(), fnCmd + "&")
+        return []
+
+    # --------------------------- UTILS functions -----------------------------------
+    def getPageModels(self, store):
+        first, nModels = (max(1, self.page.get()) - 1) * max(1, self.nModels.get()), max(1, self.nModels.get())
+        if self.modelsOrigin.get() == 1:
+            models = store.getTopJobModels(limit=nModels, offset=first)
+        else:
+            models = store.getModels(job=self.jobName.get() or None, limit=nModels, offset=first)
+        return [os.path.abspath(modelFile) for modelFile, _, _ in models]
+
+    def getPageName(self):
+        job = self.jobName.get() if self.modelsOrigin.get() == 0 and self.jobName.get() else 'all'
+        origin = 'best' if self.modelsOrigin.get() == 1 else job
+        return f'models_{origin}_{max(1, self.nModels.get())}_{max(1, self.page.get())}'
+
+    def getViewerPath(self, fileName):
+        viewerDir = self.protocol._getExtraPath('viewer')
+        os.makedirs(viewerDir, exist_ok=True)
+        return os.path.join(viewerDir, fileName)
+
+    def getUnitScaleModels(self):
+        """Models with pLDDT in [0, 1], from the confidence table of the protocol"""
+        tableFile = self.protocol.getConfidenceTableFile()
+        if not os.path.exists(tableFile):
+            return set()
+        from biofold.utils.utilsConfidence import readConfidenceTable, getConfidentThresholds
+        table = readConfidenceTable(tableFile)
+        return {os.path.abspath(str(modelFile)) for modelFile, threshold
+                in zip(table['files'], getConfidentThresholds(table)) if threshold < 1}
+
+    def writeModelsCommands(self, fnCmd, modelFiles, sessionFile):
+        unitScale = self.getUnitScaleModels()
+        with open(fnCmd, 'w') as f:
+            for modelFile in modelFiles:
+                f.write(f"open {modelFile}\n")
+            if len(modelFiles) > 1:
+                f.write(f"matchmaker #2-{len(modelFiles)} to #1\n")
+            for i, modelFile in enumerate(modelFiles):
+                palette = PLDDT_PALETTE_UNIT if modelFile in unitScale else PLDDT_PALETTE
+                f.write(f"color bfactor #{i + 1} palette {palette}\n")
+            f.write("view\n")
+            f.write(f"save {sessionFile}\n")
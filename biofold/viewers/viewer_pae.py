@@ -0,0 +1,123 @@
+# **************************************************************************
+# *
+# * Authors:   Blanca Pueche (blanca.pueche@cnb.csis.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+
+import pyworkflow.protocol.params as params
+from pyworkflow.viewer import ProtocolViewer, DESKTOP_TKINTER
+
+from biofold.protocols import ProtocolTargets
+
+# Error matrices shown by the viewer: key of the stored matrix, colour map upper limit (A)
+ERROR_MATRICES = [('pae', 31.75), ('pde', 31.75)]
+
+
+class ProtBiofoldPaeViewer(ProtocolViewer):
+    """ Heatmap of the predicted aligned (or distance) error of a model, with the chain pair blocks outlined.
+    The matrix is shown from a multiresolution pyramid built once next to it, so zooming and panning only read the
+    tiles of the region shown, at the resolution of the screen. """
+    _label = 'viewer PAE'
+    _targets = ProtocolTargets('ProtImportPredictions', 'ProtBoltz', 'ProtChai')
+    _environments = [DESKTOP_TKINTER]
+
+    def _defineParams(self, form):
+        form.addSection(label='Predicted aligned error')
+        form.addParam('jobName', params.StringParam, default='',
+                      label='Job: ', help='Job of the model. Models of all the jobs if empty.')
+        form.addParam('modelRank', params.IntParam, default=1,
+                      label='Model rank: ', help='Rank of the model, 1 is the best ranked model (of the job).')
+        form.addParam('errorMatrix', params.EnumParam, default=0, choices=['PAE', 'PDE'],
+                      label='Matrix: ',
+                      help='PAE: predicted aligned error (boltz, chai and imported AlphaFold3/Protenix models).\n'
+                           'PDE: predicted distance error (boltz and chai).')
+        form.addParam('displayPae', params.LabelParam,
+                      label='Display error heatmap: ')
+
+    def _getVisualizeDict(self):
+        return {'displayPae': self._showPae}
+
+    def _showPae(self, paramName=None):
+        from pwem.viewers.plotter import EmPlotter
+        from biofold.utils.utilsPae import PaePyramid, buildPyramid, findMatrixFile
+        models = self.protocol.getScoreStore().getModels(job=self.jobName.get() or None, limit=1,
+                                                         offset=max(1, self.modelRank.get()) - 1)
+        if not models:
+            return [self.errorMessage('No model found with this rank.', title='No model')]
+
+        modelFile, jobName, _ = models[0]
+        key, maxError = ERROR_MATRICES[self.errorMatrix.get()]
+        matrixFile = findMatrixFile(modelFile, key)
+        if matrixFile is None:
+            return [self.errorMessage(f'No {key.upper()} matrix was saved for {os.path.basename(modelFile)}. '
+                                      f'It is written by boltz and chai when "Write full PAE and PDE" is set, and '
+                                      f'imported from the AlphaFold3/Protenix full_data files.',
+                                      title=f'No {key.upper()}')]
+
+        pyramid = PaePyramid(buildPyramid(matrixFile, key, modelFile))
+        title = f"{key.upper()} of {os.path.basename(modelFile)}" + (f" ({jobName})" if jobName else "")
+        plotter = EmPlotter(windowTitle=title)
+        ax = plotter.createSubPlot(title, 'Scored residue', 'Aligned residue')
+        plotter.heatmap = TiledHeatmap(plotter.figure, ax, pyramid, maxError)
+        return [plotter]
+
+
+class TiledHeatmap:
+    """
+    Heatmap of a PaePyramid that reloads the region shown at the screen resolution when zooming or panning
+    """
+    def __init__(self, figure, ax, pyramid, maxValue):
+        self.figure, self.ax, self.pyramid = figure, ax, pyramid
+        size = pyramid.shape[0]
+        values, extent = pyramid.read((0, size), (0, size), self.getPixels())
+        self.image = ax.imshow(values, extent=extent, cmap='Greens_r', vmin=0, vmax=maxValue,
+                               interpolation='nearest', aspect='equal')
+        figure.colorbar(self.image, ax=ax, label='Expected error (A)')
+        self.drawChainBlocks(size)
+        ax.set_xlim(0, size)
+        ax.set_ylim(size, 0)
+        # The callbacks keep the heatmap alive, matplotlib only keeps weak references to bound methods
+        ax.callbacks.connect('xlim_changed', lambda ax: self.update(ax))
+        ax.callbacks.connect('ylim_changed', lambda ax: self.update(ax))
+
+    def getPixels(self):
+        return max(self.ax.bbox.width, self.ax.bbox.height)
+
+    def drawChainBlocks(self, size):
+        for boundary in self.pyramid.getChainBoundaries():
+            self.ax.axhline(boundary, color='black', linewidth=0.8)
+            self.ax.axvline(boundary, color='black', linewidth=0.8)
+        start = 0
+        for chain, count in self.pyramid.chains:
+            self.ax.text(start + count / 2, -0.01 * size, chain, ha='center', va='bottom', fontsize=8)
+            start += count
+
+    def update(self, ax):
+        cols, rows = sorted(ax.get_xlim()), sorted(ax.get_ylim())
+        values, extent = self.pyramid.read(rows, cols, self.getPixels())
+        if not values.size:
+            return
+        self.image.set_data(values)
+        self.image.set_extent(extent)
+        self.figure.canvas.draw_idle()
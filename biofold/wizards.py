@@ -27,112 +27,59 @@
 import json
 import os
 
+from biofold.constants import STRUCTURE_CACHE_SIZE
 from biofold.protocols import ProtBoltz, ProtChai
+from biofold.utils.utilsCache import MemoryCache
 from pwem.objects import AtomStruct, Sequence
 from pwem.wizards import SelectResidueWizard
 from pyworkflow.object import Pointer
 
 from pwchem.wizards.wizard_select_chain import SelectChainWizardQT, SelectResidueWizardQT
 
-SelectChainWizardQT().addTarget(protocol=ProtBoltz,
-                                targets=['inpChain'],
-                                inputs=[{'inputOrigin': ['inputSequence',
-                                                         'inputAtomStruct']}],
-                                outputs=['inpChain'])
-
-SelectResidueWizardQT().addTarget(protocol=ProtBoltz,
-                                  targets=['inpPositions'],
-                                  inputs=[{'inputOrigin': ['inputSequence', 'inputAtomStruct']},
-                                          'inpChain'],
-                                  outputs=['inpPositions'])
-
-SelectChainWizardQT().addTarget(protocol=ProtChai,
-                                targets=['inpChain'],
-                                inputs=[{'inputOrigin': ['inputSequence',
-                                                         'inputAtomStruct']}],
-                                outputs=['inpChain'])
-
-SelectResidueWizardQT().addTarget(protocol=ProtChai,
-                                  targets=['inpPositions'],
-                                  inputs=[{'inputOrigin': ['inputSequence', 'inputAtomStruct']},
-                                          'inpChain'],
-                                  outputs=['inpPositions'])
-
-class AddSequenceWizardBoltz(SelectResidueWizard):
-    _targets, _inputs, _outputs = [], {}, {}
+# Models and chains of the input structures, shared by all the wizards so each file is parsed once
+structureCache = MemoryCache(STRUCTURE_CACHE_SIZE)
 
-    def show(self, form, *params):
-        protocol = form.protocol
-        inputParams, outputParam = self.getInputOutput(form)
 
-        # StructName
-        inputObj = getattr(protocol, inputParams[0]).get()
-        pdbFile, AS, addPointer = '', False, True
-        if issubclass(type(inputObj), str):
-            outStr = [inputObj]
-            AS, addPointer = True, False
-        elif issubclass(type(inputObj), AtomStruct):
-            pdbFile = inputObj.getFileName()
-            outStr = [os.path.splitext(os.path.basename(pdbFile))[0]]
-            AS = True
-        elif issubclass(type(inputObj), Sequence):
-            outStr = [inputObj.getId().replace("|", "_")]
+class CachedStructureMixin:
+    """Reads the models and chains of the input AtomStruct from structureCache"""
+    @classmethod
+    def getModelsChainsStep(cls, protocol, inputObj):
+        if not isinstance(inputObj, AtomStruct):
+            return super(CachedStructureMixin, cls).getModelsChainsStep(protocol, inputObj)
+        return structureCache.get(inputObj.getFileName(),
+                                  lambda: super(CachedStructureMixin, cls).getModelsChainsStep(protocol, inputObj))
 
-        if AS:
-            # Chain
-            chainJson = getattr(protocol, inputParams[1]).get()
-            chainId = json.loads(chainJson)['chain']
-        else:
-            chainJson = ''
-
-        # Positions
-        posJson = getattr(protocol, inputParams[2]).get()
-        if posJson:
-            posIdxs = json.loads(posJson)['index']
-            seq = json.loads(posJson)['residues']
-            outStr += [posIdxs]
-        else:
-            outStr += ['FIRST-LAST']
-            finalResiduesList = self.getResidues(form, inputObj, chainJson)
-            idxs = [json.loads(finalResiduesList[0].get())['index'], json.loads(finalResiduesList[-1].get())['index']]
-            seq = self.getSequence(finalResiduesList, idxs)
 
-        chainStr, chainFileId = '', ''
-        if AS:
-          chainStr = ', "chain": "{}"'.format(chainId)
-          chainFileId = '_{}'.format(chainId)
+class SelectChainWizardBiofold(CachedStructureMixin, SelectChainWizardQT):
+    _targets, _inputs, _outputs = [], {}, {}
 
-        prevStr = getattr(protocol, outputParam[0]).get()
-        lenPrev = len(prevStr.strip().split('\n')) + 1
-        if prevStr.strip() == '':
-          lenPrev -= 1
-        elif not prevStr.endswith('\n'):
-          prevStr += '\n'
 
-        cyclic = getattr(protocol, 'cyclic').get()
-        val = getattr(protocol, 'entityType').get()
-        if val==0: entity = 'protein'
-        elif val==1: entity = 'dna'
-        else: entity = 'rna'
+class SelectResidueWizardBiofold(CachedStructureMixin, SelectResidueWizardQT):
+    _targets, _inputs, _outputs = [], {}, {}
 
-        seqFile = protocol.getProject().getTmpPath('{}{}_{}.fa'.format(outStr[0], chainFileId, outStr[1]))
-        with open(seqFile, 'w') as f:
-            f.write('>{}\n{}\n'.format(outStr[0], seq))
 
-        jsonStr = '%s) {"name": "%s"%s, "index": "%s", "seqFile": "%s", "entity": "%s", "cyclic": "%s"}\n' % \
-                  (lenPrev, outStr[0], chainStr, outStr[1], seqFile, entity, cyclic)
-        form.setVar(outputParam[0], prevStr + jsonStr)
+for protocol in [ProtBoltz, ProtChai]:
+    SelectChainWizardBiofold().addTarget(protocol=protocol,
+                                         targets=['inpChain'],
+                                         inputs=[{'inputOrigin': ['inputSequence',
+                                                                  'inputAtomStruct']}],
+                                         outputs=['inpChain'])
 
+    SelectResidueWizardBiofold().addTarget(protocol=protocol,
+                                           targets=['inpPositions'],
+                                           inputs=[{'inputOrigin': ['inputSequence', 'inputAtomStruct']},
+                                                   'inpChain'],
+                                           outputs=['inpPositions'])
 
-AddSequenceWizardBoltz().addTarget(protocol=ProtBoltz,
-                              targets=['addInput'],
-                              inputs=[{'inputOrigin': ['inputSequence', 'inputAtomStruct', 'inputPDB']},
-                                      'inpChain', 'inpPositions'],
-                              outputs=['inputList', 'inputPointers'])
 
-class AddSequenceWizardChai(SelectResidueWizard):
+class AddSequenceWizard(CachedStructureMixin, SelectResidueWizard):
+    """Adds the selected chain/residues of the input to the list of entities of the protocol"""
     _targets, _inputs, _outputs = [], {}, {}
 
+    def getExtraFields(self, protocol):
+        """Extra fields of the entity, as a json string starting with a comma"""
+        return ''
+
     def show(self, form, *params):
         protocol = form.protocol
         inputParams, outputParam = self.getInputOutput(form)
@@ -190,11 +137,28 @@ class AddSequenceWizardChai(SelectResidueWizard):
         with open(seqFile, 'w') as f:
             f.write('>{}\n{}\n'.format(outStr[0], seq))
 
-        jsonStr = '%s) {"name": "%s"%s, "index": "%s", "seqFile": "%s", "entity": "%s"}\n' % \
-                  (lenPrev, outStr[0], chainStr, outStr[1], seqFile, entity)
+        jsonStr = '%s) {"name": "%s"%s, "index": "%s", "seqFile": "%s", "entity": "%s"%s}\n' % \
+                  (lenPrev, outStr[0], chainStr, outStr[1], seqFile, entity, self.getExtraFields(protocol))
         form.setVar(outputParam[0], prevStr + jsonStr)
 
 
+class AddSequenceWizardBoltz(AddSequenceWizard):
+    _targets, _inputs, _outputs = [], {}, {}
+
+    def getExtraFields(self, protocol):
+        return ', "cyclic": "{}"'.format(getattr(protocol, 'cyclic').get())
+
+
+class AddSequenceWizardChai(AddSequenceWizard):
+    _targets, _inputs, _outputs = [], {}, {}
+
+
+AddSequenceWizardBoltz().addTarget(protocol=ProtBoltz,
+                              targets=['addInput'],
+                              inputs=[{'inputOrigin': ['inputSequence', 'inputAtomStruct', 'inputPDB']},
+                                      'inpChain', 'inpPositions'],
+                              outputs=['inputList', 'inputPointers'])
+
 AddSequenceWizardChai().addTarget(protocol=ProtChai,
                               targets=['addInput'],
                               inputs=[{'inputOrigin': ['inputSequence', 'inputAtomStruct']},